@@ -0,0 +1,86 @@
+"""
+Latency of a well behaved client while other clients flood the server,
+with and without admission control.
+
+    python -m benchmarks.bench_admission --flooders 16 --duration 5
+
+Flooders send list_files as fast as they can without a session, so each
+request costs the server RSA. The measured client sends one list_files
+every 10ms. With --user-rate each user is limited to that many requests
+per second, so the flood is refused cheaply rather than queued in front
+of everyone else.
+"""
+import time
+import argparse
+import threading
+import statistics
+
+import fileserve
+from benchmarks.common import quiet, running_server
+
+
+def flood(port: int, user: str, stop: threading.Event, counts: dict):
+    client = fileserve.Client(user, port=port, session=False)
+    while not stop.is_set():
+        header = client.run("list_files", "", "")["header"]
+        counts[header] = counts.get(header, 0) + 1
+    client.close()
+
+
+def main(args):
+    print("{:>10} {:>10} {:>10} {:>10} {:>12}".format(
+        "user rate", "p50 ms", "p99 ms", "max ms", "refused/s"
+    ))
+    for rate in [0, args.user_rate]:
+        admission = fileserve.AdmissionControl(user_rate=rate, user_burst=rate)
+        with running_server(engine=args.engine, admission=admission) as server:
+            port = server.server_address[1]
+            users = ["flood{}".format(i) for i in range(args.flooders // 2 + 1)]
+            with quiet():
+                for user in users + ["good"]:
+                    fileserve.Client(user, port=port, keepalive=False).run("add_user", "", "")
+
+                stop = threading.Event()
+                counts = {}
+                threads = [
+                    threading.Thread(
+                        target=flood, args=(port, users[i // 2 if i % 2 else 0], stop, counts)
+                    )
+                    for i in range(args.flooders)
+                ]
+                for t in threads:
+                    t.start()
+
+                client = fileserve.Client("good", port=port)
+                latencies = []
+                end = time.perf_counter() + args.duration
+                while time.perf_counter() < end:
+                    start = time.perf_counter()
+                    client.run("list_files", "", "")
+                    latencies.append(time.perf_counter() - start)
+                    time.sleep(0.01)
+                client.close()
+
+                stop.set()
+                for t in threads:
+                    t.join()
+
+        latencies.sort()
+        print("{:>10} {:>10.2f} {:>10.2f} {:>10.2f} {:>12.0f}".format(
+            rate or "none",
+            statistics.median(latencies) * 1e3,
+            latencies[int(len(latencies) * 0.99)] * 1e3,
+            latencies[-1] * 1e3,
+            counts.get(fileserve.admission.OVERLOADED, 0) / args.duration,
+        ))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--flooders", type=int, default=16, help="Clients flooding the server")
+    parser.add_argument("--duration", type=float, default=5.0, help="Seconds to measure")
+    parser.add_argument("--user-rate", type=float, default=20, help="Requests/sec allowed per user")
+    parser.add_argument("--engine", type=str, default="thread", choices=["thread", "asyncio"])
+    args = parser.parse_args()
+    main(args)
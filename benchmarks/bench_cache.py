@@ -0,0 +1,75 @@
+"""
+Download throughput of a hot set of shared files with and without the
+server's file cache.
+
+    python -m benchmarks.bench_cache --files 200 --size 64K --downloads 20000
+
+Downloads pick files with a Zipf-like skew, so a few files are requested
+far more often than the rest, and run directly against the Database to
+leave out network and crypto costs.
+"""
+import os
+import time
+import random
+import shutil
+import argparse
+import tempfile
+
+import fileserve
+from benchmarks.common import parse_size, quiet
+
+
+def run(cache_bytes: int, files: int, size: int, downloads: int, skew: float):
+    """ Return (downloads per second, cache stats) """
+    cwd = os.getcwd()
+    tmp = tempfile.mkdtemp()
+    os.chdir(tmp)
+    try:
+        with quiet():
+            db = fileserve.Database(sync_every=0, cache_bytes=cache_bytes)
+            db.add_user("client")
+            names = ["file{}".format(i) for i in range(files)]
+            for name in names:
+                db.upload_file("client", name, os.urandom(size))
+
+        rng = random.Random(0)
+        weights = [1 / (rank + 1) ** skew for rank in range(files)]
+        picks = rng.choices(names, weights, k=downloads)
+
+        start = time.perf_counter()
+        for name in picks:
+            with db.locks(("file", name)):
+                db.download_file("client", name)
+        elapsed = time.perf_counter() - start
+
+        stats = db.cache.stats()
+        db.journal.close()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    return downloads / elapsed, stats
+
+
+def main(args):
+    size = parse_size(args.size)
+
+    print("{:>10} {:>14} {:>8} {:>10}".format("cache", "downloads/s", "hit %", "evictions"))
+    for cache in args.caches.split(","):
+        rate, stats = run(parse_size(cache), args.files, size, args.downloads, args.skew)
+        lookups = stats["hits"] + stats["misses"]
+        print("{:>10} {:>14.0f} {:>8.1f} {:>10}".format(
+            cache, rate, 100 * stats["hits"] / lookups if lookups else 0.0, stats["evictions"]
+        ))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=200, help="Distinct files")
+    parser.add_argument("--size", type=str, default="64K", help="Size of each file")
+    parser.add_argument("--downloads", type=int, default=20000, help="Downloads to run")
+    parser.add_argument("--skew", type=float, default=1.0, help="Zipf exponent of popularity")
+    parser.add_argument("--caches", type=str, default="0,1M,4M,16M", help="Cache sizes to compare")
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,80 @@
+"""
+Compare encode/decode time and bytes on the wire of the binary codec against
+the pickled dicts it replaced.
+
+    python -m benchmarks.bench_codec --sizes 0,1K,64K,1M
+
+The "legacy" column is the wire size of the original format: the data dict
+pickled, encrypted with rsa_encrypt into base64 strings and pickled again
+inside the request dict. Ciphertext is stood in for by random bytes of the
+plaintext's length, which is what the AEAD produces.
+"""
+import os
+import pickle
+import argparse
+from base64 import b64encode
+
+from fileserve import codec
+from benchmarks.common import parse_sizes, format_size, measure
+
+
+def build_request(size: int) -> codec.Request:
+    """ Plaintext upload request carrying size bytes of file data """
+    return codec.Request(
+        header="upload_file",
+        sender="client",
+        data=codec.RequestData(
+            filename="tmp.txt",
+            user1="client",
+            data=os.urandom(size),
+            key=os.urandom(32),
+        ),
+    )
+
+
+def legacy_size(request: codec.Request) -> int:
+    """ Wire size of the pickle, base64, pickle envelope """
+    inner = pickle.dumps(request["data"].to_dict())
+    outer = request.to_dict()
+    outer["data"] = b64encode(os.urandom(len(inner))).decode("utf-8")
+    outer["mac"] = b64encode(os.urandom(256)).decode("utf-8")
+    return len(pickle.dumps(outer))
+
+
+def main(args):
+    print("{:>8} {:>10} {:>10} {:>10} {:>12} {:>12} {:>12} {:>12}".format(
+        "size", "legacy B", "pickle B", "codec B",
+        "pickle enc", "codec enc", "pickle dec", "codec dec",
+    ))
+
+    for size in parse_sizes(args.sizes):
+        request = build_request(size)
+        as_dict = request.to_dict()
+
+        pickled = pickle.dumps(as_dict)
+        encoded = codec.encode(request)
+
+        times = [
+            measure(lambda: pickle.dumps(as_dict), args.min_time, args.max_iters),
+            measure(lambda: codec.encode(request), args.min_time, args.max_iters),
+            measure(lambda: pickle.loads(pickled), args.min_time, args.max_iters),
+            measure(lambda: codec.decode(encoded, codec.Request), args.min_time, args.max_iters),
+        ]
+
+        print("{:>8} {:>10} {:>10} {:>10} {}".format(
+            format_size(size),
+            legacy_size(request),
+            len(pickled),
+            len(encoded),
+            " ".join("{:>10.2f}us".format(t * 1e6) for t in times),
+        ))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=str, default="0,1K,64K,1M", help="File data sizes")
+    parser.add_argument("--min-time", type=float, default=0.2, help="Minimum seconds per measurement")
+    parser.add_argument("--max-iters", type=int, default=100000, help="Maximum calls per measurement")
+    args = parser.parse_args()
+    main(args)
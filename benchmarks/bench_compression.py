@@ -0,0 +1,110 @@
+"""
+Ratio and throughput of the compress-before-encrypt stage on text, binary
+and random data, per codec, and the disk usage of the compressed store.
+
+    python -m benchmarks.bench_compression --size 16M
+
+Data is compressed in transfer sized chunks the way streams send it, so
+the entropy check and per chunk overheads are included. "sent" is bytes on
+the wire relative to the original, "stored" is the compressed chunk store's
+disk usage relative to the original.
+"""
+import sys
+import time
+import random
+import shutil
+import argparse
+import tempfile
+
+from fileserve import compression, streaming
+from fileserve.storage import ChunkStore
+from benchmarks.common import parse_size
+
+
+def text_data(size: int) -> bytes:
+    """ Server log lines """
+    rng = random.Random(0)
+    paths = ["/api/files", "/api/users", "/static/app.js", "/health", "/login"]
+    lines = []
+    total = 0
+    while total < size:
+        line = "2024-05-{:02d}T{:02d}:{:02d}:{:02d}Z INFO {} {} {} {}ms user={}\n".format(
+            rng.randrange(1, 29), rng.randrange(24), rng.randrange(60), rng.randrange(60),
+            rng.choice(["GET", "POST", "PUT"]), rng.choice(paths),
+            rng.choice([200, 200, 200, 304, 404, 500]), rng.randrange(1, 900),
+            rng.randrange(10000),
+        ).encode()
+        lines.append(line)
+        total += len(line)
+    return b"".join(lines)[:size]
+
+
+def binary_data(size: int) -> bytes:
+    """ An executable, repeated to size """
+    with open(sys.executable, "rb") as f:
+        data = f.read()
+    return (data * (size // len(data) + 1))[:size]
+
+
+def random_data(size: int) -> bytes:
+    """ Incompressible, like media or already compressed archives """
+    return random.Random(0).randbytes(size)
+
+
+def chunks(data: bytes):
+    view = memoryview(data)
+    step = streaming.CHUNK_SIZE
+    return [bytes(view[i:i + step]) for i in range(0, len(data), step)]
+
+
+def stored_ratio(data: bytes, codec: str) -> float:
+    """ Disk usage of a chunk store compressing with codec relative to the data """
+    tmp = tempfile.mkdtemp()
+    try:
+        store = ChunkStore(tmp, compression=codec)
+        store.save("file", chunks(data))
+        return store.usage() / len(data)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def main(args):
+    size = parse_size(args.size)
+    datasets = [("text", text_data), ("binary", binary_data), ("random", random_data)]
+
+    print("{:>8} {:>6} {:>8} {:>8} {:>14} {:>14}".format(
+        "data", "codec", "sent", "stored", "compress MB/s", "decompress MB/s"
+    ))
+
+    for name, build in datasets:
+        pieces = chunks(build(size))
+
+        for codec in args.codecs.split(","):
+            codec = "" if codec == "none" else codec
+
+            start = time.perf_counter()
+            compressed = [compression.compress(piece, codec) for piece in pieces]
+            compress_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            for used, payload in compressed:
+                compression.decompress(payload, used, streaming.CHUNK_SIZE)
+            decompress_time = time.perf_counter() - start
+
+            print("{:>8} {:>6} {:>8.3f} {:>8.3f} {:>14.1f} {:>14.1f}".format(
+                name,
+                codec or "none",
+                sum(len(payload) for _, payload in compressed) / size,
+                stored_ratio(b"".join(pieces), codec),
+                size / compress_time / 1e6,
+                size / decompress_time / 1e6,
+            ))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=str, default="16M", help="Bytes of each kind of data")
+    parser.add_argument("--codecs", type=str, default="none,zlib,lzma", help="Codecs to compare")
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,72 @@
+"""
+Bytes sent and time taken to store an edited file by re-uploading it whole
+versus by update_file's delta transfer.
+
+    python -m benchmarks.bench_delta --sizes 1M,16M,128M --edit 100
+
+Each file is uploaded once, then has --edit bytes overwritten in the middle
+and a few bytes inserted near the start, and is sent again both ways.
+"""
+import os
+import time
+import argparse
+
+import fileserve
+from fileserve import utils
+from benchmarks.common import parse_sizes, format_size, quiet, running_server
+
+
+def main(args):
+    print("{:>8} {:>12} {:>12} {:>12} {:>12}".format(
+        "size", "upload B", "delta B", "upload s", "update s"
+    ))
+
+    with running_server(engine=args.engine) as server:
+        with quiet():
+            client = fileserve.Client("client", port=server.server_address[1])
+            client.run("add_user", "", "")
+
+        for size in parse_sizes(args.sizes):
+            name = "file{}".format(size)
+            data = os.urandom(size)
+            utils.save_file(client.FILE_DIR, name, data)
+
+            with quiet():
+                client.run("upload_file", name, "")
+
+            middle = size // 2
+            edited = data[:16] + b"inserted" + data[16:middle] + os.urandom(args.edit)
+            edited += data[middle + args.edit:]
+            utils.save_file(client.FILE_DIR, name, edited)
+            utils.save_file(client.FILE_DIR, name + ".copy", edited)
+
+            with quiet():
+                start = time.perf_counter()
+                client.run("upload_file", name + ".copy", "")
+                upload_time = time.perf_counter() - start
+
+                start = time.perf_counter()
+                signature = client.exchange(client.generate_request("file_signature", name, ""))
+                request = client.generate_update(name, signature)
+                client.exchange(request)
+                update_time = time.perf_counter() - start
+
+            print("{:>8} {:>12} {:>12} {:>12.3f} {:>12.3f}".format(
+                format_size(size),
+                len(edited),
+                len(signature["data"]["data"]) + len(request["data"]["data"]),
+                upload_time,
+                update_time,
+            ))
+
+        client.close()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=str, default="1M,16M,128M", help="File sizes")
+    parser.add_argument("--edit", type=int, default=100, help="Bytes overwritten in each file")
+    parser.add_argument("--engine", type=str, default="thread", choices=["thread", "asyncio"])
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,82 @@
+"""
+Per-request overhead of checking and dispatching requests in process,
+without sockets or encryption.
+
+    python -m benchmarks.bench_dispatch --min-time 1.0
+
+Each row is the mean time of one RequestProcessor.process_request call.
+The rejected rows fail error checking, the others reach the database with
+a small cached file and an unsynced journal, so what is left is mostly
+the Python work around the operation.
+"""
+import os
+import shutil
+import tempfile
+import argparse
+
+import fileserve
+from fileserve import codec
+from fileserve.server import RequestProcessor
+from benchmarks.common import measure, quiet
+
+
+def build_request(header: str, user1: str, filename: str = "", user2: str = "") -> codec.Request:
+    return codec.Request(
+        header=header,
+        sender=user1,
+        data=codec.RequestData(user1=user1, user2=user2, filename=filename),
+    )
+
+
+def main(args):
+    cwd = os.getcwd()
+    tmp_dir = tempfile.mkdtemp()
+    os.chdir(tmp_dir)
+
+    try:
+        with quiet():
+            db = fileserve.Database(sync_every=0)
+        processor = RequestProcessor(db)
+        db.add_user("alice")
+        db.add_user("bob")
+        db.upload_file("alice", "a.txt", os.urandom(1024))
+
+        share = build_request("share_file", "alice", "a.txt", "bob")
+        revoke = build_request("revoke_access", "alice", "a.txt", "bob")
+
+        def share_and_revoke():
+            processor.process_request(None, share)
+            processor.process_request(None, revoke)
+
+        cases = [
+            ("unknown header", build_request("rename_file", "alice", "a.txt")),
+            ("rejected download", build_request("download_file", "bob", "a.txt")),
+            ("rejected share", build_request("share_file", "bob", "a.txt", "alice")),
+            ("download 1K", build_request("download_file", "alice", "a.txt")),
+            ("file_signature", build_request("file_signature", "alice", "a.txt")),
+            ("list_files", build_request("list_files", "alice")),
+        ]
+
+        print("{:>20} {:>12}".format("request", "us/request"))
+        for name, request in cases:
+            t = measure(
+                lambda: processor.process_request(None, request), args.min_time, args.max_iters
+            )
+            print("{:>20} {:>12.2f}".format(name, t * 1e6))
+
+        t = measure(share_and_revoke, args.min_time, args.max_iters) / 2
+        print("{:>20} {:>12.2f}".format("share/revoke", t * 1e6))
+
+        db.close()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--min-time", type=float, default=0.5, help="Minimum seconds per measurement")
+    parser.add_argument("--max-iters", type=int, default=200000, help="Maximum calls per measurement")
+    args = parser.parse_args()
+    main(args)
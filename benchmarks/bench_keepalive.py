@@ -0,0 +1,43 @@
+"""
+Operations/sec for many small requests with a new connection per request
+versus one persistent keep-alive connection.
+
+    python -m benchmarks.bench_keepalive --ops 10000
+
+The operation is an unencrypted add_user for an existing user, so the
+number reflects connection and framing overhead rather than RSA.
+"""
+import time
+import argparse
+
+import fileserve
+from benchmarks.common import quiet, running_server
+
+
+def main(args):
+    print("{:>8} {:>10} {:>10}".format("engine", "keepalive", "ops/s"))
+    for engine in args.engines.split(","):
+        with running_server(engine=engine) as server:
+            port = server.server_address[1]
+
+            for keepalive in [False, True]:
+                with quiet():
+                    client = fileserve.Client("bench", port=port, keepalive=keepalive)
+                    client.run("add_user", "", "")
+
+                    start = time.perf_counter()
+                    for _ in range(args.ops):
+                        client.run("add_user", "", "")
+                    elapsed = time.perf_counter() - start
+                    client.close()
+
+                print("{:>8} {:>10} {:>10.0f}".format(engine, str(keepalive), args.ops / elapsed))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--engines", type=str, default="thread,asyncio", help="Engines to compare")
+    parser.add_argument("--ops", type=int, default=10000, help="Requests per measurement")
+    args = parser.parse_args()
+    main(args)
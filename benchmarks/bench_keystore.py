@@ -0,0 +1,60 @@
+"""
+Requests/sec of the server side message crypto (decrypt_request followed by
+encrypt_response) when keys are re-read and re-parsed from PEM on every
+message versus served from a KeyStore.
+
+    python -m benchmarks.bench_keystore
+"""
+import os
+import argparse
+import tempfile
+
+from fileserve import codec
+from fileserve import crypto
+from fileserve import utils
+from fileserve.keystore import KeyStore
+from benchmarks.common import measure
+
+
+def main(args):
+    key_dir = tempfile.mkdtemp()
+    paths = {}
+    for user in ["client", "server"]:
+        pub_key, priv_key = crypto.generate_keys()
+        crypto.export_keys(key_dir, user, pub_key, priv_key)
+        paths[user] = (
+            os.path.join(key_dir, user + "_public.pem"),
+            os.path.join(key_dir, user + "_private.pem"),
+        )
+
+    def read(path):
+        with open(path, "r") as f:
+            return f.read()
+
+    data = utils.serialize(codec.RequestData(filename="tmp.txt", user1="client", data=b"x" * args.size))
+    ciphertext, mac = crypto.hybrid_encrypt(data, read(paths["server"][0]), read(paths["client"][1]))
+
+    def pem_request():
+        plaintext = crypto.hybrid_decrypt(ciphertext, mac, read(paths["client"][0]), read(paths["server"][1]))
+        crypto.hybrid_encrypt(plaintext, read(paths["client"][0]), read(paths["server"][1]))
+
+    store = KeyStore()
+
+    def store_request():
+        plaintext = crypto.hybrid_decrypt(
+            ciphertext, mac, store.get(paths["client"][0]), store.get(paths["server"][1])
+        )
+        crypto.hybrid_encrypt(plaintext, store.get(paths["client"][0]), store.get(paths["server"][1]))
+
+    for name, fn in [("pem", pem_request), ("keystore", store_request)]:
+        t = measure(fn, args.min_time, max_iters=100000)
+        print("{:>10} {:>10.1f} req/s".format(name, 1 / t))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=128, help="Payload size in bytes")
+    parser.add_argument("--min-time", type=float, default=2.0, help="Minimum seconds per measurement")
+    args = parser.parse_args()
+    main(args)
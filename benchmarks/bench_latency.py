@@ -0,0 +1,61 @@
+"""
+Round trip latency of small requests against a FileServer on localhost.
+
+    python -m benchmarks.bench_latency --requests 200
+"""
+import time
+import argparse
+import statistics
+
+import fileserve
+from benchmarks.common import quiet, running_server
+
+
+def round_trip(client: fileserve.Client, command: str, filename: str = "", user2: str = "") -> float:
+    """ Time a single request/response through the client """
+    start = time.perf_counter()
+    with quiet():
+        client.run(command, filename, user2)
+    return time.perf_counter() - start
+
+
+def report(name: str, samples: list):
+    samples = sorted(samples)
+    p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+    print("{:>24} mean {:8.2f} ms  p50 {:8.2f} ms  p99 {:8.2f} ms".format(
+        name,
+        statistics.mean(samples) * 1e3,
+        statistics.median(samples) * 1e3,
+        p99 * 1e3,
+    ))
+
+
+def main(args):
+    with running_server() as server:
+        with quiet():
+            client = fileserve.Client("bench", port=server.server_address[1])
+            client.run("add_user", "", "")
+            fileserve.utils.save_file(client.FILE_DIR, "small.txt", b"x" * args.size)
+            client.run("upload_file", "small.txt", "")
+
+        for use_session in [False, True]:
+            client.close()
+            client.use_session = use_session
+            suffix = " (session)" if use_session else ""
+
+            # add_user on an existing user is an error round trip
+            report("add_user" + suffix, [
+                round_trip(client, "add_user") for _ in range(args.requests)
+            ])
+            report("download_file" + suffix, [
+                round_trip(client, "download_file", "small.txt") for _ in range(args.requests)
+            ])
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=200, help="Requests per operation")
+    parser.add_argument("--size", type=int, default=100, help="File size for downloads")
+    args = parser.parse_args()
+    main(args)
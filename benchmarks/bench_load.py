@@ -0,0 +1,89 @@
+"""
+Load test comparing the threaded and asyncio server engines with many
+concurrent connections.
+
+    python -m benchmarks.bench_load --connections 1000,10000 --hold 1.0
+
+Every connection is opened first and held idle for --hold seconds, which
+is how slow clients look to the server, before sending one unencrypted
+add_user request. 10k connections need a high open file limit.
+"""
+import time
+import asyncio
+import argparse
+import resource
+import statistics
+
+from fileserve import utils
+from fileserve import protocol
+from fileserve.server import new_request
+from benchmarks.common import quiet, running_server
+
+
+async def one_client(port: int, request: bytes, hold: float, start_event: asyncio.Event):
+    """ Connect, wait for the go signal, then time one round trip """
+    reader, writer = await asyncio.open_connection("localhost", port)
+    try:
+        await start_event.wait()
+        await asyncio.sleep(hold)
+        start = time.perf_counter()
+        await protocol.send_frame_async(writer, request, protocol.MSG_REQUEST)
+        await protocol.recv_frame_async(reader)
+        return time.perf_counter() - start
+    finally:
+        writer.close()
+
+
+async def run_load(port: int, connections: int, hold: float):
+    request = new_request()
+    request["header"] = "add_user"
+    request["sender"] = request["data"]["user1"] = "load"
+    request = utils.serialize(request)
+
+    start_event = asyncio.Event()
+    tasks = [
+        asyncio.ensure_future(one_client(port, request, hold, start_event))
+        for _ in range(connections)
+    ]
+    await asyncio.sleep(0)
+
+    start = time.perf_counter()
+    start_event.set()
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    elapsed = time.perf_counter() - start - hold
+
+    latencies = sorted(r for r in results if isinstance(r, float))
+    errors = len(results) - len(latencies)
+    return elapsed, latencies, errors
+
+
+def main(args):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    print("{:>8} {:>11} {:>10} {:>10} {:>10} {:>8}".format(
+        "engine", "connections", "req/s", "p50 ms", "p99 ms", "errors"
+    ))
+    for engine in args.engines.split(","):
+        for connections in [int(c) for c in args.connections.split(",")]:
+            with running_server(engine=engine) as server:
+                with quiet():
+                    elapsed, latencies, errors = asyncio.run(
+                        run_load(server.server_address[1], connections, args.hold)
+                    )
+
+            p50 = statistics.median(latencies) * 1e3 if latencies else float("nan")
+            p99 = latencies[int(len(latencies) * 0.99)] * 1e3 if latencies else float("nan")
+            print("{:>8} {:>11} {:>10.0f} {:>10.2f} {:>10.2f} {:>8}".format(
+                engine, connections, len(latencies) / elapsed, p50, p99, errors
+            ))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--engines", type=str, default="thread,asyncio", help="Engines to compare")
+    parser.add_argument("--connections", type=str, default="1000,5000", help="Concurrent connections")
+    parser.add_argument("--hold", type=float, default=0.5, help="Seconds each connection idles first")
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,87 @@
+"""
+Throughput of small CPU-bound requests against the number of server
+worker processes.
+
+    python -m benchmarks.bench_prefork --processes 1,2,4 --clients 8
+
+Each client runs in its own process and sends list_files requests without
+a session, so every request pays an RSA decryption on the server and the
+work is bound by the server's CPU rather than by I/O. With enough cores
+requests/sec should grow close to linearly with the processes.
+"""
+import os
+import time
+import shutil
+import tempfile
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import fileserve
+from fileserve.prefork import PreforkServer
+from benchmarks.common import quiet
+
+
+def run_client(user: str, port: int, requests: int) -> float:
+    """ Seconds one client takes to send its requests """
+    with quiet():
+        client = fileserve.Client(user, port=port, session=False)
+        client.run("add_user", "", "")
+
+        start = time.perf_counter()
+        for _ in range(requests):
+            client.run("list_files", "", "")
+        elapsed = time.perf_counter() - start
+        client.close()
+    return elapsed
+
+
+def main(args):
+    cwd = os.getcwd()
+    tmp_dir = tempfile.mkdtemp()
+    os.chdir(tmp_dir)
+
+    context = multiprocessing.get_context("spawn")
+    print("{:>10} {:>8} {:>10} {:>8}".format("processes", "clients", "req/s", "speedup"))
+    try:
+        base = None
+        with ProcessPoolExecutor(max_workers=args.clients, mp_context=context) as clients:
+            for processes in [int(p) for p in args.processes.split(",")]:
+                shutil.rmtree("db", ignore_errors=True)
+                with quiet():
+                    server = PreforkServer(
+                        {"sync_every": 0}, ("localhost", 0), processes=processes, engine=args.engine
+                    )
+                port = server.server_address[1]
+
+                try:
+                    times = list(clients.map(
+                        run_client,
+                        ["bench{}".format(i) for i in range(args.clients)],
+                        [port] * args.clients,
+                        [args.requests] * args.clients,
+                    ))
+                finally:
+                    with quiet():
+                        server.shutdown()
+                        server.server_close()
+
+                rate = args.clients * args.requests / max(times)
+                base = base or rate
+                print("{:>10} {:>8} {:>10.0f} {:>8.2f}".format(
+                    processes, args.clients, rate, rate / base
+                ))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--processes", type=str, default="1,2,4", help="Server processes to compare")
+    parser.add_argument("--clients", type=int, default=8, help="Concurrent client processes")
+    parser.add_argument("--requests", type=int, default=200, help="Requests per client")
+    parser.add_argument("--engine", type=str, default="thread", choices=["thread", "asyncio"])
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,96 @@
+"""
+Disk usage and upload time of the flat and chunked storage backends on a
+corpus of versioned files.
+
+    python -m benchmarks.bench_storage --files 20 --size 4M --versions 5
+
+Every file is uploaded once and then as a number of new versions, each a
+copy of the previous one with a few small in-place edits and some data
+appended, like successive saves of a document or a growing log. The last
+pass uploads an identical copy of every file under a new name.
+"""
+import os
+import time
+import random
+import shutil
+import argparse
+import tempfile
+
+import fileserve
+from benchmarks.common import parse_size, quiet
+
+
+def build_corpus(files: int, size: int, versions: int, edits: int, seed: int = 0):
+    """ Yield (name, data) for every version of every file """
+    rng = random.Random(seed)
+    for i in range(files):
+        data = bytearray(rng.randbytes(size))
+        for v in range(versions + 1):
+            if v > 0:
+                for _ in range(edits):
+                    offset = rng.randrange(len(data) - 4096)
+                    data[offset:offset + 4096] = rng.randbytes(4096)
+                data += rng.randbytes(size // 64)
+            yield "file{}.v{}".format(i, v), bytes(data)
+
+
+def run(storage: str, corpus, fsync: bool):
+    """ Upload the corpus and return (logical bytes, disk bytes, seconds, copy seconds) """
+    cwd = os.getcwd()
+    tmp = tempfile.mkdtemp()
+    os.chdir(tmp)
+    try:
+        with quiet():
+            db = fileserve.Database(sync_every=int(fsync), storage=storage)
+            db.add_user("client")
+
+            logical = 0
+            start = time.perf_counter()
+            for name, data in corpus:
+                db.upload_file("client", name, data)
+                logical += len(data)
+            elapsed = time.perf_counter() - start
+
+            start = time.perf_counter()
+            for name, data in corpus:
+                db.upload_file("client", "copy." + name, data)
+            copy_elapsed = time.perf_counter() - start
+
+            usage = db.storage.usage()
+            db.journal.close()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    return logical, usage, elapsed, copy_elapsed
+
+
+def main(args):
+    corpus = list(build_corpus(args.files, parse_size(args.size), args.versions, args.edits))
+
+    print("{:>8} {:>11} {:>11} {:>8} {:>12} {:>12}".format(
+        "storage", "logical MB", "on disk MB", "ratio", "upload MB/s", "copy MB/s"
+    ))
+    for storage in args.storage.split(","):
+        logical, usage, elapsed, copy_elapsed = run(storage, corpus, args.fsync)
+        print("{:>8} {:>11.1f} {:>11.1f} {:>8.2f} {:>12.1f} {:>12.1f}".format(
+            storage,
+            logical * 2 / 1e6,
+            usage / 1e6,
+            logical * 2 / usage,
+            logical / elapsed / 1e6,
+            logical / copy_elapsed / 1e6,
+        ))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=20, help="Distinct files")
+    parser.add_argument("--size", type=str, default="4M", help="Initial size of each file")
+    parser.add_argument("--versions", type=int, default=5, help="New versions per file")
+    parser.add_argument("--edits", type=int, default=3, help="4K in-place edits per version")
+    parser.add_argument("--storage", type=str, default="flat,chunked", help="Backends to compare")
+    parser.add_argument("--fsync", action="store_true", help="fsync every file and journal record")
+    args = parser.parse_args()
+    main(args)
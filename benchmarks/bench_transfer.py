@@ -0,0 +1,80 @@
+"""
+Throughput of receiving one large frame over a localhost TCP connection
+with the preallocated recv_into path versus the old `data += received`
+loop.
+
+    python -m benchmarks.bench_transfer --sizes 1M,100M,1G
+
+The old loop is quadratic in message size, so it is only run up to
+--legacy-max.
+"""
+import time
+import socket
+import argparse
+import threading
+
+from fileserve import protocol
+from benchmarks.common import parse_sizes, format_size
+
+
+def legacy_recvall(s: socket.socket, length: int, chunksize: int) -> bytes:
+    """ The receive loop RequestHandler used before framing """
+    data = b""
+    while len(data) < length:
+        received = s.recv(chunksize)
+        if not received:
+            break
+        data += received
+    return data
+
+
+def transfer(size: int, receive) -> float:
+    """ Send a frame of size bytes and time how long receive takes """
+    listener = socket.create_server(("localhost", 0))
+    payload = bytes(size)
+
+    def sender():
+        conn = socket.create_connection(listener.getsockname())
+        protocol.send_frame(conn, payload, protocol.MSG_REQUEST)
+        conn.close()
+
+    t = threading.Thread(target=sender)
+    t.start()
+    conn, _ = listener.accept()
+
+    start = time.perf_counter()
+    receive(conn, size)
+    elapsed = time.perf_counter() - start
+
+    t.join()
+    conn.close()
+    listener.close()
+    return elapsed
+
+
+def main(args):
+    print("{:>8} {:>16} {:>16}".format("size", "legacy MB/s", "recv_into MB/s"))
+    for size in parse_sizes(args.sizes):
+        legacy_rate = "n/a"
+        if size <= args.legacy_max:
+            t = transfer(size, lambda s, n: (
+                protocol.recv_exact(s, protocol.HEADER_SIZE),
+                legacy_recvall(s, n, args.legacy_chunksize),
+            ))
+            legacy_rate = "{:.1f}".format(size / t / 1e6)
+
+        t = transfer(size, lambda s, n: protocol.recv_frame(s, max_size=size))
+        rate = "{:.1f}".format(size / t / 1e6)
+
+        print("{:>8} {:>16} {:>16}".format(format_size(size), legacy_rate, rate))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=str, default="1M,100M,1G", help="Frame sizes")
+    parser.add_argument("--legacy-max", type=str, default="16M", help="Largest size for the old loop")
+    parser.add_argument("--legacy-chunksize", type=int, default=64, help="recv size of the old loop")
+    args = parser.parse_args()
+    args.legacy_max = parse_sizes(args.legacy_max)[0]
+    main(args)
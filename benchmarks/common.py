@@ -0,0 +1,97 @@
+import io
+import os
+import time
+import logging
+import shutil
+import tempfile
+import threading
+import contextlib
+from typing import Callable, List
+
+import fileserve
+
+
+UNITS = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+
+
+def parse_size(size: str) -> int:
+    """ Parse a human readable size such as 1K, 100M or 1G to bytes """
+    size = size.strip().upper().rstrip("B")
+    unit = size[-1] if size and size[-1] in UNITS else ""
+    return int(float(size[:len(size) - len(unit)]) * UNITS[unit])
+
+
+def parse_sizes(sizes: str) -> List[int]:
+    """ Parse a comma separated list of sizes """
+    return [parse_size(size) for size in sizes.split(",") if size]
+
+
+def format_size(size: int) -> str:
+    """ Format bytes as a short human readable size """
+    for unit in ["G", "M", "K"]:
+        if size >= UNITS[unit] and size % UNITS[unit] == 0:
+            return "{}{}".format(size // UNITS[unit], unit)
+    return "{}B".format(size)
+
+
+def measure(fn: Callable, min_time: float = 0.5, max_iters: int = 1000) -> float:
+    """ Return the mean wall time in seconds of calling fn """
+    iters = 0
+    start = time.perf_counter()
+    elapsed = 0.0
+    while iters < max_iters and (iters == 0 or elapsed < min_time):
+        fn()
+        iters += 1
+        elapsed = time.perf_counter() - start
+    return elapsed / iters
+
+
+@contextlib.contextmanager
+def quiet():
+    """ Silence the output and logs of the client and server """
+    logging.disable(logging.CRITICAL)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            yield
+    finally:
+        logging.disable(logging.NOTSET)
+
+
+@contextlib.contextmanager
+def running_server(
+    ip: str = "localhost", port: int = 0, engine: str = "thread", admission=None
+):
+    """ Run a FileServer on localhost in a scratch directory
+
+    Database and Client keep their state relative to the working directory,
+    so the benchmark moves into a temporary one for the duration.
+    """
+    cwd = os.getcwd()
+    tmp_dir = tempfile.mkdtemp()
+    os.chdir(tmp_dir)
+
+    try:
+        with quiet():
+            if engine == "asyncio":
+                server = fileserve.AsyncFileServer(
+                    database=fileserve.Database(),
+                    server_address=(ip, port),
+                    admission=admission,
+                )
+            else:
+                server = fileserve.FileServer(
+                    database=fileserve.Database(),
+                    server_address=(ip, port),
+                    handler_class=fileserve.RequestHandler,
+                    admission=admission,
+                )
+        t = threading.Thread(target=server.serve_forever, daemon=True)
+        t.start()
+
+        yield server
+
+        server.shutdown()
+        server.server_close()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp_dir, ignore_errors=True)
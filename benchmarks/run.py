@@ -0,0 +1,369 @@
+"""
+Reproducible benchmark suite for the client/server stack, with results
+compared against a stored baseline to flag regressions.
+
+    python -m benchmarks.run --sizes 1K,64K,1M,8M --concurrency 1,4,16
+    python -m benchmarks.run --save-baseline
+
+A FileServer is started on localhost and driven by one Client per
+concurrent worker. For each concurrency level the workers register with
+add_user, then for each file size every worker uploads, downloads, shares
+and deletes --rounds files, one operation at a time with all workers
+starting together. The crypto, codec and compression primitives are also
+timed on their own for each size.
+
+Results are written as JSON to --output. If the --baseline file exists,
+every result whose median latency is more than --tolerance slower than in
+the baseline is reported as a regression and the exit status is 1. The
+baseline is only meaningful on the machine that recorded it, so a
+mismatch in the recorded machine is warned about.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import threading
+import statistics
+from typing import Callable, Dict, List, Tuple
+
+import fileserve
+from fileserve import codec, compression, crypto
+from benchmarks.common import format_size, parse_sizes, quiet, running_server
+
+
+OPERATIONS = ["upload_file", "download_file", "share_file", "delete_file"]
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+
+def machine() -> Dict:
+    """ What a baseline is only comparable on """
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def summarize(samples: List[float]) -> Dict:
+    """ Latency statistics in milliseconds """
+    samples = sorted(samples)
+    return {
+        "samples": len(samples),
+        "mean_ms": statistics.mean(samples) * 1e3,
+        "p50_ms": statistics.median(samples) * 1e3,
+        "p95_ms": samples[min(len(samples) - 1, int(len(samples) * 0.95))] * 1e3,
+    }
+
+
+def sample(fn: Callable, min_time: float, max_iters: int = 10000) -> List[float]:
+    """ Time individual calls of fn for at least min_time seconds """
+    samples = []
+    deadline = time.perf_counter() + min_time
+    while len(samples) < max_iters and (not samples or time.perf_counter() < deadline):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def primitives(sizes: List[int], min_time: float) -> List[Dict]:
+    """ Time each crypto, codec and compression primitive in isolation """
+    pub_key, priv_key = (crypto.import_key(key) for key in crypto.generate_keys())
+    key = os.urandom(crypto.AES_KEY_SIZE)
+    nonce = os.urandom(crypto.GCM_NONCE_SIZE)
+    results = []
+
+    def record(name: str, size: int, fn: Callable):
+        result = {"name": name, "size": size}
+        result.update(summarize(sample(fn, min_time)))
+        result["mb_per_s"] = size / result["mean_ms"] * 1e3 / 1e6
+        results.append(result)
+
+    # RSA only ever carries a single PKCS#1 v1.5 block
+    block = os.urandom(245)
+    ciphertext, mac = crypto.rsa_encrypt(block, pub_key, priv_key)
+    record("rsa_encrypt", len(block), lambda: crypto.rsa_encrypt(block, pub_key, priv_key))
+    record(
+        "rsa_decrypt", len(block), lambda: crypto.rsa_decrypt(ciphertext, mac, pub_key, priv_key)
+    )
+
+    for size in sizes:
+        data = os.urandom(size)
+        text = (b"2024-05-01T12:00:00Z INFO upload_file success\n" * (size // 46 + 1))[:size]
+
+        sealed, mac = crypto.hybrid_encrypt(data, pub_key, priv_key)
+        record("hybrid_encrypt", size, lambda: crypto.hybrid_encrypt(data, pub_key, priv_key))
+        record(
+            "hybrid_decrypt", size, lambda: crypto.hybrid_decrypt(sealed, mac, pub_key, priv_key)
+        )
+
+        sealed = crypto.aead_encrypt(key, nonce, data)
+        record("aead_encrypt", size, lambda: crypto.aead_encrypt(key, nonce, data))
+        record("aead_decrypt", size, lambda: crypto.aead_decrypt(key, nonce, sealed))
+
+        request = codec.Request(
+            header="upload_file",
+            sender="bench",
+            data=codec.RequestData(filename="bench.bin", user1="bench", data=data, key=key),
+        )
+        encoded = codec.encode(request)
+        record("codec_encode", size, lambda: codec.encode(request))
+        record("codec_decode", size, lambda: codec.decode(encoded, codec.Request))
+
+        for name in compression.CODECS[1:]:
+            used, payload = compression.compress(text, name)
+            record(name + "_compress", size, lambda: compression.compress(text, name))
+            record(
+                name + "_decompress", size, lambda: compression.decompress(payload, used, size)
+            )
+
+    return results
+
+
+def run_phase(clients: List[fileserve.Client], job: Callable) -> Tuple[float, List[float]]:
+    """ Run job(index, client) on every client at once
+
+    Returns the wall time of the phase and the latency of every call.
+    """
+    barrier = threading.Barrier(len(clients) + 1)
+    samples = [[] for _ in clients]
+    errors = []
+
+    def worker(i: int, client: fileserve.Client):
+        barrier.wait()
+        try:
+            samples[i].extend(job(i, client))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [
+        threading.Thread(target=worker, args=(i, client)) for i, client in enumerate(clients)
+    ]
+    for t in threads:
+        t.start()
+
+    barrier.wait()
+    start = time.perf_counter()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    if errors:
+        raise errors[0]
+    return elapsed, [latency for latencies in samples for latency in latencies]
+
+
+def timed_run(client: fileserve.Client, command: str, filename: str = "", user2: str = "") -> float:
+    """ Time one command, failing the benchmark if the server refused it """
+    start = time.perf_counter()
+    response = client.run(command, filename, user2)
+    elapsed = time.perf_counter() - start
+
+    if response["header"] != "success":
+        raise RuntimeError("{} {} failed: {}".format(command, filename, response["data"]["error"]))
+    return elapsed
+
+
+def operations(port: int, sizes: List[int], concurrency: int, rounds: int) -> List[Dict]:
+    """ Time each operation against the server with concurrency clients """
+    # Keys are generated here, outside of any timing
+    clients = [
+        fileserve.Client("bench{}_{}".format(concurrency, i), port=port)
+        for i in range(concurrency)
+    ]
+
+    # Files are shared with a user outside the timed set
+    reader = fileserve.Client("bench{}_reader".format(concurrency), port=port)
+    timed_run(reader, "add_user")
+    reader.close()
+    results = []
+
+    def record(name: str, size: int, elapsed: float, samples: List[float]):
+        result = {"name": name, "size": size, "concurrency": concurrency}
+        result.update(summarize(samples))
+        result["ops_per_s"] = len(samples) / elapsed
+        if name in ("upload_file", "download_file"):
+            result["mb_per_s"] = len(samples) * size / elapsed / 1e6
+        results.append(result)
+
+    elapsed, samples = run_phase(clients, lambda i, client: [timed_run(client, "add_user")])
+    record("add_user", 0, elapsed, samples)
+
+    for size in sizes:
+        # Filenames are global on the server so each client gets its own
+        names = [
+            ["{}_{}.bin".format(client.user, r) for r in range(rounds)] for client in clients
+        ]
+        for client, client_names in zip(clients, names):
+            for name in client_names:
+                fileserve.utils.save_file(client.FILE_DIR, name, os.urandom(size))
+
+        jobs = {
+            "upload_file": lambda i, client: [
+                timed_run(client, "upload_file", name) for name in names[i]
+            ],
+            "download_file": lambda i, client: [
+                timed_run(client, "download_file", name) for name in names[i]
+            ],
+            "share_file": lambda i, client: [
+                timed_run(client, "share_file", name, reader.user) for name in names[i]
+            ],
+            "delete_file": lambda i, client: [
+                timed_run(client, "delete_file", name) for name in names[i]
+            ],
+        }
+
+        for operation in OPERATIONS:
+            elapsed, samples = run_phase(clients, jobs[operation])
+            record(operation, size, elapsed, samples)
+
+        for client, client_names in zip(clients, names):
+            for name in client_names:
+                os.remove(os.path.join(client.FILE_DIR, name))
+
+    for client in clients:
+        client.close()
+
+    return results
+
+
+def key(result: Dict) -> str:
+    """ Name a result by what was measured, e.g. upload_file/1M/c4 """
+    parts = [result["name"]]
+    if result["size"] or "concurrency" not in result:
+        parts.append(format_size(result["size"]))
+    if "concurrency" in result:
+        parts.append("c{}".format(result["concurrency"]))
+    return "/".join(parts)
+
+
+def compare(results: Dict, baseline: Dict, tolerance: float, min_ms: float) -> List[str]:
+    """ Describe every result slower than the baseline by more than tolerance
+
+    Differences under min_ms are ignored as timer noise.
+    """
+    regressions = []
+    for name, result in results["results"].items():
+        base = baseline["results"].get(name)
+        if base is None:
+            continue
+
+        now, then = result["p50_ms"], base["p50_ms"]
+        if now > then * (1 + tolerance) and now - then > min_ms:
+            regressions.append("{:<32} p50 {:10.3f} ms vs {:10.3f} ms baseline ({:+.0%})".format(
+                name, now, then, now / then - 1
+            ))
+    return regressions
+
+
+def report(results: Dict):
+    print("{:<32} {:>10} {:>10} {:>10} {:>10} {:>10}".format(
+        "benchmark", "p50 ms", "p95 ms", "mean ms", "ops/s", "MB/s"
+    ))
+    for name, result in results["results"].items():
+        print("{:<32} {:>10.3f} {:>10.3f} {:>10.3f} {:>10} {:>10}".format(
+            name,
+            result["p50_ms"],
+            result["p95_ms"],
+            result["mean_ms"],
+            "{:.1f}".format(result["ops_per_s"]) if "ops_per_s" in result else "",
+            "{:.1f}".format(result["mb_per_s"]) if "mb_per_s" in result else "",
+        ))
+
+
+def main(args) -> int:
+    sizes = parse_sizes(args.sizes)
+    results = {
+        "machine": machine(),
+        "config": {
+            "sizes": args.sizes,
+            "concurrency": args.concurrency,
+            "rounds": args.rounds,
+            "engine": args.engine,
+        },
+        "results": {},
+    }
+    records = []
+
+    if not args.skip_primitives:
+        records += primitives(sizes, args.min_time)
+
+    if not args.skip_server:
+        with running_server(engine=args.engine) as server:
+            with quiet():
+                for concurrency in [int(c) for c in args.concurrency.split(",") if c]:
+                    records += operations(
+                        server.server_address[1], sizes, concurrency, args.rounds
+                    )
+
+    for record in records:
+        results["results"][key(record)] = record
+
+    report(results)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print("\nResults written to {}".format(args.output))
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print("Baseline saved to {}".format(args.baseline))
+        return 0
+
+    if not os.path.exists(args.baseline):
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+
+    if baseline["machine"] != results["machine"]:
+        print("\nwarning: the baseline was recorded on {}".format(baseline["machine"]))
+
+    regressions = compare(results, baseline, args.tolerance, args.min_ms)
+    if regressions:
+        print("\n{} regressions against {}:".format(len(regressions), args.baseline))
+        for regression in regressions:
+            print("  " + regression)
+        return 1
+
+    print("\nNo regressions against {}".format(args.baseline))
+    return 0
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=str, default="1K,64K,1M,8M", help="File and payload sizes")
+    parser.add_argument(
+        "--concurrency", type=str, default="1,4,16", help="Concurrent clients to run with"
+    )
+    parser.add_argument("--rounds", type=int, default=3, help="Files per client per size")
+    parser.add_argument(
+        "--engine", type=str, default="thread", choices=["thread", "asyncio"], help="Server engine"
+    )
+    parser.add_argument(
+        "--min-time", type=float, default=0.2, help="Minimum seconds per primitive"
+    )
+    parser.add_argument("--skip-primitives", action="store_true", help="Only run the server")
+    parser.add_argument("--skip-server", action="store_true", help="Only run the primitives")
+    parser.add_argument(
+        "--output", type=str, default="bench-results.json", help="Where to write results"
+    )
+    parser.add_argument(
+        "--baseline", type=str, default=DEFAULT_BASELINE, help="Results to compare against"
+    )
+    parser.add_argument(
+        "--save-baseline", action="store_true", help="Store these results as the baseline"
+    )
+    parser.add_argument(
+        "--tolerance", type=float, default=0.25, help="Slowdown allowed before flagging"
+    )
+    parser.add_argument(
+        "--min-ms", type=float, default=0.05, help="Smallest slowdown in ms worth flagging"
+    )
+    args = parser.parse_args()
+    sys.exit(main(args))
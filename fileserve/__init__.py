@@ -1,6 +1,23 @@
 from .client import Client
+from .batch import BatchClient
 from .server import FileServer, RequestHandler
+from .aio_server import AsyncFileServer
 from .database import Database
+from .keystore import KeyStore
+from .admission import AdmissionControl
 from . import crypto
 from . import utils
+from . import protocol
+from . import session
 from . import error_handling
+from . import operations
+from . import codec
+from . import delta
+from . import compression
+from . import acl
+from . import cache
+from . import logs
+from . import metrics
+from . import storage
+from . import batch
+from . import admission
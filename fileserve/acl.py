@@ -0,0 +1,97 @@
+import bisect
+import threading
+from typing import Dict, List, Set
+
+
+class AccessIndex(object):
+    """ Reverse index from each user to the files they own or were shared
+
+    The forward direction is each file's access set in the metadata, this
+    answers which files a user can read without scanning every file. The
+    index is kept in step with the metadata by Database.apply and rebuilt
+    from it on startup. Each user's readable files are also kept as a
+    sorted list, so a page of them is a slice rather than a sort.
+    """
+
+    def __init__(self):
+        # user -> filenames
+        self.owned = {}
+        self.shared = {}
+        # user -> sorted filenames they own or were shared
+        self.readable = {}
+        self._lock = threading.Lock()
+
+    def build(self, files: Dict[str, Dict]):
+        """ Rebuild the index from file metadata """
+        with self._lock:
+            self.owned.clear()
+            self.shared.clear()
+            self.readable.clear()
+            for filename, info in files.items():
+                self.owned.setdefault(info["owner"], set()).add(filename)
+                for user in info["access"]:
+                    if user != info["owner"]:
+                        self.shared.setdefault(user, set()).add(filename)
+
+            for user in self.owned.keys() | self.shared.keys():
+                self.readable[user] = sorted(
+                    self.owned.get(user, set()) | self.shared.get(user, set())
+                )
+
+    def add(self, user: str, filename: str, owner: bool = False):
+        with self._lock:
+            (self.owned if owner else self.shared).setdefault(user, set()).add(filename)
+
+            filenames = self.readable.setdefault(user, [])
+            i = bisect.bisect_left(filenames, filename)
+            if i == len(filenames) or filenames[i] != filename:
+                filenames.insert(i, filename)
+
+    def remove(self, user: str, filename: str):
+        """ Drop a user's share in a file """
+        with self._lock:
+            self._discard(self.shared, user, filename)
+            self._unlist(user, filename)
+
+    def remove_file(self, filename: str, info: Dict):
+        """ Drop a deleted file from the index of everyone who could read it """
+        with self._lock:
+            self._discard(self.owned, info["owner"], filename)
+            self._unlist(info["owner"], filename)
+            for user in info["access"]:
+                self._discard(self.shared, user, filename)
+                self._unlist(user, filename)
+
+    @staticmethod
+    def _discard(index: Dict[str, Set[str]], user: str, filename: str):
+        filenames = index.get(user)
+        if filenames is not None:
+            filenames.discard(filename)
+            if not filenames:
+                del index[user]
+
+    def _unlist(self, user: str, filename: str):
+        """ Drop a file from a user's sorted list once they can no longer read it """
+        if filename in self.owned.get(user, ()) or filename in self.shared.get(user, ()):
+            return
+
+        filenames = self.readable.get(user)
+        if filenames is None:
+            return
+        i = bisect.bisect_left(filenames, filename)
+        if i < len(filenames) and filenames[i] == filename:
+            del filenames[i]
+            if not filenames:
+                del self.readable[user]
+
+    def files_of(self, user: str, offset: int = 0, length: int = None) -> List[str]:
+        """ Sorted names of the files a user owns or can read, or length of them from offset """
+        with self._lock:
+            filenames = self.readable.get(user, [])
+            if length is None:
+                return filenames[offset:]
+            return filenames[offset:offset + length]
+
+    def count(self, user: str) -> int:
+        with self._lock:
+            return len(self.readable.get(user, ()))
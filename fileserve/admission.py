@@ -0,0 +1,205 @@
+import time
+import threading
+from typing import Dict, Tuple
+
+from fileserve import metrics
+
+
+# Header of responses to requests turned away, and the error of refused handshakes
+OVERLOADED = "overloaded"
+
+# Largest frame read from a refused connection to reply to it, bigger ones are dropped
+REFUSED_FRAME_SIZE = 64 * 1024
+
+# Seconds a refused connection is drained after the reply so the client reads it
+LINGER_TIMEOUT = 2.0
+
+
+class TokenBucket(object):
+    """ Allows rate requests per second on average with bursts of up to burst """
+
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = now
+
+    def take(self, now: float, amount: float = 1) -> bool:
+        """ Spend amount tokens if there are enough """
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+        if self.tokens < amount:
+            return False
+        self.tokens -= amount
+        return True
+
+
+class AdmissionControl(object):
+    """ Limits what the server takes on so overload is refused rather than queued
+
+    Connections are capped globally when accepted, and per user once the
+    user is authenticated, by a session or an encrypted request. Frames
+    reserve their size from the in-flight byte budgets as soon as their
+    header arrives, before the payload is buffered, and release it once
+    handled. Requests then spend a token from their operation's bucket,
+    before they are decrypted, and from their user's bucket once the
+    sender is authenticated. add_user names no authenticated user so it
+    is only limited per operation.
+
+    Each check returns why it refused or "" and the servers answer refused
+    requests with an OVERLOADED response, which is never encrypted so it
+    costs no RSA. A limit of 0 is no limit. read_timeout bounds how long a
+    frame may take to arrive once it starts and write_timeout how long a
+    frame may take to send, so slow clients can't hold on to the server.
+
+    Limits apply to one server, each worker process of a PreforkServer
+    enforces its own.
+    """
+
+    def __init__(
+        self,
+        max_connections: int = 0,
+        max_user_connections: int = 0,
+        max_inflight_bytes: int = 0,
+        max_user_inflight_bytes: int = 0,
+        user_rate: float = 0,
+        user_burst: float = 0,
+        operation_rates: Dict[str, Tuple[float, float]] = None,
+        read_timeout: float = None,
+        write_timeout: float = None,
+    ):
+        """ operation_rates maps request headers to their (rate, burst) """
+        self.max_connections = max_connections
+        self.max_user_connections = max_user_connections
+        self.max_inflight_bytes = max_inflight_bytes
+        self.max_user_inflight_bytes = max_user_inflight_bytes
+        self.user_rate = user_rate
+        self.user_burst = user_burst or user_rate
+        self.operation_rates = operation_rates or {}
+        self.read_timeout = read_timeout
+        self.write_timeout = write_timeout
+
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.user_connections = {}
+        self.inflight_bytes = 0
+        self.user_inflight_bytes = {}
+        self.user_buckets = {}
+        self.operation_buckets = {}
+
+    def connect(self, channel) -> str:
+        """ Count a new connection, refusing it over the global cap """
+        with self.lock:
+            if self.max_connections and self.connections >= self.max_connections:
+                return refuse("too many connections")
+            self.connections += 1
+        channel.read_timeout = self.read_timeout
+        channel.write_timeout = self.write_timeout
+        return ""
+
+    def disconnect(self, channel):
+        """ Stop counting a connection that connect admitted """
+        with self.lock:
+            self.connections -= 1
+            self.detach(channel)
+
+    def attach(self, channel, user: str) -> str:
+        """ Count a connection against the user it authenticated as """
+        if channel.user == user:
+            return ""
+
+        with self.lock:
+            count = self.user_connections.get(user, 0)
+            if self.max_user_connections and count >= self.max_user_connections:
+                return refuse("too many connections", user)
+
+            self.detach(channel)
+            self.user_connections[user] = count + 1
+            channel.user = user
+        return ""
+
+    def detach(self, channel):
+        """ Stop counting a connection against its user, holding the lock """
+        if channel.user is None:
+            return
+
+        count = self.user_connections.pop(channel.user) - 1
+        if count:
+            self.user_connections[channel.user] = count
+        channel.user = None
+
+    def reserve(self, channel, size: int) -> str:
+        """ Reserve in-flight bytes for a frame about to be received """
+        user = channel.user
+
+        with self.lock:
+            if self.max_inflight_bytes and self.inflight_bytes + size > self.max_inflight_bytes:
+                return refuse("too many bytes in flight")
+
+            used = self.user_inflight_bytes.get(user, 0) if user is not None else 0
+            if self.max_user_inflight_bytes and used + size > self.max_user_inflight_bytes:
+                return refuse("too many bytes in flight", user)
+
+            self.inflight_bytes += size
+            if user is not None:
+                self.user_inflight_bytes[user] = used + size
+
+        channel.reserved = (user, size)
+        return ""
+
+    def release(self, channel):
+        """ Return the bytes the channel's last frame reserved """
+        user, size = channel.reserved
+        channel.reserved = (None, 0)
+
+        with self.lock:
+            self.inflight_bytes -= size
+            if user is not None:
+                used = self.user_inflight_bytes.pop(user) - size
+                if used:
+                    self.user_inflight_bytes[user] = used
+
+    def admit_operation(self, header: str) -> str:
+        """ Spend a token for a request from its operation's bucket
+
+        Needs nothing but the header so it is checked before the request
+        is decrypted.
+        """
+        rate = self.operation_rates.get(header)
+        if rate is None:
+            return ""
+
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.operation_buckets.get(header)
+            if bucket is None:
+                bucket = self.operation_buckets[header] = TokenBucket(rate[0], rate[1], now)
+            if not bucket.take(now):
+                return refuse("{} rate exceeded".format(header))
+        return ""
+
+    def admit_user(self, channel, user: str) -> str:
+        """ Spend a token for a request from its authenticated user's bucket """
+        if self.user_rate:
+            now = time.monotonic()
+            with self.lock:
+                bucket = self.user_buckets.get(user)
+                if bucket is None:
+                    bucket = self.user_buckets[user] = TokenBucket(
+                        self.user_rate, self.user_burst, now
+                    )
+                if not bucket.take(now):
+                    return refuse("rate exceeded", user)
+
+        return self.attach(channel, user)
+
+
+def refuse(reason: str, user: str = None) -> str:
+    """ Count a refusal and return its reason """
+    metrics.count_rejected(reason)
+    if user is not None:
+        return "{} for {}".format(reason, user)
+    return reason
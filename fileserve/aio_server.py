@@ -0,0 +1,269 @@
+import os
+import socket
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Tuple
+
+from fileserve import metrics
+from fileserve import protocol
+from fileserve.server import RequestProcessor, format_address
+from fileserve.session import SessionManager
+from fileserve.admission import AdmissionControl, REFUSED_FRAME_SIZE, LINGER_TIMEOUT, refuse
+
+
+log = logging.getLogger(__name__)
+
+
+class BridgeChannel(protocol.Channel):
+    """ Channel used from executor threads that does its I/O on the event loop
+
+    Request processing is blocking code shared with the threaded engine, so
+    it runs on the executor and hands every frame read or write back to the
+    loop, which also gives streamed transfers the loop's flow control.
+
+    Frames are handled holding one of the server's work slots. A streamed
+    transfer waits on its client for as long as the client takes, so it
+    trades its work slot for one of the stream slots and slow clients only
+    ever hold stream slots. The stream slot is given back on the executor
+    before the transfer's last frame is sent, so a client that saw its
+    transfer finish can always start another.
+    """
+
+    def __init__(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        loop: asyncio.AbstractEventLoop,
+        max_frame_size: int = protocol.MAX_FRAME_SIZE,
+        work: asyncio.Semaphore = None,
+        streams: threading.BoundedSemaphore = None,
+    ):
+        self.reader = reader
+        self.writer = writer
+        self.loop = loop
+        self.max_frame_size = max_frame_size
+        self.session = None
+
+        self.work = work
+        self.streams = streams
+        self.slot = None
+        self.streaming = False
+
+        self.read_timeout = None
+        self.write_timeout = None
+        self.user = None
+        self.reserved = (None, 0)
+        self.skip_chunks = False
+
+    async def acquire(self):
+        """ Take a work slot before handing a frame to the executor """
+        await self.work.acquire()
+        self.slot = self.work
+
+    def release_slot(self):
+        """ Give back the work slot held while handling the last frame """
+        if self.slot is not None:
+            self.slot.release()
+            self.slot = None
+
+    def begin_stream(self) -> str:
+        # Called on the executor, the work slot is released on the loop
+        if not self.streams.acquire(blocking=False):
+            return refuse("too many streamed transfers")
+        self.slot = None
+        self.streaming = True
+        self.loop.call_soon_threadsafe(self.work.release)
+        return ""
+
+    def end_stream(self):
+        if self.streaming:
+            self.streaming = False
+            self.streams.release()
+
+    def send_frame(self, payload: bytes, msg_type: int, flags: int = 0):
+        coro = protocol.send_frame_async(self.writer, payload, msg_type, flags, self.write_timeout)
+        asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def recv_frame(self, max_size: int = None) -> Tuple[int, int, bytes]:
+        coro = protocol.recv_frame_async(
+            self.reader, max_size or self.max_frame_size, self.read_timeout
+        )
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+
+class AsyncFileServer(object):
+    """ asyncio engine serving the same Database as FileServer
+
+    Connections are handled on a single event loop so idle or slow clients
+    only cost a coroutine. RSA/AES and disk work is offloaded to a bounded
+    thread pool. Streamed transfers hold an executor thread for their
+    duration, so the pool has max_streams threads for them on top of the
+    max_workers threads for everything else and streamed transfers past
+    max_streams are refused as overloaded.
+    """
+
+    backlog = 1024
+    max_frame_size = protocol.MAX_FRAME_SIZE
+    idle_timeout = 60.0
+
+    def __init__(
+        self,
+        database,
+        server_address=("localhost", 60000),
+        max_workers: int = None,
+        sessions: SessionManager = None,
+        sock: socket.socket = None,
+        admission: AdmissionControl = None,
+        max_streams: int = None,
+    ):
+        self.database = database
+        self.admission = admission if admission is not None else AdmissionControl()
+        self.processor = RequestProcessor(database, sessions, self.admission)
+
+        if max_workers is None:
+            max_workers = min(32, (os.cpu_count() or 1) + 4)
+        if max_streams is None:
+            max_streams = max_workers
+        self.executor = ThreadPoolExecutor(max_workers=max_workers + max_streams)
+        self.streams = threading.BoundedSemaphore(max_streams)
+
+        # Bind straight away like socketserver.TCPServer does
+        self.loop = asyncio.new_event_loop()
+        if sock is not None:
+            # Serve a socket that is already listening, such as one shared by workers
+            server = asyncio.start_server(self.handle_connection, sock=sock, backlog=self.backlog)
+        else:
+            server = asyncio.start_server(
+                self.handle_connection,
+                host=server_address[0],
+                port=server_address[1],
+                backlog=self.backlog,
+                reuse_address=True,
+            )
+        self.server = self.loop.run_until_complete(server)
+        self.socket = self.server.sockets[0]
+        self.server_address = self.socket.getsockname()[:2]
+        self._stopped = threading.Event()
+
+        # Created on the loop it is used from, loop arguments are deprecated
+        async def create_work():
+            return asyncio.Semaphore(max_workers)
+        self.work = self.loop.run_until_complete(create_work())
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """ Receive requests on the loop and process them on the executor """
+        channel = BridgeChannel(
+            reader, writer, self.loop, self.max_frame_size, self.work, self.streams
+        )
+
+        reason = self.admission.connect(channel)
+        if reason:
+            await self.refuse(channel, reason)
+            return
+
+        try:
+            while True:
+                try:
+                    msg_type, flags, length = await asyncio.wait_for(
+                        protocol.recv_header_async(reader, self.max_frame_size),
+                        self.idle_timeout,
+                    )
+                except (protocol.ConnectionClosed, asyncio.TimeoutError):
+                    break
+
+                # Refuse the frame before buffering it when over budget
+                reason = self.admission.reserve(channel, length)
+                if reason:
+                    await protocol.skip_payload_async(reader, length, channel.read_timeout)
+                    await self.send_refusal(channel, msg_type, flags, reason)
+                    continue
+
+                try:
+                    data = await protocol.recv_payload_async(reader, length, channel.read_timeout)
+                    await channel.acquire()
+                    await self.loop.run_in_executor(
+                        self.executor, self.processor.handle_frame, channel, msg_type, flags, data
+                    )
+                finally:
+                    channel.release_slot()
+                    self.admission.release(channel)
+
+        except (protocol.ProtocolError, ConnectionError):
+            pass
+
+        except socket.timeout:
+            log.info(
+                "connection deadline passed",
+                extra={"client": format_address(writer.get_extra_info("peername"))},
+            )
+
+        except asyncio.CancelledError:
+            # server_close cancels open connections, finish quietly
+            pass
+
+        except Exception:
+            self.handle_error(writer.get_extra_info("peername"))
+
+        finally:
+            self.admission.disconnect(channel)
+            writer.close()
+
+    async def send_refusal(self, channel: BridgeChannel, msg_type: int, flags: int, reason: str):
+        """ Reply to a refused frame from the loop """
+        reply = self.processor.refusal(channel, msg_type, flags, reason)
+        if reply is not None:
+            await protocol.send_frame_async(
+                channel.writer, reply[1], reply[0], timeout=channel.write_timeout
+            )
+
+    async def refuse(self, channel: BridgeChannel, reason: str):
+        """ Reply to the first frame of a refused connection then close it """
+        try:
+            msg_type, flags, length = await asyncio.wait_for(
+                protocol.recv_header_async(channel.reader), LINGER_TIMEOUT
+            )
+            if length > REFUSED_FRAME_SIZE:
+                return
+            await protocol.skip_payload_async(channel.reader, length, LINGER_TIMEOUT)
+            channel.write_timeout = LINGER_TIMEOUT
+            await self.send_refusal(channel, msg_type, flags, reason)
+            await protocol.linger_async(channel.reader, channel.writer, LINGER_TIMEOUT)
+        except (protocol.ProtocolError, OSError, asyncio.TimeoutError):
+            pass
+        finally:
+            channel.writer.close()
+
+    def handle_error(self, client_address):
+        """ Log the traceback of a failed request like FileServer does """
+        metrics.count_exception()
+        log.exception("request failed", extra={"client": format_address(client_address)})
+
+    def serve_forever(self):
+        """ Run the event loop until shutdown is called """
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_forever()
+        finally:
+            self._stopped.set()
+
+    def shutdown(self, filename=None):
+        """ Save the database and stop serve_forever from another thread """
+        self.database.save(filename)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._stopped.wait()
+
+    async def _cancel_connections(self):
+        """ Cancel open connections so executor threads blocked on them wake up """
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def server_close(self):
+        """ Close the listening socket and release the executor """
+        self.server.close()
+        self.loop.run_until_complete(self._cancel_connections())
+        self.loop.close()
+        self.executor.shutdown(wait=False)
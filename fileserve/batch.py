@@ -0,0 +1,312 @@
+import os
+import time
+import queue
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from typing import Callable, Dict, Iterable, List, Tuple
+
+from fileserve import protocol
+from fileserve import streaming
+from fileserve.client import Client, part_name
+from fileserve.admission import OVERLOADED
+
+
+# Failures worth retrying on a fresh connection, the server refusing a
+# request is final unless it was overloaded
+RETRY_ERRORS = (OSError, protocol.ProtocolError)
+
+Task = Tuple[str, str, str]
+
+
+class TransferResult(object):
+    """ Outcome of one command of a batch """
+
+    def __init__(
+        self,
+        command: str,
+        filename: str,
+        ok: bool = False,
+        error: str = "",
+        size: int = 0,
+        elapsed: float = 0.0,
+        attempts: int = 0,
+    ):
+        self.command = command
+        self.filename = filename
+        self.ok = ok
+        self.error = error
+        self.size = size
+        self.elapsed = elapsed
+        self.attempts = attempts
+
+    def __repr__(self) -> str:
+        status = "ok" if self.ok else "failed: {}".format(self.error)
+        return "{} {} {}".format(self.command, self.filename, status)
+
+
+def attempt(
+    client: Client, call: Callable[[Client], Dict], retries: int, backoff: float
+) -> Tuple[Dict, int, str]:
+    """ Call call(client), reconnecting and retrying if the connection fails
+
+    Returns the response, or None and the last error, and the attempts made.
+    Interrupted uploads and downloads resume where they stopped. Requests
+    the server refused as overloaded are retried after the same backoff.
+    """
+    attempts = 0
+
+    while True:
+        attempts += 1
+        try:
+            response = call(client)
+            if response["header"] != OVERLOADED or attempts > retries:
+                return response, attempts, ""
+        except RETRY_ERRORS as e:
+            client.close()
+            if attempts > retries:
+                return None, attempts, str(e) or type(e).__name__
+        time.sleep(backoff * 2 ** (attempts - 1))
+
+
+def run_task(client: Client, task: Task, retries: int, backoff: float) -> TransferResult:
+    """ Run one command, reconnecting and retrying if the connection fails """
+    command, filename, user2 = task
+    result = TransferResult(command, filename)
+    start = time.perf_counter()
+
+    response, result.attempts, result.error = attempt(
+        client, lambda client: client.run(command, filename, user2), retries, backoff
+    )
+    result.elapsed = time.perf_counter() - start
+    if response is None:
+        return result
+
+    result.ok = response["header"] == "success"
+    result.error = response["data"]["error"]
+
+    if result.ok and command in ("upload_file", "update_file"):
+        result.size = os.path.getsize(os.path.join(client.FILE_DIR, filename))
+    elif result.ok and command == "download_file":
+        result.size = response["data"]["total"] or len(response["data"]["data"])
+
+    return result
+
+
+# Client of a worker process, set up once by init_worker
+worker_client = None
+
+
+def init_worker(user: str, ip: str, port: int, file_dir: str, client_args: dict):
+    global worker_client
+    worker_client = Client(user, ip, port, file_dir=file_dir, **client_args)
+
+
+def run_worker_task(task: Task, retries: int, backoff: float) -> TransferResult:
+    return run_task(worker_client, task, retries, backoff)
+
+
+def summary(results: List[TransferResult], elapsed: float) -> str:
+    """ One line report of a finished batch """
+    ok = [result for result in results if result.ok]
+    size = sum(result.size for result in ok)
+    retried = sum(1 for result in results if result.attempts > 1)
+    return "{} ok, {} failed, {} retried, {:.1f} MB in {:.2f}s ({:.1f} MB/s, {:.1f} files/s)".format(
+        len(ok),
+        len(results) - len(ok),
+        retried,
+        size / 1e6,
+        elapsed,
+        size / elapsed / 1e6 if elapsed else 0.0,
+        len(results) / elapsed if elapsed else 0.0,
+    )
+
+
+class BatchClient(object):
+    """ Runs many commands concurrently over a bounded pool of connections
+
+    By default a thread pool shares `connections` clients, each with its
+    own connection and session. With processes > 0 every command runs in
+    one of that many worker processes instead, each with a connection of
+    its own, so encryption, hashing and framing scale across cores.
+    """
+
+    def __init__(
+        self,
+        user: str,
+        ip: str = "localhost",
+        port: int = 60000,
+        connections: int = 4,
+        processes: int = 0,
+        retries: int = 2,
+        backoff: float = 0.1,
+        file_dir: str = None,
+        **client_args
+    ):
+        self.user = user
+        self.ip = ip
+        self.port = port
+        self.connections = connections
+        self.processes = processes
+        self.retries = retries
+        self.backoff = backoff
+        self.file_dir = file_dir
+        self.client_args = client_args
+
+        # Generate keys once up front rather than racing in every worker
+        self.client = self.new_client()
+
+    def new_client(self) -> Client:
+        return Client(self.user, self.ip, self.port, file_dir=self.file_dir, **self.client_args)
+
+    def run_many(
+        self,
+        tasks: Iterable[Task],
+        progress: Callable[[TransferResult, int, int], None] = None,
+    ) -> List[TransferResult]:
+        """ Run (command, filename, user2) tasks and return their results in order """
+        tasks = list(tasks)
+        results = [None] * len(tasks)
+
+        if self.processes > 0:
+            executor = ProcessPoolExecutor(
+                max_workers=self.processes,
+                initializer=init_worker,
+                initargs=(self.user, self.ip, self.port, self.file_dir, self.client_args),
+            )
+            submit = lambda task: executor.submit(run_worker_task, task, self.retries, self.backoff)
+            clients = None
+        else:
+            executor = ThreadPoolExecutor(max_workers=self.connections)
+            clients = self.client_pool(self.connections)
+            submit = lambda task: executor.submit(self.run_pooled, clients, task)
+
+        with executor:
+            futures = {submit(task): i for i, task in enumerate(tasks)}
+            for done, future in enumerate(as_completed(futures), 1):
+                result = future.result()
+                results[futures[future]] = result
+                if progress is not None:
+                    progress(result, done, len(tasks))
+
+        self.close_pool(clients)
+        return results
+
+    def client_pool(self, size: int) -> queue.Queue:
+        """ Pool of size clients, all but the first connected when first borrowed """
+        clients = queue.Queue()
+        clients.put(self.client)
+        for _ in range(size - 1):
+            clients.put(None)
+        return clients
+
+    def close_pool(self, clients: queue.Queue):
+        """ Hang up the pooled connections """
+        while clients is not None and not clients.empty():
+            client = clients.get()
+            if client is not None:
+                client.close()
+        self.client.close()
+
+    def run_pooled(self, clients: queue.Queue, task: Task) -> TransferResult:
+        """ Run a task on a client borrowed from the pool """
+        return self.with_pooled(
+            clients, lambda client: run_task(client, task, self.retries, self.backoff)
+        )
+
+    def with_pooled(self, clients: queue.Queue, call: Callable[[Client], object]):
+        """ Call call(client) with a client borrowed from the pool """
+        client = clients.get()
+        try:
+            if client is None:
+                client = self.new_client()
+            return call(client)
+        finally:
+            clients.put(client)
+
+    def upload_dir(self, **kwargs) -> List[TransferResult]:
+        """ Upload every file at the top level of the client's file directory """
+        names = sorted(
+            entry.name for entry in os.scandir(self.client.FILE_DIR)
+            if entry.is_file()
+            and not entry.name.endswith("_private.pem")
+            and not entry.name.startswith(".")
+        )
+        return self.run_many([("upload_file", name, "") for name in names], **kwargs)
+
+    def download_many(self, filenames: Iterable[str], **kwargs) -> List[TransferResult]:
+        """ Download the named files """
+        return self.run_many([("download_file", name, "") for name in filenames], **kwargs)
+
+    def download_ranges(self, filename: str, streams: int = None) -> TransferResult:
+        """ Download one file as parallel range streams over pooled connections
+
+        The first range reports the file's size and digest, the rest of the
+        file is then split between streams connections which write their
+        ranges straight into the part file. Every range is pinned to the
+        digest so a file changed mid download fails rather than mixing
+        versions, and the result is verified before it is moved into place.
+        """
+        streams = streams or self.connections
+        result = TransferResult("download_file", filename)
+        start = time.perf_counter()
+
+        part = os.path.join(self.client.FILE_DIR, part_name(filename))
+        if os.path.exists(part):
+            os.remove(part)
+
+        first, result.attempts, result.error = attempt(
+            self.client,
+            lambda client: client.download_range(filename, 0, streaming.CHUNK_SIZE),
+            self.retries,
+            self.backoff,
+        )
+        if first is None or first["header"] != "success":
+            result.error = result.error or first["data"]["error"]
+            result.elapsed = time.perf_counter() - start
+            self.client.close()
+            return result
+
+        # Split the rest into equal ranges in whole chunks
+        total, digest = first["data"]["total"], first["data"]["digest"]
+        remaining = total - first["data"]["size"]
+        step = -(-remaining // streams)
+        step = max(-(-step // streaming.CHUNK_SIZE) * streaming.CHUNK_SIZE, streaming.CHUNK_SIZE)
+        ranges = [
+            (offset, min(step, total - offset))
+            for offset in range(first["data"]["size"], total, step)
+        ]
+
+        def fetch(client, offset, length):
+            return attempt(
+                client,
+                lambda client: client.download_range(filename, offset, length, digest),
+                self.retries,
+                self.backoff,
+            )
+
+        clients = self.client_pool(max(len(ranges), 1))
+        with ThreadPoolExecutor(max_workers=max(len(ranges), 1)) as executor:
+            futures = [
+                executor.submit(self.with_pooled, clients, lambda client, r=r: fetch(client, *r))
+                for r in ranges
+            ]
+            responses = [future.result() for future in futures]
+        self.close_pool(clients)
+
+        result.elapsed = time.perf_counter() - start
+        result.attempts += sum(attempts for _, attempts, _ in responses) - len(responses)
+
+        for response, _, error in responses:
+            if response is None or response["header"] != "success":
+                result.error = error or response["data"]["error"]
+                return result
+
+        try:
+            self.client.finish_download(filename, digest)
+        except ValueError as e:
+            result.error = str(e)
+            return result
+
+        result.elapsed = time.perf_counter() - start
+        result.ok = True
+        result.size = total
+        return result
@@ -0,0 +1,85 @@
+import threading
+from collections import OrderedDict
+from typing import Dict
+
+
+class FileCache(object):
+    """ LRU cache of whole file contents bounded by total bytes
+
+    Files larger than max_file_size are never cached, so one large
+    download cannot flush every small hot file out of the cache. Entries
+    are invalidated by the database whenever a file's metadata changes,
+    and can be tagged with the file's digest so a get for another version
+    misses, for changes made by other processes.
+    """
+
+    def __init__(self, max_bytes: int = 64 << 20, max_file_size: int = None):
+        self.max_bytes = max_bytes
+        self.max_file_size = max_file_size if max_file_size is not None else max_bytes // 8
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # filename -> (tag, contents)
+        self._files = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, filename: str, tag: str = None) -> bytes:
+        """ Return the cached contents of a file, if cached with this tag, or None """
+        with self._lock:
+            entry = self._files.get(filename)
+            if entry is None or entry[0] != tag:
+                self.misses += 1
+                return None
+
+            self._files.move_to_end(filename)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, filename: str, data: bytes, tag: str = None):
+        """ Cache a file's contents, evicting the least recently used files """
+        if len(data) > self.max_file_size or len(data) > self.max_bytes:
+            return
+
+        with self._lock:
+            old = self._files.pop(filename, None)
+            if old is not None:
+                self.size -= len(old[1])
+
+            self._files[filename] = (tag, data)
+            self.size += len(data)
+
+            while self.size > self.max_bytes:
+                _, (_, evicted) = self._files.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def invalidate(self, filename: str):
+        """ Drop a file so the next get misses """
+        with self._lock:
+            entry = self._files.pop(filename, None)
+            if entry is not None:
+                self.size -= len(entry[1])
+
+    def clear(self):
+        """ Drop all cached files """
+        with self._lock:
+            self._files.clear()
+            self.size = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "files": len(self._files),
+                "bytes": self.size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def __contains__(self, filename: str) -> bool:
+        return filename in self._files
+
+    def __len__(self) -> int:
+        return len(self._files)
@@ -1,54 +1,90 @@
 import os
-import time
-import copy
+import json
+import uuid
 import socket
-import pickle
-from typing import Tuple, Dict
+import logging
+import hashlib
+from typing import Tuple, Dict, List
 
+from fileserve import logs
 from fileserve import utils
+from fileserve import codec
+from fileserve import delta
 from fileserve import crypto
-from fileserve.server import request_template
+from fileserve import protocol
+from fileserve import session
+from fileserve import streaming
+from fileserve import compression
+from fileserve.keystore import KeyStore, default_keystore
+from fileserve.server import new_request, new_response
+from fileserve.admission import OVERLOADED
+
+
+log = logging.getLogger(__name__)
+
+
+def part_name(filename: str) -> str:
+    """ Hidden name a download is received under until it is complete """
+    return ".{}.part".format(filename)
 
 
 class Client(object):
 
-    def __init__(self, user, ip="localhost", port=60000):
+    max_frame_size = protocol.MAX_FRAME_SIZE
+
+    def __init__(
+        self,
+        user,
+        ip="localhost",
+        port=60000,
+        keystore: KeyStore = None,
+        stream: bool = True,
+        keepalive: bool = True,
+        session: bool = True,
+        file_dir: str = None,
+        compression: str = "",
+    ):
         self.user = user
         self.ip = ip
         self.port = port
+        self.stream = stream
+        self.keepalive = keepalive
+        self.use_session = session
+        self.compression = compression
+        self.channel = None
+        self.last_session = None
+        self.uploads = {}
+        self.downloads = {}
         self.KEY_DIR = "pki"
-        self.FILE_DIR = user
+        self.USER_DIR = user
+        self.FILE_DIR = file_dir if file_dir is not None else user
+        self.keystore = keystore if keystore is not None else default_keystore
 
         # Make user's file directory
+        os.makedirs(self.USER_DIR, exist_ok=True)
         os.makedirs(self.FILE_DIR, exist_ok=True)
         os.makedirs(self.KEY_DIR, exist_ok=True)
 
         # Load keys or generate if none
         self.pub_key, self.priv_key, self.server_pub_key = self.load_keys()
 
-        print("\nHello {}".format(self.user.capitalize()))
+        log.debug("client ready", extra={"user": self.user})
 
-    def load_keys(self) -> Tuple[str, str, str]:
+    def load_keys(self) -> Tuple[crypto.RSA.RsaKey, crypto.RSA.RsaKey, crypto.RSA.RsaKey]:
         """ Load public/priv/and server pub keys """
 
         pub_key_path = os.path.join(self.KEY_DIR, "{}_public.pem".format(self.user))
-        priv_key_path = os.path.join(self.FILE_DIR, "{}_private.pem".format(self.user))
+        priv_key_path = os.path.join(self.USER_DIR, "{}_private.pem".format(self.user))
         server_key_path = os.path.join(self.KEY_DIR, "server_public.pem")
 
         if not os.path.exists(pub_key_path) or not os.path.exists(priv_key_path):
-            print("User does not have public/private keys so generating them...")
+            log.info("user has no keys, generating them", extra={"user": self.user})
             self.generate_keys()
 
         # Load public and private keys
-        """ Load keys from pem files """
-        with open(pub_key_path, "r") as f:
-            pub_key = f.read()
-
-        with open(priv_key_path, "r") as f:
-            priv_key = f.read()
-            
-        with open(server_key_path, "r") as f:
-            server_pub_key = f.read()
+        pub_key = self.keystore.get(pub_key_path)
+        priv_key = self.keystore.get(priv_key_path)
+        server_pub_key = self.keystore.get(server_key_path)
 
         return pub_key, priv_key, server_pub_key
 
@@ -59,76 +95,335 @@ class Client(object):
         with open(os.path.join(self.KEY_DIR, self.user + "_public.pem"), "wb") as f:
             f.write(pub_key)
 
-        with open(os.path.join(self.FILE_DIR, self.user + "_private.pem"), "wb") as f:
+        with open(os.path.join(self.USER_DIR, self.user + "_private.pem"), "wb") as f:
             f.write(priv_key)
 
-    def run(self, command: str, filename: str, user2: str):
+    def run(self, command: str, filename: str, user2: str) -> Dict:
         """ Main function """
 
-        # Generate request
-        request = self.generate_request(command, filename, user2)
+        if command == "update_file":
+            # Fetch the signature of the server's copy to send only what changed
+            response = self.exchange(self.generate_request("file_signature", filename, user2))
+            if response["header"] == "success":
+                response = self.exchange(self.generate_update(filename, response))
+        elif command == "upload_file" and self.stream:
+            response = self.upload(filename)
+        elif command == "download_file" and self.stream:
+            response = self.download(filename)
+        else:
+            response = self.exchange(self.generate_request(command, filename, user2))
+
+        # Do a thing given the response
+        self.process_response(response)
+
+        return response
+
+    def exchange(self, request: Dict) -> Dict:
+        """ Send a request along with any streamed file and return the response """
+        command = request["header"]
+        filename = request["data"]["filename"]
 
         FLAG = True
         if command == "add_user":
             FLAG = False
 
-        # Encrypt and serialize request
-        request = self.format_request(request, encrypt=FLAG)
+        # Streams are keyed by the request so capture it before encrypting
+        stream = request["data"]["stream"]
+        key = request["data"]["key"]
+        offset = request["data"]["offset"]
+        whole = request["data"]["length"] == 0
+        compress_with = request["data"]["compression"]
 
         # Communicate with server
-        response = self.communicate(request)
+        try:
+            channel = self.connect()
+        except session.HandshakeError as e:
+            # Report a server refusing sessions while overloaded like a refused request
+            if str(e) != OVERLOADED:
+                raise
+            response = new_response(OVERLOADED)
+            response["data"]["error"] = "server refused the connection"
+            return response
+
+        try:
+            if channel.session is not None:
+                # Seal the whole request with the session key
+                request = channel.session.seal(utils.serialize(request))
+                channel.send_frame(request, protocol.MSG_REQUEST, protocol.FLAG_SESSION)
+            else:
+                # Encrypt and serialize request
+                request = self.format_request(request, encrypt=FLAG)
+                self.send(channel, request)
+
+            if stream and command == "upload_file":
+                streaming.send_chunks(
+                    channel,
+                    key,
+                    utils.read_chunks(self.FILE_DIR, filename, streaming.CHUNK_SIZE, offset),
+                    offset,
+                    compress_with,
+                )
 
-        # Deserialize and decrypt response
-        response = self.parse_response(response, decrypt=FLAG)
+            # Deserialize and decrypt response
+            msg_type, flags, response = channel.recv_frame()
+            if msg_type != protocol.MSG_RESPONSE:
+                raise protocol.ProtocolError(
+                    "expected a response but received message type {}".format(msg_type)
+                )
 
-        # Do a thing given the response
-        self.process_response(response)
+            if flags & protocol.FLAG_SESSION:
+                response = utils.deserialize(channel.session.open(response), codec.Response)
+            else:
+                response = self.parse_response(response, decrypt=FLAG)
+
+            if response["header"] == "success" and response["data"]["stream"]:
+                self.recv_file(channel, key, response["data"], whole)
+        except BaseException:
+            # The connection is in an unknown state mid exchange
+            self.close()
+            raise
+
+        if not self.keepalive:
+            self.close()
+
+        return response
 
     def generate_request(self, command: str, filename: str, user2: str) -> Dict:
         """ Use user input to generate request """
-        request = copy.deepcopy(request_template)
+        request = new_request()
         request["header"] = command
         request["sender"] = self.user
         request["data"]["user1"] = self.user
 
-        if command in ["upload_file", "download_file", "delete_file", "share_file"]:
+        if command in [
+            "upload_file", "download_file", "update_file", "delete_file", "share_file",
+            "revoke_access", "file_signature", "upload_status",
+        ]:
             request["data"]["filename"] = filename
 
-        if command == "share_file":
+        if command in ["upload_file", "download_file"]:
+            request["data"]["compression"] = self.compression
+
+        if command in ["share_file", "revoke_access"]:
             request["data"]["user2"] = user2
 
+        elif command in ["upload_file", "download_file"] and self.stream:
+            request["data"]["stream"] = True
+            request["data"]["key"] = streaming.new_key()
+
+            if command == "upload_file":
+                request["data"]["size"] = os.path.getsize(
+                    os.path.join(self.FILE_DIR, filename)
+                )
+                request["data"]["upload_id"] = uuid.uuid4().hex
+
         elif command == "upload_file":
-            request["data"]["data"] = utils.read_file(
-                self.FILE_DIR,
-                request["data"]["filename"]
+            request["data"]["compression"], request["data"]["data"] = compression.compress(
+                utils.read_file(self.FILE_DIR, request["data"]["filename"]),
+                self.compression,
             )
 
         return request
 
-    def communicate(self, request: bytes) -> bytes:
-        """ Communicate with server and receive a response """
+    def upload(self, filename: str) -> Dict:
+        """ Stream a file to the server, resuming the last attempt if it was cut off
+
+        The server keeps what it received of an interrupted upload, so
+        retrying an unchanged file only sends the rest of it.
+        """
+        request = self.generate_request("upload_file", filename, "")
+        stat = os.stat(os.path.join(self.FILE_DIR, filename))
+        version = (stat.st_size, stat.st_mtime_ns)
+
+        pending = self.uploads.get(filename)
+        if pending is not None and pending["version"] == version:
+            status = self.generate_request("upload_status", filename, "")
+            status["data"]["upload_id"] = pending["upload_id"]
+            status = self.exchange(status)
+
+            if status["header"] == "success":
+                request["data"]["upload_id"] = pending["upload_id"]
+                request["data"]["offset"] = status["data"]["offset"]
+                request["data"]["digest"] = pending["digest"]
+
+        if request["data"]["offset"] == 0:
+            request["data"]["digest"] = utils.file_digest(self.FILE_DIR, filename)
+            self.uploads[filename] = {
+                "version": version,
+                "upload_id": request["data"]["upload_id"],
+                "digest": request["data"]["digest"],
+            }
+
+        # Keep the upload to resume until it is stored
+        response = self.exchange(request)
+        if response["header"] == "success":
+            self.uploads.pop(filename, None)
+        return response
+
+    def download(self, filename: str) -> Dict:
+        """ Stream a file from the server, resuming the last attempt if it was cut off
+
+        The file is received into a hidden part file which is only renamed
+        into place once it is complete and matches the server's digest.
+        """
+        request = self.generate_request("download_file", filename, "")
+        part = os.path.join(self.FILE_DIR, part_name(filename))
 
-        # Connect to the server
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.connect((self.ip, self.port))
+        digest = self.downloads.get(filename)
+        if digest is not None and os.path.exists(part):
+            # Only continue from the same version of the file
+            request["data"]["offset"] = os.path.getsize(part)
+            request["data"]["digest"] = digest
 
-        # Send request
-        self.sendlen(s, request)
-        self.send(s, request)
+        response = self.exchange(request)
 
-        # Receive response
-        response = self.recvall(s)
-        s.close()
+        if response["header"] != "success" and digest is not None:
+            # The file changed since the last attempt so start again
+            self.downloads.pop(filename, None)
+            if os.path.exists(part):
+                os.remove(part)
+            response = self.exchange(self.generate_request("download_file", filename, ""))
 
         return response
 
+    def download_range(self, filename: str, offset: int, length: int, digest: bytes = b"") -> Dict:
+        """ Download length bytes of a file from offset into its part file
+
+        Passing the digest from an earlier range fails the request if the
+        file has changed since. The part file is not completed, see
+        finish_download.
+        """
+        request = self.generate_request("download_file", filename, "")
+        request["data"]["stream"] = True
+        request["data"]["key"] = streaming.new_key()
+        request["data"]["offset"] = offset
+        request["data"]["length"] = length
+        request["data"]["digest"] = digest
+        return self.exchange(request)
+
+    def finish_download(self, filename: str, digest: bytes):
+        """ Check a fully received part file against its digest and move it into place """
+        part = part_name(filename)
+        self.downloads.pop(filename, None)
+
+        if digest and utils.file_digest(self.FILE_DIR, part) != digest:
+            os.remove(os.path.join(self.FILE_DIR, part))
+            raise ValueError("downloaded file {} does not match its digest".format(filename))
+
+        os.replace(os.path.join(self.FILE_DIR, part), os.path.join(self.FILE_DIR, filename))
+
+    def list_files(self) -> List[Tuple[str, str]]:
+        """ Page through the (filename, owner) of every file the user can read """
+        files = []
+        while True:
+            request = self.generate_request("list_files", "", "")
+            request["data"]["offset"] = len(files)
+            response = self.exchange(request)
+            if response["header"] != "success":
+                raise ValueError(response["data"]["error"])
+
+            page = json.loads(response["data"]["data"])
+            files.extend((filename, owner) for filename, owner in page)
+            if not page or len(files) >= response["data"]["size"]:
+                return files
+
+    def generate_update(self, filename: str, signature: Dict) -> Dict:
+        """ Generate an update request carrying the delta against a signature """
+        data = utils.read_file(self.FILE_DIR, filename)
+
+        request = self.generate_request("update_file", filename, "")
+        request["data"]["data"] = delta.diff(data, signature["data"]["data"])
+        request["data"]["version"] = signature["data"]["version"]
+        request["data"]["digest"] = hashlib.sha256(data).digest()
+        return request
+
+    def connect(self) -> protocol.Channel:
+        """ Return the open connection to the server or open a new one """
+        if self.channel is not None and self.channel.is_stale():
+            self.close()
+
+        if self.channel is None:
+            s = socket.create_connection((self.ip, self.port))
+            s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            channel = protocol.Channel(s, self.max_frame_size)
+
+            try:
+                if self.use_session:
+                    self.handshake(channel)
+            except BaseException:
+                channel.close()
+                raise
+
+            self.channel = channel
+
+        return self.channel
+
+    def handshake(self, channel: protocol.Channel):
+        """ Establish a session, resuming the last one if its ticket is valid """
+        attempts = [self.last_session, None] if self.last_session is not None else [None]
+
+        for resume in attempts:
+            hello, state = session.client_hello(
+                self.user, self.priv_key, self.server_pub_key, resume
+            )
+            channel.send_frame(hello, protocol.MSG_HELLO)
+            welcome = channel.expect_frame(protocol.MSG_WELCOME)
+
+            try:
+                channel.session = session.client_finish(state, welcome)
+            except session.HandshakeError as e:
+                # Fall back to a full handshake if the ticket was refused
+                if resume is None or str(e) == OVERLOADED:
+                    raise
+                continue
+
+            self.last_session = channel.session
+            return
+
+    def close(self):
+        """ Close the connection to the server """
+        if self.channel is not None:
+            self.channel.close()
+            self.channel = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def recv_file(self, channel: protocol.Channel, key: bytes, data: Dict, whole: bool = True):
+        """ Receive a streamed file, or a range of it, straight to its part file
+
+        Whole file downloads are completed once the last byte arrives and
+        can otherwise be resumed from what was written.
+        """
+        filename = data["filename"]
+        part = part_name(filename)
+
+        if whole and data["digest"]:
+            self.downloads[filename] = data["digest"]
+        if whole:
+            # Drop anything past the offset left by an earlier attempt
+            with open(os.path.join(self.FILE_DIR, part), "ab") as f:
+                f.truncate(data["offset"])
+
+        received = utils.write_chunks(
+            self.FILE_DIR, part, streaming.recv_chunks(channel, key, data["offset"]), data["offset"]
+        )
+        if received != data["size"]:
+            raise ValueError("received {} of the announced {} bytes".format(received, data["size"]))
+
+        if whole:
+            self.finish_download(filename, data["digest"])
+
     def encrypt_request(self, request: Dict) -> Dict:
         """ Encrypt the request data excluding the header """
         # Serialize the data dict
         data = utils.serialize(request["data"])
 
         # Encrypt and sign + MAC for integrity
-        ciphertext, mac = crypto.rsa_encrypt(data, self.server_pub_key, self.priv_key)
+        ciphertext, mac = crypto.hybrid_encrypt(data, self.server_pub_key, self.priv_key)
         request["data"] = ciphertext
         request["mac"] = mac
 
@@ -137,7 +432,7 @@ class Client(object):
     def decrypt_response(self, response: Dict) -> Dict:
         """ Decrypt the response data excluding the header """
         # Decrypt the data dict and verify MAC and signature
-        plaintext = crypto.rsa_decrypt(
+        plaintext = crypto.hybrid_decrypt(
             ciphertext=response["data"],
             mac=response["mac"],
             pub_key=self.server_pub_key,
@@ -145,7 +440,7 @@ class Client(object):
         )
         
         # Deserialize data dict
-        response["data"] = utils.deserialize(plaintext)
+        response["data"] = utils.deserialize(plaintext, codec.ResponseData)
 
         return response
 
@@ -161,57 +456,33 @@ class Client(object):
     def parse_response(self, response: bytes, decrypt: bool = True) -> Dict:
         """ Parse response """
 
-        response = utils.deserialize(response)
+        response = utils.deserialize(response, codec.Response)
 
-        if decrypt:
+        # Servers refuse requests without encrypting the reply
+        if decrypt and response["header"] != OVERLOADED:
             response = self.decrypt_response(response)
 
         return response
 
     def process_response(self, response: Dict):
         """ Perform postprocessing given the response """
-        print(response)
-
         if response["header"] == "success":
-            print("Success!")
-            # If file then download it
-            if response["data"]["filename"] != "":
+            if log.isEnabledFor(logging.INFO):
+                log.info("request succeeded", extra=logs.summarize(response))
+            # If file then download it, streamed files are already saved
+            if response["data"]["filename"] != "" and not response["data"]["stream"]:
                 utils.save_file(
                     self.FILE_DIR,
                     response["data"]["filename"],
-                    response["data"]["data"]
+                    compression.decompress(
+                        response["data"]["data"],
+                        response["data"]["compression"],
+                        self.max_frame_size,
+                    ),
                 )
         else:
-            print("Request failed due to {}".format(response["data"]["error"]))
+            log.warning("request failed due to %s", response["data"]["error"])
 
-    def send(self, s: socket.socket, request: bytes):
+    def send(self, channel: protocol.Channel, request: bytes):
         """ Format request as binary and send to server """
-        _ = s.sendall(request)
-
-    def sendlen(self, s: socket.socket, request: bytes):
-        """ Send length of data first """
-        length = str(len(request)).encode()
-        _ = s.send(length)
-        time.sleep(0.1)
-
-    def recvlen(self, s: socket.socket) -> int:
-        """ Receive length of data to be received """
-        length = s.recv(32)
-        length = int(length.decode())
-        return length
-
-    def recvall(self, s: socket.socket, chunksize: int = 8192) -> bytes:
-        """ Receive entirety of data """
-        length = self.recvlen(s)
-
-        data = b""
-
-        while len(data) < length:
-            received = s.recv(chunksize)
-
-            if not received:
-                break
-            else:
-                data += received
-
-        return data
+        channel.send_frame(request, protocol.MSG_REQUEST)
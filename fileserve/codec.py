@@ -0,0 +1,327 @@
+import struct
+from typing import Dict, List, Tuple, Union
+
+
+# Field types
+STR = 0
+BYTES = 1
+BOOL = 2
+UINT = 3
+FLOAT = 4
+SEALED = 5  # nested message, or its ciphertext once encrypted
+
+U8 = struct.Struct("!B")
+U32 = struct.Struct("!I")
+U64 = struct.Struct("!Q")
+F64 = struct.Struct("!d")
+
+DEFAULTS = {STR: "", BYTES: b"", BOOL: False, UINT: 0, FLOAT: 0.0, SEALED: b""}
+
+# type id -> message class
+registry = {}
+
+
+class CodecError(ValueError):
+    """ Raised when a message cannot be encoded or decoded """
+
+
+def message(type_id: int):
+    """ Register a message class under the type id that prefixes its encoding """
+    def register(cls):
+        if type_id in registry:
+            raise ValueError("message type {} is already registered".format(type_id))
+
+        # Rebuild the class with slots, they cannot be added after creation
+        namespace = {
+            key: value for key, value in vars(cls).items()
+            if key not in ("__dict__", "__weakref__")
+        }
+        namespace["__slots__"] = tuple(name for name, _ in cls.fields)
+        namespace["defaults"] = tuple((name, DEFAULTS[kind]) for name, kind in cls.fields)
+        namespace["type_id"] = type_id
+        cls = type(cls)(cls.__name__, cls.__bases__, namespace)
+
+        registry[type_id] = cls
+        return cls
+    return register
+
+
+class Message(object):
+    """ Base of the fixed schema messages
+
+    Subclasses list their (name, type) fields and are registered with the
+    message decorator. SEALED fields hold either bytes or a message of the
+    sealed class, which cannot nest messages itself. Fields can also be
+    accessed like dict keys so the messages are drop in replacements for
+    the dicts they were.
+    """
+
+    __slots__ = ()
+    fields = ()
+    sealed = None
+    defaults = ()
+    type_id = 0
+
+    def __init__(self, **kwargs):
+        for name, default in self.defaults:
+            setattr(self, name, kwargs.pop(name, default))
+
+        if kwargs:
+            raise TypeError("unknown fields {}".format(", ".join(kwargs)))
+
+    def __getitem__(self, name: str):
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            raise KeyError(name)
+
+    def __setitem__(self, name: str, value):
+        if name not in self.__slots__:
+            raise KeyError(name)
+        setattr(self, name, value)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.__slots__
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, dict):
+            return self.to_dict() == other
+        return type(self) is type(other) and self.to_dict() == other.to_dict()
+
+    def __repr__(self) -> str:
+        return "{}({})".format(
+            type(self).__name__,
+            ", ".join("{}={!r}".format(name, getattr(self, name)) for name in self.__slots__),
+        )
+
+    def keys(self) -> Tuple[str, ...]:
+        return self.__slots__
+
+    def to_dict(self) -> Dict:
+        """ Convert to a plain dict, recursing into nested messages """
+        return {
+            name: value.to_dict() if isinstance(value, Message) else value
+            for name, value in ((name, getattr(self, name)) for name in self.__slots__)
+        }
+
+
+def encode(msg: Message) -> bytes:
+    """ Encode a message as its type id followed by its fields in order """
+    parts = []
+    _encode(msg, parts)
+    return b"".join(parts)
+
+
+def _encode(msg: Message, parts: List[bytes]):
+    if not isinstance(msg, Message):
+        raise CodecError("cannot encode {}".format(type(msg).__name__))
+
+    parts.append(U8.pack(msg.type_id))
+
+    for name, kind in msg.fields:
+        value = getattr(msg, name)
+        try:
+            if kind == STR:
+                value = value.encode("utf-8")
+                parts.append(U32.pack(len(value)))
+                parts.append(value)
+
+            elif kind == BYTES:
+                value = memoryview(value)
+                parts.append(U32.pack(value.nbytes))
+                parts.append(value)
+
+            elif kind == BOOL:
+                parts.append(U8.pack(bool(value)))
+
+            elif kind == UINT:
+                parts.append(U64.pack(value))
+
+            elif kind == FLOAT:
+                parts.append(F64.pack(value))
+
+            elif isinstance(value, Message):
+                if type(value) is not msg.sealed:
+                    raise CodecError("{}.{} cannot hold {}".format(
+                        type(msg).__name__, name, type(value).__name__
+                    ))
+                parts.append(U8.pack(1))
+                _encode(value, parts)
+
+            else:
+                value = memoryview(value)
+                parts.append(U8.pack(0))
+                parts.append(U32.pack(value.nbytes))
+                parts.append(value)
+
+        except (AttributeError, TypeError, struct.error) as e:
+            raise CodecError("bad value for {}.{}: {}".format(type(msg).__name__, name, e))
+
+
+def decode(data: Union[bytes, bytearray, memoryview], cls: type = None) -> Message:
+    """ Decode a message produced by encode, rejecting anything malformed
+
+    If cls is given the message must be of that type.
+    """
+    view = memoryview(data)
+    msg, offset = _decode(view, 0)
+
+    if offset != len(view):
+        raise CodecError("{} trailing bytes".format(len(view) - offset))
+
+    if cls is not None and type(msg) is not cls:
+        raise CodecError(
+            "expected {} but received {}".format(cls.__name__, type(msg).__name__)
+        )
+
+    return msg
+
+
+def _decode(view: memoryview, offset: int, sealed: type = None) -> Tuple[Message, int]:
+    """ Decode the message at offset, a message of type sealed if it is nested """
+    limit = len(view)
+    if offset >= limit:
+        raise CodecError("message truncated at byte {}".format(offset))
+
+    cls = registry.get(view[offset])
+    if cls is None:
+        raise CodecError("unknown message type {}".format(view[offset]))
+
+    # Nested messages are one level deep and of the declared class only
+    if sealed is not None and cls is not sealed:
+        raise CodecError("expected nested {} but received {}".format(
+            sealed.__name__, cls.__name__
+        ))
+
+    msg = cls.__new__(cls)
+    offset += 1
+
+    for name, kind in cls.fields:
+        if kind == SEALED:
+            if offset >= limit:
+                raise CodecError("message truncated at byte {}".format(offset))
+            offset += 1
+            if view[offset - 1]:
+                if sealed is not None or cls.sealed is None:
+                    raise CodecError("{}.{} cannot hold a message".format(cls.__name__, name))
+                value, offset = _decode(view, offset, cls.sealed)
+                setattr(msg, name, value)
+                continue
+            kind = BYTES
+
+        if kind == STR or kind == BYTES:
+            end = offset + 4
+            if end <= limit:
+                end += U32.unpack_from(view, offset)[0]
+        elif kind == BOOL:
+            end = offset + 1
+        else:
+            end = offset + 8
+
+        if end > limit:
+            raise CodecError("message truncated at byte {}".format(offset))
+
+        if kind == BYTES:
+            value = view[offset + 4:end].tobytes()
+        elif kind == STR:
+            try:
+                value = str(view[offset + 4:end], "utf-8")
+            except UnicodeDecodeError as e:
+                raise CodecError("bad string for {}.{}: {}".format(cls.__name__, name, e))
+        elif kind == BOOL:
+            value = view[offset] != 0
+        elif kind == UINT:
+            value = U64.unpack_from(view, offset)[0]
+        else:
+            value = F64.unpack_from(view, offset)[0]
+
+        setattr(msg, name, value)
+        offset = end
+
+    return msg, offset
+
+
+@message(2)
+class RequestData(Message):
+    fields = (
+        ("filename", STR),
+        ("user1", STR),
+        ("user2", STR),
+        ("data", BYTES),
+        ("stream", BOOL),
+        ("key", BYTES),
+        ("size", UINT),
+        ("version", UINT),
+        ("digest", BYTES),
+        ("offset", UINT),
+        ("length", UINT),
+        ("upload_id", STR),
+        ("compression", STR),
+    )
+
+
+@message(1)
+class Request(Message):
+    fields = (
+        ("header", STR),
+        ("sender", STR),
+        ("mac", BYTES),
+        ("data", SEALED),
+    )
+    sealed = RequestData
+
+
+@message(4)
+class ResponseData(Message):
+    fields = (
+        ("filename", STR),
+        ("data", BYTES),
+        ("error", STR),
+        ("stream", BOOL),
+        ("size", UINT),
+        ("version", UINT),
+        ("offset", UINT),
+        ("total", UINT),
+        ("digest", BYTES),
+        ("compression", STR),
+    )
+
+
+@message(3)
+class Response(Message):
+    fields = (
+        ("header", STR),
+        ("mac", BYTES),
+        ("data", SEALED),
+    )
+    sealed = ResponseData
+
+
+@message(5)
+class Hello(Message):
+    fields = (
+        ("user", STR),
+        ("nonce", BYTES),
+        ("secret", BYTES),
+        ("signature", BYTES),
+        ("ticket", BYTES),
+    )
+
+
+@message(6)
+class Welcome(Message):
+    fields = (
+        ("nonce", BYTES),
+        ("ticket", BYTES),
+        ("expires", FLOAT),
+        ("error", STR),
+    )
+
+
+@message(7)
+class Ticket(Message):
+    fields = (
+        ("user", STR),
+        ("secret", BYTES),
+        ("expires", FLOAT),
+    )
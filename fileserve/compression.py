@@ -0,0 +1,85 @@
+import lzma
+import zlib
+import math
+from collections import Counter
+from typing import Tuple
+
+
+# Codecs by the name used in requests, "" sends data as is
+CODECS = ("", "zlib", "lzma")
+
+# Fast settings, the stage has to keep up with the network
+ZLIB_LEVEL = 1
+LZMA_PRESET = 0
+
+# Data estimated above this many bits of entropy per byte is sent as is
+MAX_ENTROPY = 7.5
+
+# Bytes sampled from each of the start, middle and end to estimate entropy
+SAMPLE_SIZE = 4096
+
+
+def entropy(data: bytes) -> float:
+    """ Estimate the Shannon entropy of data in bits per byte from samples """
+    if len(data) > 3 * SAMPLE_SIZE:
+        middle = len(data) // 2
+        data = b"".join([
+            data[:SAMPLE_SIZE],
+            data[middle:middle + SAMPLE_SIZE],
+            data[-SAMPLE_SIZE:],
+        ])
+
+    if not data:
+        return 0.0
+
+    n = len(data)
+    return -sum(count / n * math.log2(count / n) for count in Counter(data).values())
+
+
+def compressible(data: bytes) -> bool:
+    """ Whether data is worth compressing, compressed or encrypted data is not """
+    return entropy(data) < MAX_ENTROPY
+
+
+def compress(data: bytes, codec: str) -> Tuple[str, bytes]:
+    """ Compress data with codec unless it would not shrink
+
+    Returns the codec actually used, which is "" when the data is sent as
+    it is, and the payload.
+    """
+    if codec == "" or not compressible(data):
+        return "", data
+
+    if codec == "zlib":
+        payload = zlib.compress(data, ZLIB_LEVEL)
+    elif codec == "lzma":
+        payload = lzma.compress(data, preset=LZMA_PRESET)
+    else:
+        raise ValueError("unknown compression {!r}".format(codec))
+
+    if len(payload) >= len(data):
+        return "", data
+    return codec, payload
+
+
+def decompress(payload: bytes, codec: str, max_size: int) -> bytes:
+    """ Decompress a payload, refusing to expand it past max_size bytes """
+    if codec == "":
+        return payload
+
+    if codec == "zlib":
+        decompressor = zlib.decompressobj()
+        data = decompressor.decompress(payload, max_size + 1)
+        complete = decompressor.eof and not decompressor.unconsumed_tail
+    elif codec == "lzma":
+        decompressor = lzma.LZMADecompressor()
+        data = decompressor.decompress(payload, max_size + 1)
+        complete = decompressor.eof
+    else:
+        raise ValueError("unknown compression {!r}".format(codec))
+
+    if len(data) > max_size:
+        raise ValueError("payload expands past {} bytes".format(max_size))
+    if not complete:
+        raise ValueError("{} payload is truncated".format(codec))
+    return data
@@ -1,6 +1,7 @@
 import os
 import json
-from typing import Tuple
+import logging
+from typing import Tuple, Union
 from base64 import b64decode, b64encode
 
 from Crypto import Random
@@ -10,7 +11,19 @@ from Crypto.Cipher import PKCS1_v1_5, PKCS1_OAEP
 from Crypto.Signature import pkcs1_15
 from Crypto.Cipher import AES
 from Crypto.Util.Padding import pad, unpad
+from Crypto.Random import get_random_bytes
 
+from fileserve import metrics
+
+
+log = logging.getLogger(__name__)
+
+AES_KEY_SIZE = 32
+GCM_NONCE_SIZE = 12
+GCM_TAG_SIZE = 16
+
+# Keys may be passed as PEM text or as an already parsed RsaKey
+Key = Union[str, bytes, RSA.RsaKey]
 
 
 def generate_keys(bits: int = 2048, e: int = 65535) -> Tuple[bytes, bytes]:
@@ -18,6 +31,12 @@ def generate_keys(bits: int = 2048, e: int = 65535) -> Tuple[bytes, bytes]:
     key = RSA.generate(bits=bits, e=e)
     return key.publickey().export_key(), key.export_key()
 
+def import_key(key: Key) -> RSA.RsaKey:
+    """ Parse a PEM key unless it is already an RsaKey """
+    if isinstance(key, RSA.RsaKey):
+        return key
+    return RSA.import_key(key)
+
 def export_keys(key_dir: str, user: str, pub_key: bytes, priv_key: bytes):
     """ Export keys to files for user """
     with open(os.path.join(key_dir, user + "_private.pem"), "wb") as f:
@@ -27,15 +46,16 @@ def export_keys(key_dir: str, user: str, pub_key: bytes, priv_key: bytes):
         f.write(pub_key)
 
 
-def rsa_encrypt(data: bytes, pub_key: str, priv_key: str) -> Tuple[str, str]:
+@metrics.instrument("rsa_encrypt")
+def rsa_encrypt(data: bytes, pub_key: Key, priv_key: Key) -> Tuple[str, str]:
     """ Encrypt via RSA """
     # Ciphertext
-    key = RSA.import_key(pub_key)
+    key = import_key(pub_key)
     cipher = PKCS1_v1_5.new(key)
     ciphertext = cipher.encrypt(data)
 
     # MAC
-    key = RSA.import_key(priv_key)
+    key = import_key(priv_key)
     cipher = pkcs1_15.new(key)
     h = SHA256.new(data)
     mac = cipher.sign(h)
@@ -47,7 +67,8 @@ def rsa_encrypt(data: bytes, pub_key: str, priv_key: str) -> Tuple[str, str]:
     return ciphertext, mac
 
 
-def rsa_decrypt(ciphertext: bytes, mac: bytes, pub_key: str, priv_key: str) -> bytes:
+@metrics.instrument("rsa_decrypt")
+def rsa_decrypt(ciphertext: bytes, mac: bytes, pub_key: Key, priv_key: Key) -> bytes:
     """ Decrypt via RSA """
     # Decode from base64
     ciphertext = b64decode(ciphertext)
@@ -56,18 +77,97 @@ def rsa_decrypt(ciphertext: bytes, mac: bytes, pub_key: str, priv_key: str) -> b
     # Plaintext
     # sentinel = Random.new().read(15+SHA256.digest_size)
     sentinel = None
-    key = RSA.import_key(priv_key)
+    key = import_key(priv_key)
     cipher = PKCS1_v1_5.new(key)
     plaintext = cipher.decrypt(ciphertext, sentinel)
 
     # Verify
-    key = RSA.import_key(pub_key)
+    key = import_key(pub_key)
     cipher = pkcs1_15.new(key)
     h = SHA256.new(plaintext)
     try:
         cipher.verify(h, mac)
-        print("Signature verified!")
-    except:
-        print("Signature is not valid!")
+    except ValueError:
+        log.warning("signature is not valid")
 
     return plaintext
+
+
+@metrics.instrument("hybrid_encrypt")
+def hybrid_encrypt(data: bytes, pub_key: Key, priv_key: Key) -> Tuple[bytes, bytes]:
+    """ Encrypt via a per-message AES-GCM key wrapped with RSA-OAEP
+
+    The returned ciphertext is laid out as
+    wrapped_key || nonce || tag || aes_ciphertext and the mac is an RSA
+    signature over everything before the aes_ciphertext. The GCM tag already
+    authenticates the bulk bytes so only the small header is signed.
+    """
+    # Wrap a fresh session key for the recipient
+    session_key = get_random_bytes(AES_KEY_SIZE)
+    key = import_key(pub_key)
+    wrapped_key = PKCS1_OAEP.new(key, hashAlgo=SHA256).encrypt(session_key)
+
+    # Ciphertext
+    nonce = get_random_bytes(GCM_NONCE_SIZE)
+    cipher = AES.new(session_key, AES.MODE_GCM, nonce=nonce, mac_len=GCM_TAG_SIZE)
+    ciphertext, tag = cipher.encrypt_and_digest(data)
+    header = wrapped_key + nonce + tag
+
+    # MAC
+    key = import_key(priv_key)
+    mac = pkcs1_15.new(key).sign(SHA256.new(header))
+
+    return header + ciphertext, mac
+
+
+@metrics.instrument("hybrid_decrypt")
+def hybrid_decrypt(ciphertext: bytes, mac: bytes, pub_key: Key, priv_key: Key) -> bytes:
+    """ Decrypt a message produced by hybrid_encrypt """
+    key = import_key(priv_key)
+    ciphertext = memoryview(ciphertext)
+
+    # Split the envelope header from the bulk ciphertext
+    wrapped_size = key.size_in_bytes()
+    header_size = wrapped_size + GCM_NONCE_SIZE + GCM_TAG_SIZE
+    if len(ciphertext) < header_size:
+        raise ValueError("Ciphertext is too short")
+
+    header = ciphertext[:header_size]
+    wrapped_key = bytes(ciphertext[:wrapped_size])
+    nonce = ciphertext[wrapped_size:wrapped_size + GCM_NONCE_SIZE]
+    tag = ciphertext[wrapped_size + GCM_NONCE_SIZE:header_size]
+
+    # Verify
+    signer = pkcs1_15.new(import_key(pub_key))
+    try:
+        signer.verify(SHA256.new(header), mac)
+    except ValueError:
+        raise ValueError("Signature is not valid")
+
+    # Plaintext
+    session_key = PKCS1_OAEP.new(key, hashAlgo=SHA256).decrypt(wrapped_key)
+    cipher = AES.new(session_key, AES.MODE_GCM, nonce=nonce, mac_len=GCM_TAG_SIZE)
+    plaintext = cipher.decrypt_and_verify(ciphertext[header_size:], tag)
+
+    return plaintext
+
+
+@metrics.instrument("aead_encrypt")
+def aead_encrypt(key: bytes, nonce: bytes, data: bytes, aad: bytes = b"") -> bytes:
+    """ Encrypt with AES-GCM under a shared key, returns ciphertext || tag """
+    cipher = AES.new(key, AES.MODE_GCM, nonce=nonce, mac_len=GCM_TAG_SIZE)
+    cipher.update(aad)
+    ciphertext, tag = cipher.encrypt_and_digest(data)
+    return ciphertext + tag
+
+
+@metrics.instrument("aead_decrypt")
+def aead_decrypt(key: bytes, nonce: bytes, data: bytes, aad: bytes = b"") -> bytes:
+    """ Decrypt and verify a message produced by aead_encrypt """
+    if len(data) < GCM_TAG_SIZE:
+        raise ValueError("Ciphertext is too short")
+
+    data = memoryview(data)
+    cipher = AES.new(key, AES.MODE_GCM, nonce=nonce, mac_len=GCM_TAG_SIZE)
+    cipher.update(aad)
+    return cipher.decrypt_and_verify(data[:-GCM_TAG_SIZE], data[-GCM_TAG_SIZE:])
@@ -1,78 +1,316 @@
 import os
-import copy
 import json
-import pickle
-from typing import Tuple, Dict
+import time
+import fcntl
+import logging
+import hashlib
+from typing import Tuple, Dict, Iterable, Iterator
 
 from fileserve import utils
+from fileserve import delta
+from fileserve import codec
 from fileserve import crypto
-from fileserve.server import response_template
-from fileserve.error_handling import error_check_request
+from fileserve import streaming
+from fileserve.cache import FileCache
+from fileserve.storage import backends
+from fileserve.metadata import ReservationTable, backends as metadata_backends
+from fileserve.locking import StripedLock, ProcessStripedLock
+from fileserve.keystore import KeyStore, default_keystore
+from fileserve.server import new_response
+from fileserve.operations import registry as operations
+from fileserve.error_handling import SUCCESS, FAILURE, valid_upload_id
 
 
-files_template = {
-    "owner": "",
-    "access": []
-}
+log = logging.getLogger(__name__)
+
+# Seconds an interrupted upload can be resumed for before it is discarded
+UPLOAD_TTL = 24 * 60 * 60
+
+# Most files listed by one list_files request
+LIST_PAGE_SIZE = 1000
+
+
+class UploadMismatch(ValueError):
+    """ Raised when a streamed upload does not match the size or digest announced """
 
-user_template = {
-    "info": ""
-}
 
 class Database(object):
 
-    def __init__(self):
+    def __init__(
+        self,
+        keystore: KeyStore = None,
+        sync_every: int = 1,
+        sync_interval: float = None,
+        compact_every: int = 10000,
+        storage: str = "flat",
+        cache_bytes: int = 64 << 20,
+        metadata: str = "json",
+        shared: bool = False,
+    ):
+        if shared and (metadata != "sqlite" or storage != "flat"):
+            raise ValueError("a database shared by processes needs sqlite metadata and flat storage")
+
         self.DB_DIR = "db"
-        self.FILE_DIR = os.path.join(self.DB_DIR, "files")
+        self.FILE_DIR = os.path.join(self.DB_DIR, "files" if storage == "flat" else storage)
+        self.UPLOAD_DIR = os.path.join(self.DB_DIR, "uploads")
         self.KEY_DIR = "pki"
-        self.db_file = "db.json"
         self.user = "server"
+        self.keystore = keystore if keystore is not None else default_keystore
+        self.fsync = bool(sync_every)
+        self.shared = shared
+        self.uploads = {}
+        self.storage = backends[storage](self.FILE_DIR, fsync=self.fsync)
+        self.cache = FileCache(cache_bytes)
 
-        self.files, self.users = self.load()
-        self.pub_key, self.priv_key = self.load_keys()
-        print("Files: \n", self.files)
-        print("Users: \n", self.users)
-
-    def load(self) -> Tuple[Dict, Dict]:
-        """ Load the database from file """
-        os.makedirs(self.FILE_DIR, exist_ok=True)
         os.makedirs(self.KEY_DIR, exist_ok=True)
         os.makedirs(self.DB_DIR, exist_ok=True)
+        if shared:
+            self.locks = ProcessStripedLock(os.path.join(self.DB_DIR, "locks"))
+        else:
+            self.locks = StripedLock()
+
+        self.metadata = metadata_backends[metadata](
+            self.DB_DIR,
+            self.locks,
+            sync_every=sync_every,
+            sync_interval=sync_interval,
+            compact_every=compact_every,
+        )
+        self.files, self.users = self.metadata.files, self.metadata.users
 
-        if os.path.exists(os.path.join(self.DB_DIR, self.db_file)):
-            with open(os.path.join(self.DB_DIR, self.db_file), "r") as f:
-                db = json.load(f)
+        # filename -> upload ID of uploads whose data is still in flight
+        self.uploading = ReservationTable(self.metadata) if shared else {}
 
-            return db["files"], db["users"]
+        # Internals of the journaled backend, None with other backends
+        self.journal = getattr(self.metadata, "journal", None)
+        self.acl = getattr(self.metadata, "acl", None)
+        self.db_file = getattr(self.metadata, "db_file", None)
 
-        else:
-            return {}, {}
+        if metadata == "sqlite" and os.path.exists(os.path.join(self.DB_DIR, "db.json")):
+            if not self.users:
+                log.warning("db.json has not been imported, see migrate_db.py")
+
+        self.recover_uploads()
+        self.pub_key, self.priv_key = self.load_keys()
+        log.info(
+            "database loaded",
+            extra={"files": len(self.files), "users": len(self.users), "uploads": len(self.uploads)},
+        )
 
     def save(self, filename=None):
-        """ Save database to file """
-        if filename is None:
-            filename = os.path.join(self.DB_DIR, self.db_file)
+        """ Snapshot the metadata to filename, or into the database directory """
+        self.metadata.save(filename)
+
+    def close(self):
+        """ Make the metadata durable and release it """
+        self.metadata.close()
+        if self.shared:
+            self.locks.close()
+
+    def locked(self, request: Dict):
+        """ Lock the metadata a request checks and mutates
+
+        Requests hold this from error checking until their mutation is
+        applied, so the check cannot go stale, while requests for other
+        files proceed in parallel. Users are only ever added, so checks
+        against other users need no lock.
+        """
+        op = operations.get(request["header"])
+        if op is not None and op.lock == "user":
+            return self.locks(("user", request["data"]["user1"]))
+        return self.locks(("file", request["data"]["filename"]))
+
+    def reserve(self, filename: str, upload_id: str = ""):
+        """ Claim a filename for an upload whose data is still in flight """
+        with self.locks(("file", filename)):
+            self.uploading[filename] = upload_id
+
+    def release(self, filename: str):
+        """ Drop the claim made by reserve """
+        with self.locks(("file", filename)):
+            self.uploading.pop(filename, None)
+
+    def recover_uploads(self):
+        """ Reload uploads interrupted by a restart, discarding expired ones
+
+        A shared database may be recovered while other processes serve
+        it, so only uploads nobody is receiving are discarded, and the rest
+        are left on disk to be loaded when resumed.
+        """
+        os.makedirs(self.UPLOAD_DIR, exist_ok=True)
+        names = os.listdir(self.UPLOAD_DIR)
+
+        for name in names:
+            upload_id, ext = os.path.splitext(name)
+            if ext != ".json":
+                if ext != ".part" or upload_id + ".json" not in names:
+                    if not self.shared:
+                        os.remove(os.path.join(self.UPLOAD_DIR, name))
+                continue
+
+            upload = self.load_upload(upload_id)
+            if upload is None or upload["active"]:
+                continue
+
+            # Uploads stored just before the crash are already in the metadata
+            if (
+                time.time() - upload["created"] > UPLOAD_TTL
+                or upload["filename"] in self.files
+                or (upload["offset"] is None and not self.shared)
+            ):
+                self.discard_upload(upload_id)
+                continue
+
+            self.uploading[upload["filename"]] = upload_id
+            if self.shared:
+                continue
+
+            # Rehash what was received so the upload can be verified when complete
+            upload["hash"], upload["offset"] = self.hash_part(upload_id)
+            self.uploads[upload_id] = upload
+
+    def load_upload(self, upload_id: str) -> Dict:
+        """ Read the record of a resumable upload from disk, or None
+
+        Its offset is the size of what was received, None if nothing was,
+        and its hash is left to hash_part.
+        """
+        # IDs come from requests that aren't checked yet, only hex may name a file
+        if not upload_id or not valid_upload_id(upload_id):
+            return None
+
+        try:
+            with open(os.path.join(self.UPLOAD_DIR, upload_id + ".json"), "r") as f:
+                upload = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+        try:
+            upload["offset"] = os.path.getsize(os.path.join(self.UPLOAD_DIR, upload_id + ".part"))
+        except FileNotFoundError:
+            upload["offset"] = None
+        upload["hash"] = None
+        upload["active"] = self.receiving(upload_id)
+        return upload
+
+    def hash_part(self, upload_id: str):
+        """ Hash and size of what was received of an upload """
+        h = hashlib.sha256()
+        size = 0
+        for chunk in utils.read_chunks(self.UPLOAD_DIR, upload_id + ".part", streaming.CHUNK_SIZE):
+            h.update(chunk)
+            size += len(chunk)
+        return h, size
+
+    def receiving(self, upload_id: str) -> bool:
+        """ Whether any process is receiving an upload, it holds a flock on the part file """
+        try:
+            fd = os.open(os.path.join(self.UPLOAD_DIR, upload_id + ".part"), os.O_RDONLY)
+        except FileNotFoundError:
+            return False
+
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+        finally:
+            os.close(fd)
+        return False
+
+    def find_upload(self, upload_id: str) -> Dict:
+        """ A resumable upload by ID or None
+
+        Processes sharing the database only keep the uploads they are
+        receiving in memory, others are read from disk as they may have
+        moved on in another process.
+        """
+        upload = self.uploads.get(upload_id)
+        if upload is None and self.shared:
+            upload = self.load_upload(upload_id)
+            if upload is not None and upload["offset"] is None:
+                upload["offset"] = 0
+        return upload
+
+    def begin_upload(self, request: Dict):
+        """ Claim a filename for a resumable upload, recording it if it is new """
+        upload_id = request["data"]["upload_id"]
+        upload = self.find_upload(upload_id)
+
+        if upload is None:
+            upload = {
+                "user": request["data"]["user1"],
+                "filename": request["data"]["filename"],
+                "size": request["data"]["size"],
+                "created": time.time(),
+            }
+            utils.save_file(
+                self.UPLOAD_DIR, upload_id + ".json", json.dumps(upload).encode(), fsync=self.fsync
+            )
+            upload["hash"] = hashlib.sha256()
+            upload["offset"] = 0
+            self.reserve(upload["filename"], upload_id)
+
+        self.uploads[upload_id] = upload
+        upload["active"] = True
+
+        # Other processes see the upload as active while the part file is locked
+        if self.shared:
+            upload["part"] = open(os.path.join(self.UPLOAD_DIR, upload_id + ".part"), "ab")
+            fcntl.flock(upload["part"], fcntl.LOCK_EX)
+
+    def expired(self, upload_id: str) -> bool:
+        upload = self.find_upload(upload_id)
+        return (
+            upload is not None
+            and not upload["active"]
+            and time.time() - upload["created"] > UPLOAD_TTL
+        )
+
+    def discard_upload(self, upload_id: str):
+        """ Forget an upload, deleting what was received and releasing its filename """
+        upload = self.uploads.pop(upload_id, None)
+        if upload is None and self.shared:
+            upload = self.load_upload(upload_id)
+        if upload is not None:
+            self.release(upload["filename"])
+
+        for ext in (".part", ".json"):
+            try:
+                os.remove(os.path.join(self.UPLOAD_DIR, upload_id + ext))
+            except FileNotFoundError:
+                pass
+
+    def log(self, op: str, **fields):
+        """ Apply a metadata mutation and journal it """
+        fields["op"] = op
+
+        if "filename" in fields:
+            lock = self.locks(("file", fields["filename"]))
+        else:
+            lock = self.locks(("user", fields["user"]))
 
-        with open(filename, "w") as f:
-            json.dump({"files": self.files, "users": self.users}, f, indent=1)
+        with lock:
+            # Every mutation of a file's contents goes through here
+            if op in ("upload_file", "update_file", "delete_file"):
+                self.cache.invalidate(fields["filename"])
+            lsn = self.metadata.record(fields)
 
-    def load_keys(self) -> Tuple[str, str]:
+        # Wait for durability outside the lock so commits can be grouped
+        self.metadata.commit(lsn)
+
+    def load_keys(self) -> Tuple[crypto.RSA.RsaKey, crypto.RSA.RsaKey]:
         """ Load pub/priv keys """
 
         pub_key_path = os.path.join(self.KEY_DIR, "{}_public.pem".format(self.user))
         priv_key_path = os.path.join(self.DB_DIR, "{}_private.pem".format(self.user))
 
         if not os.path.exists(pub_key_path) or not os.path.exists(priv_key_path):
-            print("Server does not have public/private keys so generating them...")
+            log.info("server has no keys, generating them")
             self.generate_keys()
 
         # Load public and private keys
-        """ Load keys from pem files """
-        with open(pub_key_path, "r") as f:
-            pub_key = f.read()
-
-        with open(priv_key_path, "r") as f:
-            priv_key = f.read()
+        pub_key = self.keystore.get(pub_key_path)
+        priv_key = self.keystore.get(priv_key_path)
 
         return pub_key, priv_key
 
@@ -86,77 +324,359 @@ class Database(object):
         with open(os.path.join(self.DB_DIR, self.user + "_private.pem"), "wb") as f:
             f.write(priv_key)
 
-    def load_user_key(self, user: str) -> str:
+    def load_user_key(self, user: str) -> crypto.RSA.RsaKey:
         """ Load the public key of a given user from the PKI """
         path = os.path.join(self.KEY_DIR, "{}_public.pem".format(user))
-        with open(path, "r") as f:
-            pub_key = f.read()
-
-        return pub_key
+        return self.keystore.get(path)
 
     def error_check(self, request: Dict) -> Tuple[int, Dict]:
-        """ Perform error checking on the request """
-        return error_check_request(request, self.users, self.files)
+        """ Check a request with its operation's validator
+
+        Returns SUCCESS and no response, or FAILURE and the error response.
+        """
+        data = request["data"]
+        filename = data["filename"]
+
+        # An abandoned upload stops holding its filename once it expires
+        if self.expired(self.uploading.get(filename)):
+            self.discard_upload(self.uploading[filename])
+
+        op = operations.get(request["header"])
+        if op is None:
+            error = "unknown header"
+        else:
+            error = op.validate(data, self.users, self.files, self.find_upload(data["upload_id"]))
+
+        # A concurrent upload of the same name counts as an existing file,
+        # unless this request resumes it
+        if (
+            not error
+            and op.header == "upload_file"
+            and filename in self.uploading
+            and (not data["upload_id"] or data["upload_id"] != self.uploading[filename])
+        ):
+            error = "filename {} already exists".format(filename)
+
+        if not error:
+            return SUCCESS, None
+
+        response = new_response()
+        response["data"]["error"] = error
+        return FAILURE, response
 
     def add_user(self, user: str, data=None) -> Dict:
         """ Add a user to the database """
 
         # Update access control matrix
-        self.users[user] = user_template.copy()
+        self.log("add_user", user=user)
 
         # Format response
-        response = copy.deepcopy(response_template)
-        response["header"] = "success"
+        response = new_response("success")
         return response
 
     def upload_file(self, user: str, filename: str, data: bytes) -> Dict:
         """ Upload a file to the server and update the access control matrix """
         # Save file to server
-        utils.save_file(self.FILE_DIR, filename, data)
+        self.storage.save(filename, [data])
 
         # Update access control matrix
-        self.files[filename] = files_template.copy()
-        self.files[filename]["owner"] = user
-        self.files[filename]["access"].append(user)
+        self.log(
+            "upload_file", user=user, filename=filename, digest=hashlib.sha256(data).hexdigest()
+        )
+
+        # Format response
+        response = new_response("success")
+        return response
+
+    def upload_stream(
+        self, user: str, filename: str, chunks: Iterable[bytes], size: int, digest: bytes = b""
+    ) -> Dict:
+        """ Upload a file received as a stream of chunks
+
+        A stream that does not match its announced size or digest is
+        discarded and answered with a failure, reading it to the end so
+        the connection stays in step.
+        """
+        h = hashlib.sha256()
+
+        # Write to a temp file which is only renamed into place when complete
+        def checked(chunks):
+            received = 0
+            for chunk in chunks:
+                received += len(chunk)
+                if received > size:
+                    for _ in chunks:
+                        pass
+                    raise UploadMismatch("received more than the announced {} bytes".format(size))
+                h.update(chunk)
+                yield chunk
+            if received != size:
+                raise UploadMismatch(
+                    "received {} of the announced {} bytes".format(received, size)
+                )
+            if digest and h.digest() != digest:
+                raise UploadMismatch("file does not match the client's digest")
+
+        try:
+            self.storage.save(filename, checked(chunks))
+        except UploadMismatch as e:
+            response = new_response()
+            response["data"]["error"] = "upload of file {} failed: {}".format(filename, e)
+            return response
+
+        # Update access control matrix
+        self.log("upload_file", user=user, filename=filename, digest=h.hexdigest())
+
+        # Format response
+        response = new_response("success")
+        return response
+
+    def upload_resumable(
+        self, upload_id: str, chunks: Iterable[bytes], digest: bytes = b""
+    ) -> Dict:
+        """ Append a stream to a resumable upload and store the file once complete
+
+        Everything received is kept if the connection drops, so a later
+        request with the same upload ID carries on from the upload's offset.
+        A stream longer than announced discards the upload and is answered
+        with a failure, reading it to the end so the connection stays in
+        step.
+        """
+        upload = self.uploads[upload_id]
+        filename = upload["filename"]
+        part = os.path.join(self.UPLOAD_DIR, upload_id + ".part")
+        response = new_response()
+        error = None
+
+        try:
+            if upload["hash"] is None:
+                upload["hash"], upload["offset"] = self.hash_part(upload_id)
+
+            with upload.pop("part", None) or open(part, "ab") as f:
+                # Drop anything written past the offset by a failed attempt
+                f.truncate(upload["offset"])
+                for chunk in chunks:
+                    if upload["offset"] + len(chunk) > upload["size"]:
+                        error = "received more than the announced {} bytes".format(upload["size"])
+                        for _ in chunks:
+                            pass
+                        break
+                    f.write(chunk)
+                    upload["hash"].update(chunk)
+                    upload["offset"] += len(chunk)
+        finally:
+            upload["active"] = False
+            if self.shared:
+                self.uploads.pop(upload_id, None)
+
+        if error is not None:
+            self.discard_upload(upload_id)
+            response["data"]["error"] = "upload of file {} failed: {}".format(filename, error)
+            return response
+
+        response["data"]["offset"] = upload["offset"]
+        if upload["offset"] != upload["size"]:
+            response["data"]["error"] = "received {} of the announced {} bytes".format(
+                upload["offset"], upload["size"]
+            )
+            return response
+
+        if digest and upload["hash"].digest() != digest:
+            self.discard_upload(upload_id)
+            response["data"]["error"] = "upload of file {} failed: {}".format(
+                filename, "file does not match the client's digest"
+            )
+            return response
+
+        # Store the file then record it, a crash in between is cleaned up on recovery
+        self.storage.adopt(filename, part)
+        self.log(
+            "upload_file",
+            user=upload["user"],
+            filename=filename,
+            digest=upload["hash"].hexdigest(),
+        )
+        self.discard_upload(upload_id)
 
         # Format response
-        response = copy.deepcopy(response_template)
         response["header"] = "success"
         return response
 
+    def upload_status(self, user: str, upload_id: str) -> Dict:
+        """ Report how much of an interrupted upload has been received """
+        # Format response
+        response = new_response("success")
+        upload = self.find_upload(upload_id)
+        response["data"]["offset"] = upload["offset"]
+        response["data"]["size"] = upload["size"]
+        return response
+
     def download_file(self, user: str, filename: str) -> Dict:
         """ Send a file to the client """
         # Read file
-        data = utils.read_file(self.FILE_DIR, filename)
+        data = self.cached(filename)
 
         # Format response
-        response = copy.deepcopy(response_template)
-        response["header"] = "success"
+        response = new_response("success")
         response["data"]["filename"] = filename
         response["data"]["data"] = data
         return response
 
+    def download_stream(self, user: str, filename: str, offset: int = 0, length: int = 0) -> Dict:
+        """ Announce a file, or length bytes of it from offset, that will follow as chunks """
+        total = self.storage.size(filename)
+        response = new_response()
+
+        if offset > total:
+            response["data"]["error"] = "offset {} is past the end of file {}".format(
+                offset, filename
+            )
+            return response
+
+        # Format response
+        response["header"] = "success"
+        response["data"]["filename"] = filename
+        response["data"]["stream"] = True
+        response["data"]["size"] = (total if length == 0 else min(offset + length, total)) - offset
+        response["data"]["offset"] = offset
+        response["data"]["total"] = total
+        response["data"]["digest"] = bytes.fromhex(self.files[filename].get("digest", ""))
+        return response
+
+    def read_chunks(self, filename: str, offset: int = 0, length: int = None) -> Iterator[bytes]:
+        """ Read a stored file, or length bytes of it from offset, incrementally
+
+        Files small enough to cache are served from memory, larger ones
+        straight from storage.
+        """
+        tag = self.version(filename)
+        data = self.cache.get(filename, tag)
+        if data is None and self.storage.size(filename) <= self.cache.max_file_size:
+            data = self.storage.read(filename)
+            self.cache.put(filename, data, tag)
+
+        if data is None:
+            return self.storage.read_chunks(filename, streaming.CHUNK_SIZE, offset, length)
+
+        view = memoryview(data)[offset:None if length is None else offset + length]
+        return (
+            view[i:i + streaming.CHUNK_SIZE] for i in range(0, len(view), streaming.CHUNK_SIZE)
+        )
+
+    def cached(self, filename: str) -> bytes:
+        """ A file's contents from the cache, reading and caching them on a miss
+
+        Callers hold the file's lock so the contents cannot be replaced
+        between reading and caching them.
+        """
+        tag = self.version(filename)
+        data = self.cache.get(filename, tag)
+        if data is None:
+            data = self.storage.read(filename)
+            self.cache.put(filename, data, tag)
+        return data
+
+    def version(self, filename: str) -> str:
+        """ Tag for the cached contents of a file
+
+        Other processes sharing the database change files without
+        invalidating this one's cache, so their entries are tagged with
+        the file's digest. Otherwise invalidation is enough.
+        """
+        if not self.shared:
+            return None
+        return self.files[filename].get("digest")
+
+    def file_signature(self, user: str, filename: str) -> Dict:
+        """ Send the block signature of a file for delta updates """
+        size = self.storage.size(filename)
+        signature = delta.signature(
+            self.storage.read_chunks(filename, streaming.CHUNK_SIZE), delta.block_size_for(size)
+        )
+
+        # Format response
+        response = new_response("success")
+        response["data"]["data"] = signature
+        response["data"]["size"] = size
+        response["data"]["version"] = self.files[filename].get("version", 0)
+        return response
+
+    def update_file(self, user: str, filename: str, changes: bytes, digest: bytes) -> Dict:
+        """ Make a new version of a file from a delta against the current one """
+        h = hashlib.sha256()
+
+        def verified(chunks):
+            for chunk in chunks:
+                h.update(chunk)
+                yield chunk
+            if h.digest() != digest:
+                raise ValueError("result does not match the client's digest")
+
+        # The new version replaces the file atomically once it is verified
+        chunks = delta.patch(
+            changes, lambda offset, length: self.storage.read_range(filename, offset, length)
+        )
+        response = new_response()
+
+        try:
+            self.storage.save(filename, verified(chunks))
+        except ValueError as e:
+            response["data"]["error"] = "update of file {} failed: {}".format(filename, e)
+            return response
+
+        # Update access control matrix
+        version = self.files[filename].get("version", 0) + 1
+        self.log("update_file", filename=filename, version=version, digest=h.hexdigest())
+
+        # Format response
+        response["header"] = "success"
+        response["data"]["version"] = version
+        return response
+
     def delete_file(self, user: str, filename: str) -> Dict:
         """ Delete file specified by the client """
         # Delete file from server
-        os.remove(os.path.join(self.FILE_DIR, filename))
+        self.storage.delete(filename)
 
         # Update access control matrix
-        del self.files[filename]
+        self.log("delete_file", filename=filename)
 
         # Format response
-        response = copy.deepcopy(response_template)
-        response["header"] = "success"
+        response = new_response("success")
         return response
 
     def share_file(self, user: str, filename: str) -> Dict:
         """ Give access in the access control matrix to user2 for a file """
         # Update access control matrix
-        self.files[filename]["access"].append(user)
+        self.log("share_file", user=user, filename=filename)
 
         # Format response
-        response = copy.deepcopy(response_template)
-        response["header"] = "success"
+        response = new_response("success")
+        return response
+
+    def revoke_access(self, user: str, filename: str) -> Dict:
+        """ Take back a user's read access to a file """
+        # Update access control matrix
+        self.log("revoke_access", user=user, filename=filename)
+
+        # Format response
+        response = new_response("success")
+        return response
+
+    def list_files(self, user: str, offset: int = 0, length: int = 0) -> Dict:
+        """ List a page of the files a user owns or can read, in name order
+
+        The response data is a JSON list of filename and owner pairs and
+        its size is the user's total number of files.
+        """
+        length = min(length or LIST_PAGE_SIZE, LIST_PAGE_SIZE)
+        listing, total = self.metadata.list_files(user, offset, length)
+
+        # Format response
+        response = new_response("success")
+        response["data"]["data"] = json.dumps(listing).encode()
+        response["data"]["offset"] = offset
+        response["data"]["size"] = total
         return response
 
     def encrypt_response(self, user: str, response: Dict) -> Dict:
@@ -168,7 +688,7 @@ class Database(object):
         pub_key = self.load_user_key(user)
         
         # Encrypt and sign + MAC for integrity
-        ciphertext, mac = crypto.rsa_encrypt(data, pub_key, self.priv_key)
+        ciphertext, mac = crypto.hybrid_encrypt(data, pub_key, self.priv_key)
         response["data"] = ciphertext
         response["mac"] = mac
         
@@ -181,7 +701,7 @@ class Database(object):
         pub_key = self.load_user_key(request["sender"])
 
         # Decrypt the data dict and verify MAC and signature
-        plaintext = crypto.rsa_decrypt(
+        plaintext = crypto.hybrid_decrypt(
             ciphertext=request["data"],
             mac=request["mac"],
             pub_key=pub_key,
@@ -189,6 +709,6 @@ class Database(object):
         )
         
         # Deserialize data dict
-        request["data"] = utils.deserialize(plaintext)
+        request["data"] = utils.deserialize(plaintext, codec.RequestData)
 
         return request
\ No newline at end of file
@@ -0,0 +1,185 @@
+import zlib
+import struct
+import hashlib
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple
+
+from fileserve.storage import split
+
+
+# Block sizes grow with the square root of the file like rsync's
+MIN_BLOCK_SIZE = 2 * 1024
+MAX_BLOCK_SIZE = 1024 * 1024
+
+# Largest read made from the base file while applying a delta
+READ_SIZE = 1024 * 1024
+
+ADLER_MOD = 65521
+STRONG_SIZE = 16
+
+SIGNATURE_HEADER = struct.Struct("!IQ")
+SIGNATURE_BLOCK = struct.Struct("!I16s")
+DELTA_HEADER = struct.Struct("!I")
+COPY = struct.Struct("!cQI")
+LITERAL = struct.Struct("!cI")
+
+
+def block_size_for(size: int) -> int:
+    """ Pick the signature block size for a file of size bytes """
+    block_size = MIN_BLOCK_SIZE
+    while block_size * block_size < size and block_size < MAX_BLOCK_SIZE:
+        block_size *= 2
+    return block_size
+
+
+def strong_hash(block: bytes) -> bytes:
+    return hashlib.sha256(block).digest()[:STRONG_SIZE]
+
+
+def signature(chunks: Iterable[bytes], block_size: int) -> bytes:
+    """ Weak rolling checksum and strong hash of every block of a file """
+    parts = []
+    size = 0
+
+    for block in split(chunks, block_size):
+        parts.append(SIGNATURE_BLOCK.pack(zlib.adler32(block), strong_hash(block)))
+        size += len(block)
+
+    return SIGNATURE_HEADER.pack(block_size, size) + b"".join(parts)
+
+
+def parse_signature(data: bytes) -> Tuple[int, int, Dict[int, List[Tuple[int, bytes]]], Tuple]:
+    """ Return (block_size, size, full blocks by weak checksum, last partial block) """
+    block_size, size = SIGNATURE_HEADER.unpack_from(data)
+    count = (size + block_size - 1) // block_size
+
+    if len(data) != SIGNATURE_HEADER.size + count * SIGNATURE_BLOCK.size:
+        raise ValueError("signature is {} bytes, expected {} blocks".format(len(data), count))
+
+    blocks = {}
+    tail = None
+    for index, (weak, strong) in enumerate(
+        SIGNATURE_BLOCK.iter_unpack(memoryview(data)[SIGNATURE_HEADER.size:])
+    ):
+        if index == size // block_size:
+            tail = (index, size % block_size, strong)
+        else:
+            blocks.setdefault(weak, []).append((index, strong))
+
+    return block_size, size, blocks, tail
+
+
+def diff(data: bytes, sig: bytes) -> bytes:
+    """ Encode data as copies of blocks of the signed file plus literals
+
+    Blocks are looked up by a rolling Adler-32 so matches are found at any
+    offset, and confirmed with the strong hash. Runs of matching blocks
+    are found in block sized steps, only data that does not match the
+    base is scanned a byte at a time.
+    """
+    block_size, _, blocks, tail = parse_signature(sig)
+    view = memoryview(data)
+    n = len(data)
+
+    ops = [DELTA_HEADER.pack(block_size)]
+    copy = None  # pending run of blocks as [first, count]
+    literal_start = 0
+
+    def emit_copy():
+        nonlocal copy
+        if copy is not None:
+            ops.append(COPY.pack(b"C", copy[0], copy[1]))
+            copy = None
+
+    def emit_literal(end):
+        if literal_start < end:
+            emit_copy()
+            ops.append(LITERAL.pack(b"L", end - literal_start))
+            ops.append(view[literal_start:end])
+
+    def emit_match(index):
+        nonlocal copy
+        if copy is not None and copy[0] + copy[1] == index:
+            copy[1] += 1
+        else:
+            emit_copy()
+            copy = [index, 1]
+
+    i = 0
+    weak = None
+    while i + block_size <= n:
+        if weak is None:
+            weak = zlib.adler32(view[i:i + block_size])
+
+        match = None
+        candidates = blocks.get(weak)
+        if candidates is not None:
+            strong = strong_hash(view[i:i + block_size])
+            for index, candidate in candidates:
+                if candidate == strong:
+                    match = index
+                    break
+
+        if match is not None:
+            emit_literal(i)
+            emit_match(match)
+            i += block_size
+            literal_start = i
+            weak = None
+            continue
+
+        # Roll the checksum one byte forward
+        if i + block_size < n:
+            out, new = view[i], view[i + block_size]
+            a = ((weak & 0xffff) - out + new) % ADLER_MOD
+            b = ((weak >> 16) - block_size * out + a - 1) % ADLER_MOD
+            weak = (b << 16) | a
+        i += 1
+
+    # The shorter last block of the base can only match the end of the data
+    if tail is not None and tail[1] and n - tail[1] >= literal_start:
+        if strong_hash(view[n - tail[1]:]) == tail[2]:
+            emit_literal(n - tail[1])
+            emit_match(tail[0])
+            literal_start = n
+
+    emit_literal(n)
+    emit_copy()
+
+    return b"".join(ops)
+
+
+def patch(delta: bytes, read_range: Callable[[int, int], bytes]) -> Iterator[bytes]:
+    """ Rebuild a file from a delta, reading copied blocks with read_range """
+    view = memoryview(delta)
+    block_size, = DELTA_HEADER.unpack_from(view)
+    offset = DELTA_HEADER.size
+
+    while offset < len(view):
+        op = bytes(view[offset:offset + 1])
+
+        if op == b"C" and offset + COPY.size <= len(view):
+            _, first, count = COPY.unpack_from(view, offset)
+            offset += COPY.size
+
+            start = first * block_size
+            end = start + count * block_size
+            while start < end:
+                data = read_range(start, min(READ_SIZE, end - start))
+                if not data:
+                    raise ValueError("delta copies past the end of the base file")
+                yield data
+                start += len(data)
+                if len(data) < READ_SIZE and start < end:
+                    # Only the base's last block may be short
+                    break
+
+        elif op == b"L" and offset + LITERAL.size <= len(view):
+            _, length = LITERAL.unpack_from(view, offset)
+            offset += LITERAL.size
+            if offset + length > len(view):
+                raise ValueError("delta literal is truncated")
+            yield view[offset:offset + length]
+            offset += length
+
+        else:
+            raise ValueError("malformed delta at byte {}".format(offset))
@@ -1,147 +1,244 @@
-import copy
-from typing import Tuple, Dict
+from typing import Dict
 
-from fileserve.server import response_template
+from fileserve.compression import CODECS
 
 
 SUCCESS = 0
 FAILURE = 1
 
 
-def error_check_request(request: Dict, users: Dict, files: Dict) -> Tuple[int, Dict]:
-    """ Check for errors in request before processing """
-
-    response = copy.deepcopy(response_template)
-
-    if request["header"] == "upload_file":
-        # User1 doesn't exist
-        if request["data"]["user1"] not in users:
-            response["data"]["error"] = "user1 {} doesn't exist".format(
-                request["data"]["user1"]
-            )
-
-        # Filename wrong format
-        elif request["data"]["filename"] == "":
-            response["data"]["error"] = "filename {} is empty str".format(
-                request["data"]["filename"]
-            )
-
-        # File already exists
-        elif request["data"]["filename"] in files:
-            response["data"]["error"] = "filename {} already exists".format(
-                request["data"]["filename"]
-            )
-
-        # Data is empty
-        elif request["data"]["data"] == "" or request["data"]["data"] == b"":
-            response["data"]["error"] = "data {} is empty".format(
-                request["data"]["data"]
-            )
-
-    elif request["header"] == "download_file":
-        # User1 doesn't exist
-        if request["data"]["user1"] not in users:
-            response["data"]["error"] = "user1 {} doesn't exist".format(
-                request["data"]["user1"]
-            )
-
-        # Filename wrong format
-        elif request["data"]["filename"] == "":
-            response["data"]["error"] = "filename {} is empty str".format(
-                request["data"]["filename"]
-            )
-
-        # File doesn't exist
-        elif request["data"]["filename"] not in files:
-            response["data"]["error"] = "filename {} doesn't exist".format(
-                request["data"]["filename"]
-            )
-
-        # User1 doesn't have access to share file
-        elif request["data"]["user1"] not in files[request["data"]["filename"]]["access"]:
-            response["data"][
-                "error"
-            ] = "user1 {} not authorized to download file {}".format(
-                request["data"]["user1"], request["data"]["filename"]
-            )
-
-    elif request["header"] == "delete_file":
-        # User1 doesn't exist
-        if request["data"]["user1"] not in users:
-            response["data"]["error"] = "user1 {} doesn't exist".format(
-                request["data"]["user1"]
-            )
-
-        # Filename wrong format
-        elif request["data"]["filename"] == "":
-            response["data"]["error"] = "filename {} is empty str".format(
-                request["data"]["filename"]
-            )
-
-        # File doesn't exist
-        elif request["data"]["filename"] not in files:
-            response["data"]["error"] = "filename {} doesn't exist".format(
-                request["data"]["filename"]
-            )
-
-        # User1 doesn't have access to delete file
-        elif request["data"]["user1"] != files[request["data"]["filename"]]["owner"]:
-            response["data"][
-                "error"
-            ] = "user1 {} not authorized to delete file {}".format(
-                request["data"]["user1"], request["data"]["filename"]
-            )
-
-    elif request["header"] == "share_file":
-        # User1 doesn't exist
-        if request["data"]["user1"] not in users:
-            response["data"]["error"] = "user1 {} doesn't exist".format(
-                request["data"]["user1"]
-            )
-
-        # User2 doesn't exist
-        elif request["data"]["user2"] not in users:
-            response["data"]["error"] = "user2 {} doesn't exist".format(
-                request["data"]["user2"]
-            )
-
-        # Filename wrong format
-        elif request["data"]["filename"] == "":
-            response["data"]["error"] = "filename {} is empty str".format(
-                request["data"]["filename"]
-            )
-
-        # File doesn't exist
-        elif request["data"]["filename"] not in files:
-            response["data"]["error"] = "filename {} doesn't exist".format(
-                request["data"]["filename"]
-            )
-
-        # User1 doesn't have access to share file
-        elif request["data"]["user1"] != files[request["data"]["filename"]]["owner"]:
-            response["data"][
-                "error"
-            ] = "user1 {} not authorized to share file {}".format(
-                request["data"]["user1"], request["data"]["filename"]
-            )
-
-        # User2 already has access to file
-        elif request["data"]["user2"] in files[request["data"]["filename"]]["access"]:
-            response["data"]["error"] = "user2 {} already has read access to file {}".format(
-                request["data"]["user2"], request["data"]["filename"]
-            )
-
-    elif request["header"] == "add_user":
-        # User already exists so can't add
-        if request["data"]["user1"] in users:
-            response["data"]["error"] = "user1 {} already exists".format(
-                request["data"]["user1"]
-            )
-
-    else:
-        response["data"]["error"] = "unknown header"
-
-    if response["data"]["error"] == "":
-        return SUCCESS, response
-    else:
-        return FAILURE, response
+def valid_upload_id(upload_id: str) -> bool:
+    """ Upload IDs name files on the server so only allow 128 bit hex strings """
+    return len(upload_id) == 32 and all(c in "0123456789abcdef" for c in upload_id)
+
+
+def missing_user(data: Dict, users: Dict, field: str = "user1") -> str:
+    """ Error for a user field naming nobody, or "" """
+    if data[field] not in users:
+        return "{} {} doesn't exist".format(field, data[field])
+    return ""
+
+
+def missing_file(data: Dict, files: Dict) -> str:
+    """ Error for a filename that is empty or not stored, or "" """
+    # Filename wrong format
+    if data["filename"] == "":
+        return "filename {} is empty str".format(data["filename"])
+
+    # File doesn't exist
+    if data["filename"] not in files:
+        return "filename {} doesn't exist".format(data["filename"])
+
+    return ""
+
+
+def check_upload_file(data: Dict, users: Dict, files: Dict, upload: Dict) -> str:
+    """ Check an upload, or the resumption of one """
+    # User1 doesn't exist
+    if data["user1"] not in users:
+        return "user1 {} doesn't exist".format(data["user1"])
+
+    # Filename wrong format
+    if data["filename"] == "":
+        return "filename {} is empty str".format(data["filename"])
+
+    # File already exists
+    if data["filename"] in files:
+        return "filename {} already exists".format(data["filename"])
+
+    # Data is empty
+    if data["data"] in ("", b"") and data["size"] == 0:
+        return "data {} is empty".format(data["data"])
+
+    # Compression not supported
+    if data["compression"] not in CODECS:
+        return "compression {} is not supported".format(data["compression"])
+
+    # Upload ID wrong format
+    if data["upload_id"] and not valid_upload_id(data["upload_id"]):
+        return "upload_id {} is not valid".format(data["upload_id"])
+
+    if upload is None:
+        # Upload to resume doesn't exist
+        if data["offset"] != 0:
+            return "upload_id {} doesn't exist".format(data["upload_id"])
+        return ""
+
+    # Upload to resume is of another file
+    if (
+        upload["user"] != data["user1"]
+        or upload["filename"] != data["filename"]
+        or upload["size"] != data["size"]
+    ):
+        return "upload_id {} is not an upload of file {}".format(
+            data["upload_id"], data["filename"]
+        )
+
+    # Upload to resume is still receiving data
+    if upload["active"]:
+        return "upload_id {} is already in progress".format(data["upload_id"])
+
+    # Upload resumed from the wrong place
+    if data["offset"] != upload["offset"]:
+        return "upload_id {} is at offset {} not {}".format(
+            data["upload_id"], upload["offset"], data["offset"]
+        )
+
+    return ""
+
+
+def check_upload_status(data: Dict, users: Dict, files: Dict, upload: Dict) -> str:
+    error = missing_user(data, users)
+    if error:
+        return error
+
+    # Upload ID wrong format
+    if not valid_upload_id(data["upload_id"]):
+        return "upload_id {} is not valid".format(data["upload_id"])
+
+    # Upload doesn't exist
+    if upload is None:
+        return "upload_id {} doesn't exist".format(data["upload_id"])
+
+    # User1 doesn't own the upload
+    if data["user1"] != upload["user"]:
+        return "user1 {} not authorized to resume upload_id {}".format(
+            data["user1"], data["upload_id"]
+        )
+
+    return ""
+
+
+def check_download_file(data: Dict, users: Dict, files: Dict, upload: Dict) -> str:
+    error = missing_user(data, users) or missing_file(data, files)
+    if error:
+        return error
+    info = files[data["filename"]]
+
+    # User1 doesn't have access to read file
+    if data["user1"] not in info["access"]:
+        return "user1 {} not authorized to download file {}".format(
+            data["user1"], data["filename"]
+        )
+
+    # Range was requested from a different version of the file
+    if data["digest"] and data["digest"].hex() != info.get("digest"):
+        return "file {} has changed".format(data["filename"])
+
+    # Compression not supported
+    if data["compression"] not in CODECS:
+        return "compression {} is not supported".format(data["compression"])
+
+    return ""
+
+
+def check_file_signature(data: Dict, users: Dict, files: Dict, upload: Dict) -> str:
+    error = missing_user(data, users) or missing_file(data, files)
+    if error:
+        return error
+
+    # User1 doesn't have access to read file
+    if data["user1"] not in files[data["filename"]]["access"]:
+        return "user1 {} not authorized to download file {}".format(
+            data["user1"], data["filename"]
+        )
+
+    return ""
+
+
+def check_update_file(data: Dict, users: Dict, files: Dict, upload: Dict) -> str:
+    error = missing_user(data, users) or missing_file(data, files)
+    if error:
+        return error
+    info = files[data["filename"]]
+
+    # User1 doesn't have access to update file
+    if data["user1"] != info["owner"]:
+        return "user1 {} not authorized to update file {}".format(
+            data["user1"], data["filename"]
+        )
+
+    # Delta was computed against an older version
+    if data["version"] != info.get("version", 0):
+        return "file {} has changed since version {}".format(data["filename"], data["version"])
+
+    return ""
+
+
+def check_delete_file(data: Dict, users: Dict, files: Dict, upload: Dict) -> str:
+    error = missing_user(data, users) or missing_file(data, files)
+    if error:
+        return error
+
+    # User1 doesn't have access to delete file
+    if data["user1"] != files[data["filename"]]["owner"]:
+        return "user1 {} not authorized to delete file {}".format(
+            data["user1"], data["filename"]
+        )
+
+    return ""
+
+
+def check_share_file(data: Dict, users: Dict, files: Dict, upload: Dict) -> str:
+    error = (
+        missing_user(data, users)
+        or missing_user(data, users, "user2")
+        or missing_file(data, files)
+    )
+    if error:
+        return error
+    info = files[data["filename"]]
+
+    # User1 doesn't have access to share file
+    if data["user1"] != info["owner"]:
+        return "user1 {} not authorized to share file {}".format(
+            data["user1"], data["filename"]
+        )
+
+    # User2 already has access to file
+    if data["user2"] in info["access"]:
+        return "user2 {} already has read access to file {}".format(
+            data["user2"], data["filename"]
+        )
+
+    return ""
+
+
+def check_revoke_access(data: Dict, users: Dict, files: Dict, upload: Dict) -> str:
+    error = (
+        missing_user(data, users)
+        or missing_user(data, users, "user2")
+        or missing_file(data, files)
+    )
+    if error:
+        return error
+    info = files[data["filename"]]
+
+    # User1 doesn't have access to revoke access to file
+    if data["user1"] != info["owner"]:
+        return "user1 {} not authorized to revoke access to file {}".format(
+            data["user1"], data["filename"]
+        )
+
+    # The owner always keeps access
+    if data["user2"] == info["owner"]:
+        return "user2 {} owns file {}".format(data["user2"], data["filename"])
+
+    # User2 doesn't have access to file
+    if data["user2"] not in info["access"]:
+        return "user2 {} doesn't have read access to file {}".format(
+            data["user2"], data["filename"]
+        )
+
+    return ""
+
+
+def check_list_files(data: Dict, users: Dict, files: Dict, upload: Dict) -> str:
+    return missing_user(data, users)
+
+
+def check_add_user(data: Dict, users: Dict, files: Dict, upload: Dict) -> str:
+    # User already exists so can't add
+    if data["user1"] in users:
+        return "user1 {} already exists".format(data["user1"])
+    return ""
@@ -0,0 +1,134 @@
+import os
+import json
+import time
+import threading
+
+from fileserve import metrics
+from typing import Dict, List
+
+
+class Journal(object):
+    """ Append-only log of metadata mutations with group commit
+
+    Every mutation is one JSON line. A record is durable once a commit has
+    fsync'ed past it. Concurrent committers share a single fsync: whoever
+    arrives while one is running waits for it and is covered by the next.
+
+    append only writes the record, sync then applies the durability
+    policy: sync_every=1 waits until the record is durable, sync_every=N
+    fsyncs once per N records, and sync_interval fsyncs from a background
+    thread every that many seconds instead. Both 0/None leave syncing to
+    explicit commit calls.
+    """
+
+    def __init__(self, path: str, sync_every: int = 1, sync_interval: float = None):
+        self.path = path
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+
+        self.lsn = 0
+        self.synced_lsn = 0
+        self.records = 0
+
+        self._syncing = False
+        self._cond = threading.Condition()
+        self._file = open(path, "ab")
+        self._closed = False
+
+        if sync_interval:
+            t = threading.Thread(target=self._flusher, daemon=True)
+            t.start()
+
+    @staticmethod
+    def replay(path: str) -> List[Dict]:
+        """ Read every complete record, dropping a torn write at the tail """
+        records = []
+        if not os.path.exists(path):
+            return records
+
+        good = 0
+        with open(path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    break
+                good += len(line)
+
+        # Cut off whatever followed the last complete record
+        if good != os.path.getsize(path):
+            with open(path, "r+b") as f:
+                f.truncate(good)
+
+        return records
+
+    def append(self, op: str, **fields) -> int:
+        """ Append a record and return its log sequence number """
+        fields["op"] = op
+        line = (json.dumps(fields) + "\n").encode()
+
+        with self._cond:
+            self._file.write(line)
+            self.lsn += 1
+            self.records += 1
+            return self.lsn
+
+    def sync(self, lsn: int):
+        """ Make a record durable if the sync policy says it is due """
+        if self.sync_every and lsn - self.synced_lsn >= self.sync_every:
+            self.commit(lsn)
+
+    def commit(self, lsn: int = None):
+        """ Block until every record up to lsn is on disk """
+        with self._cond:
+            if lsn is None:
+                lsn = self.lsn
+
+            while self.synced_lsn < lsn and not self._closed:
+                if self._syncing:
+                    self._cond.wait()
+                    continue
+
+                # Become the leader and sync everything written so far
+                self._syncing = True
+                target = self.lsn
+                self._file.flush()
+
+                self._cond.release()
+                try:
+                    with metrics.timed("fsync"):
+                        os.fsync(self._file.fileno())
+                finally:
+                    self._cond.acquire()
+                    self._syncing = False
+                    self._cond.notify_all()
+
+                self.synced_lsn = max(self.synced_lsn, target)
+
+    def reset(self):
+        """ Empty the journal once its records are captured in a snapshot """
+        with self._cond:
+            self._file.flush()
+            self._file.truncate(0)
+            os.fsync(self._file.fileno())
+            self.records = 0
+            self.synced_lsn = self.lsn
+
+    def close(self):
+        """ Sync and close the journal """
+        self.commit()
+        with self._cond:
+            if not self._closed:
+                self._closed = True
+                self._file.close()
+
+    def _flusher(self):
+        """ Background group commit every sync_interval seconds """
+        while True:
+            time.sleep(self.sync_interval)
+            if self._closed:
+                break
+            if self.synced_lsn < self.lsn:
+                self.commit()
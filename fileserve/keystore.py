@@ -0,0 +1,81 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+
+from Crypto.PublicKey import RSA
+
+from fileserve import crypto
+
+
+class KeyStore(object):
+    """ LRU cache of parsed RSA keys keyed by PEM file path
+
+    Parsing PEM/ASN.1 and opening the key file on every message is a large
+    part of per-request CPU, so parsed RsaKey objects are kept in memory.
+    The PEM file is re-stat'ed at most every check_interval seconds and
+    reloaded if its mtime changed.
+    """
+
+    def __init__(self, max_keys: int = 1024, check_interval: float = 1.0):
+        self.max_keys = max_keys
+        self.check_interval = check_interval
+        self.hits = 0
+        self.misses = 0
+
+        # path -> [mtime, last_checked, RsaKey]
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path: str) -> RSA.RsaKey:
+        """ Return the parsed key stored at path """
+        path = os.path.abspath(path)
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._keys.get(path)
+            if entry is not None and now - entry[1] < self.check_interval:
+                self._keys.move_to_end(path)
+                self.hits += 1
+                return entry[2]
+
+        # Stat outside of the lock, a missing key raises FileNotFoundError
+        mtime = os.stat(path).st_mtime_ns
+
+        with self._lock:
+            entry = self._keys.get(path)
+            if entry is not None and entry[0] == mtime:
+                entry[1] = now
+                self._keys.move_to_end(path)
+                self.hits += 1
+                return entry[2]
+
+        with open(path, "r") as f:
+            key = crypto.import_key(f.read())
+
+        with self._lock:
+            self.misses += 1
+            self._keys[path] = [mtime, now, key]
+            self._keys.move_to_end(path)
+            while len(self._keys) > self.max_keys:
+                self._keys.popitem(last=False)
+
+        return key
+
+    def invalidate(self, path: str):
+        """ Drop a cached key so the next get reloads it """
+        path = os.path.abspath(path)
+        with self._lock:
+            self._keys.pop(path, None)
+
+    def clear(self):
+        """ Drop all cached keys """
+        with self._lock:
+            self._keys.clear()
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+
+# Store shared by every Database and Client in the process
+default_keystore = KeyStore()
@@ -0,0 +1,90 @@
+import os
+import zlib
+import fcntl
+import threading
+import contextlib
+from typing import Hashable
+
+
+class StripedLock(object):
+    """ Fixed pool of re-entrant locks selected by hashing a key
+
+    Operations on different keys only contend when their keys share a
+    stripe, while memory stays constant no matter how many keys exist.
+    """
+
+    def __init__(self, stripes: int = 64):
+        self.stripes = [threading.RLock() for _ in range(stripes)]
+
+    def __call__(self, key: Hashable) -> threading.RLock:
+        """ Return the lock guarding key """
+        return self.stripes[hash(key) % len(self.stripes)]
+
+    @contextlib.contextmanager
+    def all(self):
+        """ Hold every stripe, always acquired in the same order """
+        for lock in self.stripes:
+            lock.acquire()
+        try:
+            yield
+        finally:
+            for lock in reversed(self.stripes):
+                lock.release()
+
+
+class ProcessLock(object):
+    """ Re-entrant lock excluding other threads and other processes
+
+    Threads queue on an RLock, the thread holding it then takes an fcntl
+    lock on one byte of a shared file, which the kernel drops if the
+    process dies.
+    """
+
+    def __init__(self, fd: int, offset: int):
+        self.fd = fd
+        self.offset = offset
+        self.lock = threading.RLock()
+        self.depth = 0
+
+    def acquire(self):
+        self.lock.acquire()
+        if self.depth == 0:
+            try:
+                fcntl.lockf(self.fd, fcntl.LOCK_EX, 1, self.offset)
+            except BaseException:
+                self.lock.release()
+                raise
+        self.depth += 1
+
+    def release(self):
+        self.depth -= 1
+        if self.depth == 0:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, self.offset)
+        self.lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class ProcessStripedLock(StripedLock):
+    """ StripedLock shared by every process that opens the same lock file
+
+    Keys are hashed with CRC32 rather than hash(), which is salted per
+    process, so all processes agree on the stripe guarding a key.
+    """
+
+    def __init__(self, path: str, stripes: int = 64):
+        self.path = path
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        self.stripes = [ProcessLock(self.fd, i) for i in range(stripes)]
+
+    def __call__(self, key: Hashable) -> ProcessLock:
+        """ Return the lock guarding key """
+        return self.stripes[zlib.crc32(repr(key).encode()) % len(self.stripes)]
+
+    def close(self):
+        os.close(self.fd)
@@ -0,0 +1,116 @@
+import sys
+import json
+import queue
+import logging
+import logging.handlers
+from typing import Dict
+
+from fileserve import codec
+
+
+# Attributes every LogRecord has, anything else was passed in extra
+RECORD_ATTRS = set(logging.LogRecord("", 0, "", 0, "", (), None).__dict__) | {"message"}
+
+
+class JSONFormatter(logging.Formatter):
+    """ Format records as one JSON object per line
+
+    Fields passed with extra= are included as they are, except bytes which
+    are replaced by their length so file data never reaches the logs.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+
+        for key, value in record.__dict__.items():
+            if key not in RECORD_ATTRS:
+                entry[key] = scrub(value)
+
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """ Format records as their message followed by any extra fields """
+
+    def format(self, record: logging.LogRecord) -> str:
+        fields = " ".join(
+            "{}={}".format(key, scrub(value))
+            for key, value in record.__dict__.items()
+            if key not in RECORD_ATTRS
+        )
+        text = record.getMessage() + (" " + fields if fields else "")
+
+        if record.exc_info:
+            text += "\n" + self.formatException(record.exc_info)
+
+        return text
+
+
+def scrub(value):
+    """ Replace payloads by their size """
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return "<{} bytes>".format(len(value))
+    return value
+
+
+# Message fields that would clash with LogRecord attributes
+RENAMES = {"filename": "file"}
+
+
+def summarize(message: codec.Message) -> Dict:
+    """ Fields of a request or response worth logging, with sizes in place of data """
+    summary = {}
+
+    for key in message.keys():
+        value = message[key]
+        key = RENAMES.get(key, key)
+        if isinstance(value, codec.Message):
+            summary.update(summarize(value))
+        elif isinstance(value, (bytes, bytearray, memoryview)):
+            if value:
+                summary[key + "_bytes"] = len(value)
+        elif value not in ("", 0, False):
+            summary[key] = value
+
+    return summary
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    """ Enqueue records untouched so even their messages are formatted by the listener
+
+    Only immutable values are logged, so the arguments cannot change
+    before the listener gets to them.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def setup(level: str = "INFO", fmt: str = "json", stream=None) -> logging.handlers.QueueListener:
+    """ Send the fileserve logs through a queue to a background writer thread
+
+    Request threads only enqueue records, formatting and writing them
+    happens on the listener's thread. Returns the started listener, stop
+    it to flush the queue before exiting.
+    """
+    handler = logging.StreamHandler(stream if stream is not None else sys.stderr)
+    handler.setFormatter(JSONFormatter() if fmt == "json" else TextFormatter())
+
+    records = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(records, handler, respect_handler_level=True)
+
+    logger = logging.getLogger("fileserve")
+    logger.setLevel(level)
+    logger.addHandler(QueueHandler(records))
+    logger.propagate = False
+
+    listener.start()
+    return listener
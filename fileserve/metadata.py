@@ -0,0 +1,489 @@
+import os
+import json
+import sqlite3
+import threading
+from collections.abc import Mapping, MutableMapping, Set
+from typing import Dict, Iterator, List, Tuple
+
+from fileserve import utils
+from fileserve import metrics
+from fileserve.acl import AccessIndex
+from fileserve.journal import Journal
+from fileserve.locking import StripedLock
+
+user_template = {
+    "info": ""
+}
+
+
+class JournaledMetadata(object):
+    """ Users and file metadata held in dicts
+
+    Mutations are journaled and the journal is folded into a JSON snapshot
+    every compact_every records, so startup loads the snapshot and replays
+    whatever was journaled since.
+    """
+
+    def __init__(
+        self,
+        db_dir: str,
+        locks: StripedLock,
+        sync_every: int = 1,
+        sync_interval: float = None,
+        compact_every: int = 10000,
+    ):
+        self.db_dir = db_dir
+        self.db_file = "db.json"
+        self.journal_file = "journal.log"
+        self.locks = locks
+        self.compact_every = compact_every
+        self.acl = AccessIndex()
+
+        self.files, self.users = self.load()
+        self.journal = Journal(
+            os.path.join(db_dir, self.journal_file),
+            sync_every=sync_every,
+            sync_interval=sync_interval,
+        )
+
+    def load(self) -> Tuple[Dict, Dict]:
+        """ Load the last snapshot and replay the journal on top of it """
+        if os.path.exists(os.path.join(self.db_dir, self.db_file)):
+            with open(os.path.join(self.db_dir, self.db_file), "r") as f:
+                db = json.load(f)
+
+            self.files, self.users = db["files"], db["users"]
+            for info in self.files.values():
+                info["access"] = set(info["access"])
+
+        else:
+            self.files, self.users = {}, {}
+
+        self.acl.build(self.files)
+
+        for record in Journal.replay(os.path.join(self.db_dir, self.journal_file)):
+            self.apply(record)
+
+        return self.files, self.users
+
+    def snapshot(self) -> str:
+        """ Metadata as JSON, with access sets as sorted lists """
+        return json.dumps({"files": self.files, "users": self.users}, indent=1, default=sorted)
+
+    def save(self, filename: str = None):
+        """ Write a snapshot to filename, or compact the journal if it is our snapshot """
+        if filename is None:
+            self.compact()
+            return
+
+        self.journal.commit()
+        with self.locks.all():
+            data = self.snapshot()
+
+        with open(filename, "w") as f:
+            f.write(data)
+
+    def compact(self):
+        """ Write a snapshot of the metadata and empty the journal """
+        with self.locks.all():
+            data = self.snapshot()
+            utils.save_file(self.db_dir, self.db_file, data.encode(), fsync=True)
+            self.journal.reset()
+
+    def apply(self, record: Dict):
+        """ Apply a metadata mutation, replaying it must be idempotent """
+        op = record["op"]
+
+        if op == "add_user":
+            self.users[record["user"]] = user_template.copy()
+
+        elif op == "upload_file":
+            old = self.files.get(record["filename"])
+            if old is not None:
+                self.acl.remove_file(record["filename"], old)
+
+            self.files[record["filename"]] = {
+                "owner": record["user"],
+                "access": {record["user"]},
+                "digest": record.get("digest", ""),
+            }
+            self.acl.add(record["user"], record["filename"], owner=True)
+
+        elif op == "update_file" and record["filename"] in self.files:
+            self.files[record["filename"]]["version"] = record["version"]
+            self.files[record["filename"]]["digest"] = record.get("digest", "")
+
+        elif op == "delete_file":
+            old = self.files.pop(record["filename"], None)
+            if old is not None:
+                self.acl.remove_file(record["filename"], old)
+
+        elif op == "share_file" and record["filename"] in self.files:
+            self.files[record["filename"]]["access"].add(record["user"])
+            self.acl.add(record["user"], record["filename"])
+
+        elif (
+            op == "revoke_access"
+            and record["filename"] in self.files
+            and record["user"] != self.files[record["filename"]]["owner"]
+        ):
+            self.files[record["filename"]]["access"].discard(record["user"])
+            self.acl.remove(record["user"], record["filename"])
+
+    def record(self, record: Dict) -> int:
+        """ Apply and journal a mutation, the caller holds its lock """
+        self.apply(record)
+        return self.journal.append(**record)
+
+    def commit(self, lsn: int):
+        """ Wait for a recorded mutation to be durable, called without the lock """
+        with metrics.timed("journal_sync"):
+            self.journal.sync(lsn)
+
+        if self.journal.records >= self.compact_every:
+            self.compact()
+
+    def list_files(self, user: str, offset: int, length: int) -> Tuple[List[List[str]], int]:
+        """ A page of the (filename, owner) a user can read in name order, and their total """
+        listing = []
+        for filename in self.acl.files_of(user, offset, length):
+            info = self.files.get(filename)
+            if info is not None:
+                listing.append([filename, info["owner"]])
+
+        return listing, self.acl.count(user)
+
+    def close(self):
+        self.journal.close()
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    name TEXT PRIMARY KEY,
+    info TEXT NOT NULL DEFAULT ''
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS files (
+    name TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    digest TEXT NOT NULL DEFAULT '',
+    version INTEGER NOT NULL DEFAULT 0
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS grants (
+    filename TEXT NOT NULL,
+    user TEXT NOT NULL,
+    PRIMARY KEY (filename, user)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS grants_by_user ON grants (user, filename);
+
+CREATE TABLE IF NOT EXISTS reservations (
+    filename TEXT PRIMARY KEY,
+    upload_id TEXT NOT NULL,
+    pid INTEGER NOT NULL
+) WITHOUT ROWID;
+"""
+
+# Statements are kept as constants so each connection's statement cache
+# prepares them once
+HAS_USER = "SELECT 1 FROM users WHERE name = ?"
+GET_USER = "SELECT info FROM users WHERE name = ?"
+ALL_USERS = "SELECT name FROM users ORDER BY name"
+COUNT_USERS = "SELECT COUNT(*) FROM users"
+PUT_USER = "INSERT OR REPLACE INTO users (name, info) VALUES (?, ?)"
+
+HAS_FILE = "SELECT 1 FROM files WHERE name = ?"
+GET_FILE = "SELECT owner, digest, version FROM files WHERE name = ?"
+ALL_FILES = "SELECT name FROM files ORDER BY name"
+COUNT_FILES = "SELECT COUNT(*) FROM files"
+PUT_FILE = "INSERT OR REPLACE INTO files (name, owner, digest, version) VALUES (?, ?, ?, ?)"
+UPDATE_FILE = "UPDATE files SET version = ?, digest = ? WHERE name = ?"
+DELETE_FILE = "DELETE FROM files WHERE name = ?"
+
+HAS_GRANT = "SELECT 1 FROM grants WHERE filename = ? AND user = ?"
+FILE_GRANTS = "SELECT user FROM grants WHERE filename = ? ORDER BY user"
+COUNT_FILE_GRANTS = "SELECT COUNT(*) FROM grants WHERE filename = ?"
+COUNT_USER_GRANTS = "SELECT COUNT(*) FROM grants WHERE user = ?"
+PUT_GRANT = "INSERT OR IGNORE INTO grants (filename, user) VALUES (?, ?)"
+SHARE = "INSERT OR IGNORE INTO grants (filename, user) SELECT name, ? FROM files WHERE name = ?"
+REVOKE = """
+DELETE FROM grants WHERE filename = ? AND user = ?
+AND user != (SELECT owner FROM files WHERE name = ?)
+"""
+DELETE_GRANTS = "DELETE FROM grants WHERE filename = ?"
+GET_RESERVATION = "SELECT upload_id, pid FROM reservations WHERE filename = ?"
+ALL_RESERVATIONS = "SELECT filename, pid FROM reservations ORDER BY filename"
+PUT_RESERVATION = "INSERT OR REPLACE INTO reservations (filename, upload_id, pid) VALUES (?, ?, ?)"
+DELETE_RESERVATION = "DELETE FROM reservations WHERE filename = ?"
+LIST_FILES = """
+SELECT grants.filename, files.owner FROM grants JOIN files ON files.name = grants.filename
+WHERE grants.user = ? ORDER BY grants.filename LIMIT ? OFFSET ?
+"""
+
+
+class UserTable(Mapping):
+    """ Read only dict view of the users table """
+
+    def __init__(self, store: "SQLiteMetadata"):
+        self.store = store
+
+    def __getitem__(self, name: str) -> Dict:
+        row = self.store.query_one(GET_USER, (name,))
+        if row is None:
+            raise KeyError(name)
+        return {"info": row[0]}
+
+    def __contains__(self, name) -> bool:
+        return self.store.query_one(HAS_USER, (name,)) is not None
+
+    def __iter__(self) -> Iterator[str]:
+        return (row[0] for row in self.store.query(ALL_USERS))
+
+    def __len__(self) -> int:
+        return self.store.query_one(COUNT_USERS)[0]
+
+
+class GrantSet(Set):
+    """ Read only set view of the users with access to one file """
+
+    def __init__(self, store: "SQLiteMetadata", filename: str):
+        self.store = store
+        self.filename = filename
+
+    def __contains__(self, user) -> bool:
+        return self.store.query_one(HAS_GRANT, (self.filename, user)) is not None
+
+    def __iter__(self) -> Iterator[str]:
+        return (row[0] for row in self.store.query(FILE_GRANTS, (self.filename,)))
+
+    def __len__(self) -> int:
+        return self.store.query_one(COUNT_FILE_GRANTS, (self.filename,))[0]
+
+
+class FileTable(Mapping):
+    """ Read only dict view of the files table with each file's grants """
+
+    def __init__(self, store: "SQLiteMetadata"):
+        self.store = store
+
+    def __getitem__(self, name: str) -> Dict:
+        row = self.store.query_one(GET_FILE, (name,))
+        if row is None:
+            raise KeyError(name)
+        return {
+            "owner": row[0],
+            "access": GrantSet(self.store, name),
+            "digest": row[1],
+            "version": row[2],
+        }
+
+    def __contains__(self, name) -> bool:
+        return self.store.query_one(HAS_FILE, (name,)) is not None
+
+    def __iter__(self) -> Iterator[str]:
+        return (row[0] for row in self.store.query(ALL_FILES))
+
+    def __len__(self) -> int:
+        return self.store.query_one(COUNT_FILES)[0]
+
+
+def alive(pid: int) -> bool:
+    """ Whether a process exists """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class ReservationTable(MutableMapping):
+    """ Dict of filename to upload ID claimed by uploads in flight, shared across processes
+
+    Claims by plain uploads lapse with the process that made them.
+    Resumable uploads outlive it, they are released when completed or
+    discarded.
+    """
+
+    def __init__(self, store: "SQLiteMetadata"):
+        self.store = store
+
+    def __getitem__(self, filename: str) -> str:
+        row = self.store.query_one(GET_RESERVATION, (filename,))
+        if row is None or (row[1] and not alive(row[1])):
+            raise KeyError(filename)
+        return row[0]
+
+    def __setitem__(self, filename: str, upload_id: str):
+        with self.store.connection() as conn:
+            conn.execute(PUT_RESERVATION, (filename, upload_id, 0 if upload_id else os.getpid()))
+
+    def __delitem__(self, filename: str):
+        with self.store.connection() as conn:
+            if conn.execute(DELETE_RESERVATION, (filename,)).rowcount == 0:
+                raise KeyError(filename)
+
+    def __iter__(self) -> Iterator[str]:
+        rows = self.store.query(ALL_RESERVATIONS)
+        return (filename for filename, pid in rows if not pid or alive(pid))
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+
+class SQLiteMetadata(object):
+    """ Users and file metadata in an SQLite database in WAL mode
+
+    Nothing is loaded up front, lookups are indexed queries, so startup
+    is immediate and the catalog can outgrow memory. Each thread has its
+    own connection, readers never block behind the writer in WAL mode and
+    writers take turns. Every mutation is its own transaction, synced
+    when sync_every is set. Group commit and sync_interval do not apply.
+
+    Owners are stored as a grant on their own file, so access checks and
+    listing a user's files are single index lookups.
+    """
+
+    def __init__(
+        self,
+        db_dir: str,
+        locks: StripedLock,
+        sync_every: int = 1,
+        sync_interval: float = None,
+        compact_every: int = 10000,
+    ):
+        self.path = os.path.join(db_dir, "metadata.sqlite3")
+        self.locks = locks
+        self.synchronous = "FULL" if sync_every else "NORMAL"
+
+        # thread -> connection, pruned as threads exit
+        self._connections = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+        with self.connection() as conn:
+            conn.executescript(SCHEMA)
+
+        self.files = FileTable(self)
+        self.users = UserTable(self)
+
+    def connection(self) -> sqlite3.Connection:
+        """ This thread's connection, opened on first use """
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            return conn
+
+        conn = sqlite3.connect(self.path, timeout=30.0, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous={}".format(self.synchronous))
+        self._local.conn = conn
+
+        with self._lock:
+            for thread in [thread for thread in self._connections if not thread.is_alive()]:
+                self._connections.pop(thread).close()
+            self._connections[threading.current_thread()] = conn
+
+        return conn
+
+    def query(self, sql: str, params: Tuple = ()) -> List[Tuple]:
+        return self.connection().execute(sql, params).fetchall()
+
+    def query_one(self, sql: str, params: Tuple = ()) -> Tuple:
+        return self.connection().execute(sql, params).fetchone()
+
+    def apply(self, record: Dict):
+        """ Apply a metadata mutation in one transaction, replaying it must be idempotent """
+        op = record["op"]
+
+        with self.connection() as conn:
+            if op == "add_user":
+                conn.execute(PUT_USER, (record["user"], user_template["info"]))
+
+            elif op == "upload_file":
+                conn.execute(DELETE_GRANTS, (record["filename"],))
+                conn.execute(
+                    PUT_FILE, (record["filename"], record["user"], record.get("digest", ""), 0)
+                )
+                conn.execute(PUT_GRANT, (record["filename"], record["user"]))
+
+            elif op == "update_file":
+                conn.execute(
+                    UPDATE_FILE, (record["version"], record.get("digest", ""), record["filename"])
+                )
+
+            elif op == "delete_file":
+                conn.execute(DELETE_FILE, (record["filename"],))
+                conn.execute(DELETE_GRANTS, (record["filename"],))
+
+            elif op == "share_file":
+                conn.execute(SHARE, (record["user"], record["filename"]))
+
+            elif op == "revoke_access":
+                conn.execute(REVOKE, (record["filename"], record["user"], record["filename"]))
+
+    def record(self, record: Dict):
+        """ Apply and commit a mutation, the caller holds its lock """
+        with metrics.timed("sqlite_write"):
+            self.apply(record)
+
+    def commit(self, lsn):
+        """ Mutations are durable once record returns """
+
+    def load_snapshot(self, files: Dict, users: Dict):
+        """ Bulk import metadata in the JSON snapshot format in one transaction """
+        with self.connection() as conn:
+            conn.executemany(
+                PUT_USER, ((name, info.get("info", "")) for name, info in users.items())
+            )
+            conn.executemany(PUT_FILE, (
+                (name, info["owner"], info.get("digest", ""), info.get("version", 0))
+                for name, info in files.items()
+            ))
+            conn.executemany(PUT_GRANT, (
+                (name, user)
+                for name, info in files.items()
+                for user in set(info["access"]) | {info["owner"]}
+            ))
+
+    def snapshot(self) -> str:
+        """ Metadata as JSON in the same format as JournaledMetadata """
+        files = {}
+        for name in self.files:
+            info = self.files[name]
+            info["access"] = sorted(info["access"])
+            files[name] = info
+        users = {name: self.users[name] for name in self.users}
+        return json.dumps({"files": files, "users": users}, indent=1)
+
+    def save(self, filename: str = None):
+        """ Export a snapshot to filename, or checkpoint the WAL into the database """
+        if filename is None:
+            self.query_one("PRAGMA wal_checkpoint(TRUNCATE)")
+            return
+
+        with self.locks.all():
+            data = self.snapshot()
+
+        with open(filename, "w") as f:
+            f.write(data)
+
+    def list_files(self, user: str, offset: int, length: int) -> Tuple[List[List[str]], int]:
+        """ A page of the (filename, owner) a user can read in name order, and their total """
+        listing = [list(row) for row in self.query(LIST_FILES, (user, length, offset))]
+        return listing, self.query_one(COUNT_USER_GRANTS, (user,))[0]
+
+    def close(self):
+        with self._lock:
+            for conn in self._connections.values():
+                conn.close()
+            self._connections.clear()
+        self._local = threading.local()
+
+
+# Metadata backends selectable by name
+backends = {
+    "json": JournaledMetadata,
+    "sqlite": SQLiteMetadata,
+}
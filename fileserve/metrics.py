@@ -0,0 +1,320 @@
+import os
+import sys
+import time
+import bisect
+import functools
+import threading
+import contextlib
+import http.server
+from typing import Callable, List, Tuple
+
+
+# Off until enable() is called, instrumented code then only checks this flag
+enabled = False
+
+# Latency bucket upper bounds in seconds, from 50us to 10s
+BUCKETS = (
+    0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+    0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+# Returned by timed() while disabled
+NULL_TIMER = contextlib.nullcontext()
+
+
+def format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    """ Render a label set such as {stage="decode"} """
+    pairs = [
+        '{}="{}"'.format(
+            name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        )
+        for name, value in zip(names, values)
+    ]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter(object):
+    """ Monotonic count per label set """
+
+    kind = "counter"
+
+    def __init__(self, name: str, doc: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+
+        # label values -> count
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *values: str, amount: float = 1):
+        with self._lock:
+            self._values[values] = self._values.get(values, 0) + amount
+
+    def get(self, *values: str) -> float:
+        return self._values.get(values, 0)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        return [
+            "{}{} {}".format(self.name, format_labels(self.labels, key), value)
+            for key, value in values
+        ]
+
+
+class Histogram(object):
+    """ Distribution of observations per label set over fixed buckets """
+
+    kind = "histogram"
+
+    def __init__(
+        self, name: str, doc: str, labels: Tuple[str, ...] = (), buckets: Tuple = BUCKETS
+    ):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self.buckets = buckets
+
+        # label values -> [per bucket counts with +Inf last, sum]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *values: str):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(values)
+            if series is None:
+                series = self._values[values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][i] += 1
+            series[1] += value
+
+    def count(self, *values: str) -> int:
+        series = self._values.get(values)
+        return sum(series[0]) if series is not None else 0
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = sorted(
+                (key, (list(counts), total)) for key, (counts, total) in self._values.items()
+            )
+
+        lines = []
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                lines.append("{}_bucket{} {}".format(
+                    self.name, format_labels(self.labels, key, 'le="{}"'.format(bound)), cumulative
+                ))
+            lines.append("{}_sum{} {}".format(self.name, format_labels(self.labels, key), total))
+            lines.append("{}_count{} {}".format(
+                self.name, format_labels(self.labels, key), cumulative
+            ))
+        return lines
+
+
+class Registry(object):
+    """ Set of metrics rendered together in the Prometheus text format """
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def clear(self):
+        """ Reset every metric to no observations """
+        for metric in self.metrics:
+            metric.clear()
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.append("# HELP {} {}".format(metric.name, metric.doc))
+            lines.append("# TYPE {} {}".format(metric.name, metric.kind))
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+stage_seconds = registry.register(Histogram(
+    "fileserve_stage_seconds",
+    "Time spent in each stage of request handling, stages may nest",
+    ("stage",),
+))
+request_seconds = registry.register(Histogram(
+    "fileserve_request_seconds",
+    "Time from a request being received to its response and any stream being sent",
+    ("header",),
+))
+requests_total = registry.register(Counter(
+    "fileserve_requests_total", "Requests handled by header and status", ("header", "status")
+))
+rejected_total = registry.register(Counter(
+    "fileserve_rejected_total", "Connections and requests refused while overloaded", ("reason",)
+))
+exceptions_total = registry.register(Counter(
+    "fileserve_exceptions_total", "Connections dropped by an exception", ("type",)
+))
+received_bytes = registry.register(Counter(
+    "fileserve_received_bytes_total", "Bytes of frames received including headers"
+))
+sent_bytes = registry.register(Counter(
+    "fileserve_sent_bytes_total", "Bytes of frames sent including headers"
+))
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+class Timer(object):
+    """ Context manager observing the time spent in a stage """
+
+    __slots__ = ("stage", "start")
+
+    def __init__(self, stage: str):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        stage_seconds.observe(time.perf_counter() - self.start, self.stage)
+
+
+def timed(stage: str):
+    """ Time a block as a stage, a shared no-op while metrics are disabled """
+    if not enabled:
+        return NULL_TIMER
+    return Timer(stage)
+
+
+def instrument(stage: str) -> Callable:
+    """ Decorator timing every call of a function as a stage """
+    def decorate(fn: Callable) -> Callable:
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return fn(*args, **kwargs)
+            with Timer(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def observe(stage: str, seconds: float):
+    if enabled:
+        stage_seconds.observe(seconds, stage)
+
+
+def count_request(header: str, status: str, seconds: float):
+    if enabled:
+        requests_total.inc(header, status)
+        request_seconds.observe(seconds, header)
+
+
+def count_rejected(reason: str):
+    if enabled:
+        rejected_total.inc(reason)
+
+
+def count_exception():
+    """ Count the exception currently being handled by its type """
+    if enabled:
+        exceptions_total.inc(type(sys.exc_info()[1]).__name__)
+
+
+def count_received(size: int):
+    if enabled:
+        received_bytes.inc(amount=size)
+
+
+def count_sent(size: int):
+    if enabled:
+        sent_bytes.inc(amount=size)
+
+
+def render() -> str:
+    return registry.render()
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """ Serve the registry on GET /metrics """
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(address: Tuple[str, int]) -> http.server.ThreadingHTTPServer:
+    """ Enable metrics and serve them over HTTP from a background thread
+
+    Shut the returned server down to stop serving.
+    """
+    enable()
+    server = http.server.ThreadingHTTPServer(address, MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def dump_every(path: str, interval: float) -> Callable[[], None]:
+    """ Enable metrics and write them to path every interval seconds
+
+    The file is replaced atomically, so it can be picked up by a textfile
+    collector. Call the returned function to stop after a last dump.
+    """
+    enable()
+    stopped = threading.Event()
+    tmp_path = os.path.join(os.path.dirname(os.path.abspath(path)), ".metrics.tmp")
+
+    def write():
+        with open(tmp_path, "w") as f:
+            f.write(render())
+        os.replace(tmp_path, path)
+
+    def dump():
+        while not stopped.wait(interval):
+            write()
+        write()
+
+    thread = threading.Thread(target=dump, daemon=True)
+    thread.start()
+
+    def stop():
+        stopped.set()
+        thread.join()
+
+    return stop
@@ -0,0 +1,125 @@
+from typing import Callable, Dict
+
+from fileserve import protocol
+from fileserve import streaming
+from fileserve import compression
+from fileserve import error_handling
+
+
+# header -> Operation
+registry = {}
+
+
+class Operation(object):
+    """ How one request header is checked, locked and performed """
+
+    __slots__ = ("header", "validate", "handle", "lock")
+
+    def __init__(self, header: str, validate: Callable, handle: Callable, lock: str):
+        self.header = header
+        self.validate = validate
+        self.handle = handle
+        self.lock = lock
+
+
+def operation(header: str, validate: Callable, lock: str = "file"):
+    """ Register a handler for a request header along with its validator
+
+    The validator is called with the request data, users, files and the
+    upload the request names, and returns an error or "" if the request
+    can go ahead. The handler is then called with the database, channel
+    and request and returns the response. Requests lock their file, or
+    their user with lock="user".
+    """
+    def register(handle: Callable) -> Callable:
+        if header in registry:
+            raise ValueError("operation {} is already registered".format(header))
+
+        registry[header] = Operation(header, validate, handle, lock)
+        return handle
+    return register
+
+
+@operation("upload_file", error_handling.check_upload_file)
+def upload_file(database, channel: protocol.Channel, request: Dict) -> Dict:
+    data = request["data"]
+
+    if data["stream"] and data["upload_id"]:
+        return database.upload_resumable(
+            data["upload_id"],
+            streaming.recv_chunks(channel, data["key"], data["offset"]),
+            data["digest"],
+        )
+
+    if data["stream"]:
+        return database.upload_stream(
+            data["user1"],
+            data["filename"],
+            streaming.recv_chunks(channel, data["key"]),
+            data["size"],
+            data["digest"],
+        )
+
+    return database.upload_file(
+        data["user1"],
+        data["filename"],
+        compression.decompress(data["data"], data["compression"], protocol.MAX_FRAME_SIZE),
+    )
+
+
+@operation("download_file", error_handling.check_download_file)
+def download_file(database, channel: protocol.Channel, request: Dict) -> Dict:
+    data = request["data"]
+
+    if data["stream"]:
+        return database.download_stream(
+            data["user1"], data["filename"], data["offset"], data["length"]
+        )
+
+    response = database.download_file(data["user1"], data["filename"])
+    response["data"]["compression"], response["data"]["data"] = compression.compress(
+        response["data"]["data"], data["compression"]
+    )
+    return response
+
+
+@operation("upload_status", error_handling.check_upload_status)
+def upload_status(database, channel: protocol.Channel, request: Dict) -> Dict:
+    return database.upload_status(request["data"]["user1"], request["data"]["upload_id"])
+
+
+@operation("file_signature", error_handling.check_file_signature)
+def file_signature(database, channel: protocol.Channel, request: Dict) -> Dict:
+    return database.file_signature(request["data"]["user1"], request["data"]["filename"])
+
+
+@operation("update_file", error_handling.check_update_file)
+def update_file(database, channel: protocol.Channel, request: Dict) -> Dict:
+    data = request["data"]
+    return database.update_file(data["user1"], data["filename"], data["data"], data["digest"])
+
+
+@operation("delete_file", error_handling.check_delete_file)
+def delete_file(database, channel: protocol.Channel, request: Dict) -> Dict:
+    return database.delete_file(request["data"]["user1"], request["data"]["filename"])
+
+
+@operation("share_file", error_handling.check_share_file)
+def share_file(database, channel: protocol.Channel, request: Dict) -> Dict:
+    return database.share_file(request["data"]["user2"], request["data"]["filename"])
+
+
+@operation("revoke_access", error_handling.check_revoke_access)
+def revoke_access(database, channel: protocol.Channel, request: Dict) -> Dict:
+    return database.revoke_access(request["data"]["user2"], request["data"]["filename"])
+
+
+@operation("list_files", error_handling.check_list_files, lock="user")
+def list_files(database, channel: protocol.Channel, request: Dict) -> Dict:
+    data = request["data"]
+    return database.list_files(data["user1"], data["offset"], data["length"])
+
+
+@operation("add_user", error_handling.check_add_user, lock="user")
+def add_user(database, channel: protocol.Channel, request: Dict) -> Dict:
+    return database.add_user(request["data"]["user1"], request["data"]["data"])
@@ -0,0 +1,241 @@
+import os
+import time
+import queue
+import signal
+import socket
+import logging
+import threading
+import multiprocessing
+from typing import Callable, Dict, Tuple
+
+from fileserve import crypto
+from fileserve.server import FileServer
+from fileserve.aio_server import AsyncFileServer
+from fileserve.database import Database
+from fileserve.session import SessionManager
+from fileserve.admission import AdmissionControl
+
+
+log = logging.getLogger(__name__)
+
+# Seconds to wait for workers to start serving or to exit
+START_TIMEOUT = 60.0
+STOP_TIMEOUT = 30.0
+
+
+def listen(
+    address: Tuple[str, int], reuse_port: bool = False, backlog: int = 128, activate: bool = True
+) -> socket.socket:
+    """ Bind a TCP socket, joining the port's SO_REUSEPORT group if reuse_port is set """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(address)
+        if activate:
+            sock.listen(backlog)
+    except BaseException:
+        sock.close()
+        raise
+    return sock
+
+
+def serve_worker(
+    index: int,
+    address: Tuple[str, int],
+    sock: socket.socket,
+    engine: str,
+    options: Dict,
+    ticket_key: bytes,
+    max_workers: int,
+    max_streams: int,
+    admission_options: Dict,
+    initializer: Callable,
+    ready: multiprocessing.Queue,
+):
+    """ Entry point of a worker process, serves until it receives SIGTERM """
+    # Ctrl-C reaches the whole process group, the parent coordinates shutdown
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    # Each worker is stopped on its own, so one that died never holds up the rest
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    cleanup = initializer(index) if initializer is not None else None
+
+    if sock is None:
+        sock = listen(address, reuse_port=True)
+
+    database = Database(shared=True, **options)
+    sessions = SessionManager(ticket_key=ticket_key)
+    admission = AdmissionControl(**admission_options)
+    if engine == "asyncio":
+        server = AsyncFileServer(
+            database,
+            address,
+            max_workers=max_workers,
+            sessions=sessions,
+            sock=sock,
+            admission=admission,
+            max_streams=max_streams,
+        )
+    else:
+        server = FileServer(database, address, sessions=sessions, sock=sock, admission=admission)
+
+    t = threading.Thread(target=server.serve_forever, daemon=True)
+    t.start()
+    log.info("worker serving", extra={"worker": index, "pid": os.getpid()})
+    ready.put(index)
+
+    stop.wait()
+    server.shutdown()
+    server.server_close()
+    database.close()
+
+    if cleanup is not None:
+        cleanup()
+
+
+class PreforkServer(object):
+    """ Several processes serving one port, so RSA/AES work scales past the GIL
+
+    Workers are started up front with the spawn method and each runs a
+    FileServer or AsyncFileServer over a Database opened with shared=True,
+    which keeps the metadata in SQLite and locks across processes. Where
+    the platform has SO_REUSEPORT each worker listens on its own socket
+    and the kernel spreads connections between them, otherwise they
+    accept from one inherited socket. Sessions can resume on any worker
+    as they share the ticket key.
+
+    The parent only supervises, restarting workers that die, and saves
+    the database once they have all stopped.
+    """
+
+    def __init__(
+        self,
+        database_options: Dict = None,
+        server_address=("localhost", 60000),
+        processes: int = None,
+        engine: str = "thread",
+        max_workers: int = None,
+        initializer: Callable = None,
+        reuse_port: bool = None,
+        admission_options: Dict = None,
+        max_streams: int = None,
+    ):
+        """ database_options are passed to each worker's Database
+
+        admission_options are passed to each worker's AdmissionControl, so
+        its limits apply per worker. initializer is called first thing in
+        each worker with its index, and may return a function to call when
+        the worker exits. It must be picklable, such as a module level
+        function.
+        """
+        self.database_options = dict(database_options or {}, metadata="sqlite")
+        self.processes = processes or os.cpu_count() or 1
+        self.engine = engine
+        self.max_workers = max_workers
+        self.max_streams = max_streams
+        self.admission_options = admission_options or {}
+        self.initializer = initializer
+        self.reuse_port = hasattr(socket, "SO_REUSEPORT") if reuse_port is None else reuse_port
+
+        # Generate keys and recover uploads once before the workers share them
+        Database(shared=True, **self.database_options).close()
+
+        # With SO_REUSEPORT the parent only holds the port, it never listens
+        self.socket = listen(server_address, self.reuse_port, activate=not self.reuse_port)
+        self.server_address = self.socket.getsockname()[:2]
+
+        self.context = multiprocessing.get_context("spawn")
+        self.ticket_key = crypto.get_random_bytes(crypto.AES_KEY_SIZE)
+        self.ready = self.context.Queue()
+        self._stopping = threading.Event()
+
+        self.workers = [self.spawn(i) for i in range(self.processes)]
+        try:
+            self.wait_ready(self.processes)
+        except BaseException:
+            self.server_close()
+            raise
+
+    def spawn(self, index: int) -> multiprocessing.Process:
+        process = self.context.Process(
+            target=serve_worker,
+            args=(
+                index,
+                self.server_address,
+                None if self.reuse_port else self.socket,
+                self.engine,
+                self.database_options,
+                self.ticket_key,
+                self.max_workers,
+                self.max_streams,
+                self.admission_options,
+                self.initializer,
+                self.ready,
+            ),
+            name="fileserve-worker-{}".format(index),
+            daemon=True,
+        )
+        process.start()
+        return process
+
+    def wait_ready(self, count: int):
+        """ Wait for count workers to start serving, failing if one exits first """
+        deadline = time.monotonic() + START_TIMEOUT
+        started = 0
+        while started < count:
+            try:
+                self.ready.get(timeout=0.1)
+            except queue.Empty:
+                for process in self.workers:
+                    if process.exitcode is not None:
+                        raise RuntimeError("worker exited with code {} while starting".format(
+                            process.exitcode
+                        ))
+                if time.monotonic() > deadline:
+                    raise RuntimeError("workers did not start within {}s".format(START_TIMEOUT))
+                continue
+            started += 1
+
+    def serve_forever(self, poll_interval: float = 0.5):
+        """ Restart workers that exit until shutdown is called """
+        while not self._stopping.wait(poll_interval):
+            for i, process in enumerate(self.workers):
+                if process.is_alive() or self._stopping.is_set():
+                    continue
+
+                log.error("worker exited, restarting it", extra={
+                    "worker": i, "pid": process.pid, "code": process.exitcode
+                })
+                self.workers[i] = self.spawn(i)
+                self.wait_ready(1)
+
+    def shutdown(self, filename=None):
+        """ Stop the workers and serve_forever, then save the database """
+        self._stopping.set()
+        for process in self.workers:
+            if process.is_alive():
+                process.terminate()
+        for process in self.workers:
+            process.join(STOP_TIMEOUT)
+            if process.is_alive():
+                log.error("worker did not stop, killing it", extra={"pid": process.pid})
+                process.kill()
+                process.join()
+
+        database = Database(shared=True, **self.database_options)
+        try:
+            database.save(filename)
+        finally:
+            database.close()
+
+    def server_close(self):
+        """ Close the listening socket and kill any workers left """
+        self._stopping.set()
+        self.socket.close()
+        for process in self.workers:
+            if process.is_alive():
+                process.kill()
+                process.join()
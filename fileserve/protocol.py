@@ -0,0 +1,376 @@
+import time
+import socket
+import select
+import struct
+import asyncio
+from typing import Tuple
+
+from fileserve import metrics
+
+
+# Frame header: magic, version, message type, flags, payload length
+MAGIC = b"FSRV"
+VERSION = 1
+HEADER = struct.Struct("!4sBBHQ")
+HEADER_SIZE = HEADER.size
+
+# Message types
+MSG_REQUEST = 1
+MSG_RESPONSE = 2
+MSG_CHUNK = 3
+MSG_HELLO = 4
+MSG_WELCOME = 5
+
+# Flags
+FLAG_FINAL = 1
+FLAG_SESSION = 2
+FLAG_ZLIB = 4
+FLAG_LZMA = 8
+
+# Payloads below this size are sent in the same write as their header
+COALESCE_SIZE = 64 * 1024
+
+# Largest payload accepted from a peer and the size of each recv_into call
+MAX_FRAME_SIZE = 1 << 30
+RECV_CHUNK_SIZE = 1 << 20
+
+
+class ProtocolError(Exception):
+    """ Raised when a peer sends a malformed frame or hangs up mid frame """
+
+
+class ConnectionClosed(ProtocolError):
+    """ Raised when a peer hangs up cleanly between frames """
+
+
+def pack_header(msg_type: int, length: int, flags: int = 0) -> bytes:
+    """ Build the fixed width header for a frame """
+    return HEADER.pack(MAGIC, VERSION, msg_type, flags, length)
+
+
+def unpack_header(header: bytes) -> Tuple[int, int, int]:
+    """ Validate a frame header and return (msg_type, flags, length) """
+    magic, version, msg_type, flags, length = HEADER.unpack(header)
+
+    if magic != MAGIC:
+        raise ProtocolError("bad magic {!r}".format(magic))
+
+    if version != VERSION:
+        raise ProtocolError("unsupported protocol version {}".format(version))
+
+    return msg_type, flags, length
+
+
+def send_frame(
+    s: socket.socket, payload: bytes, msg_type: int, flags: int = 0, timeout: float = None
+):
+    """ Send a single frame, within timeout seconds if one is given """
+    header = pack_header(msg_type, len(payload), flags)
+
+    # sendall's timeout bounds the whole call rather than each send
+    idle = s.gettimeout()
+    if timeout is not None:
+        s.settimeout(timeout)
+
+    try:
+        with metrics.timed("send"):
+            if len(payload) < COALESCE_SIZE:
+                s.sendall(header + payload)
+            else:
+                s.sendall(header)
+                s.sendall(payload)
+    finally:
+        if timeout is not None:
+            s.settimeout(idle)
+
+    metrics.count_sent(HEADER_SIZE + len(payload))
+
+
+def recv_exact(
+    s: socket.socket,
+    length: int,
+    chunksize: int = RECV_CHUNK_SIZE,
+    timeout: float = None,
+    into: bytearray = None,
+) -> bytearray:
+    """ Receive exactly length bytes into a single preallocated buffer
+
+    With a timeout every byte must arrive within timeout seconds of the
+    call, so a peer can't hold the connection by trickling data. Passing
+    into reuses it as the buffer, overwriting it from the start.
+    """
+    data = bytearray(length) if into is None else into
+    view = memoryview(data)[:length]
+    received = 0
+
+    idle = s.gettimeout()
+    deadline = time.monotonic() + timeout if timeout is not None else None
+
+    try:
+        while received < length:
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise socket.timeout("read deadline passed")
+                s.settimeout(remaining)
+
+            n = s.recv_into(view[received:received + chunksize])
+            if n == 0:
+                if received == 0:
+                    raise ConnectionClosed("connection closed")
+                raise ProtocolError(
+                    "connection closed with {} of {} bytes outstanding".format(
+                        length - received, length
+                    )
+                )
+            received += n
+    finally:
+        if deadline is not None:
+            s.settimeout(idle)
+
+    return data
+
+
+def recv_header(s: socket.socket, max_size: int = MAX_FRAME_SIZE) -> Tuple[int, int, int]:
+    """ Receive a frame header and return (msg_type, flags, length) """
+    msg_type, flags, length = unpack_header(recv_exact(s, HEADER_SIZE))
+
+    if length > max_size:
+        raise ProtocolError(
+            "frame of {} bytes exceeds the maximum of {} bytes".format(length, max_size)
+        )
+
+    return msg_type, flags, length
+
+
+def recv_payload(s: socket.socket, length: int, timeout: float = None) -> bytearray:
+    """ Receive the payload of a frame whose header was received """
+    # Time only the payload, the wait for the header includes idle time
+    start = time.perf_counter()
+    try:
+        payload = recv_exact(s, length, timeout=timeout)
+    except ConnectionClosed:
+        raise ProtocolError("connection closed before a {} byte payload".format(length))
+
+    metrics.observe("recv", time.perf_counter() - start)
+    metrics.count_received(HEADER_SIZE + length)
+    return payload
+
+
+def skip_payload(s: socket.socket, length: int, timeout: float = None):
+    """ Receive and discard the payload of a frame without buffering all of it """
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    buffer = bytearray(min(length, RECV_CHUNK_SIZE))
+
+    while length > 0:
+        size = min(length, len(buffer))
+        remaining = deadline - time.monotonic() if deadline is not None else None
+        try:
+            recv_exact(s, size, timeout=remaining, into=buffer)
+        except ConnectionClosed:
+            raise ProtocolError("connection closed before a {} byte payload".format(length))
+        length -= size
+
+
+def recv_frame(
+    s: socket.socket, max_size: int = MAX_FRAME_SIZE, timeout: float = None
+) -> Tuple[int, int, bytearray]:
+    """ Receive a single frame and return (msg_type, flags, payload)
+
+    With a timeout the payload must arrive within timeout seconds of the header.
+    """
+    msg_type, flags, length = recv_header(s, max_size)
+    return msg_type, flags, recv_payload(s, length, timeout)
+
+
+def linger(s: socket.socket, timeout: float):
+    """ Finish sending and discard what the peer still sends for up to timeout seconds
+
+    Closing with unread data resets the connection, which can lose the
+    last reply before the peer reads it.
+    """
+    deadline = time.monotonic() + timeout
+    try:
+        s.shutdown(socket.SHUT_WR)
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            s.settimeout(remaining)
+            if not s.recv(RECV_CHUNK_SIZE):
+                return
+    except OSError:
+        pass
+
+
+class Channel(object):
+    """ Framed message channel over a blocking socket
+
+    The request processing code only talks to a Channel so the same code
+    can run behind the threaded and the asyncio server engines.
+    """
+
+    def __init__(self, s: socket.socket, max_frame_size: int = MAX_FRAME_SIZE):
+        self.socket = s
+        self.max_frame_size = max_frame_size
+        self.session = None
+
+        # Set by the server's admission control, see fileserve.admission
+        self.read_timeout = None
+        self.write_timeout = None
+        self.user = None
+        self.reserved = (None, 0)
+        self.skip_chunks = False
+
+    def close(self):
+        self.socket.close()
+
+    def is_stale(self) -> bool:
+        """ Check without blocking whether an idle connection was hung up
+
+        Between requests the peer never sends anything unprompted, so an
+        idle connection that is readable has been closed or is out of sync.
+        """
+        readable, _, _ = select.select([self.socket], [], [], 0)
+        return bool(readable)
+
+    def send_frame(self, payload: bytes, msg_type: int, flags: int = 0):
+        send_frame(self.socket, payload, msg_type, flags, self.write_timeout)
+
+    def recv_frame(self, max_size: int = None) -> Tuple[int, int, bytearray]:
+        return recv_frame(self.socket, max_size or self.max_frame_size, self.read_timeout)
+
+    def recv_header(self) -> Tuple[int, int, int]:
+        return recv_header(self.socket, self.max_frame_size)
+
+    def recv_payload(self, length: int) -> bytearray:
+        return recv_payload(self.socket, length, self.read_timeout)
+
+    def skip_payload(self, length: int):
+        skip_payload(self.socket, length, self.read_timeout)
+
+    def begin_stream(self) -> str:
+        """ Called before a streamed transfer, returns why it can't start or "" """
+        return ""
+
+    def end_stream(self):
+        """ Called once a streamed transfer is done with its client, before its last frame """
+
+    def expect_frame(self, msg_type: int, max_size: int = None) -> bytearray:
+        received_type, _, payload = self.recv_frame(max_size)
+
+        if received_type != msg_type:
+            raise ProtocolError(
+                "expected message type {} but received {}".format(msg_type, received_type)
+            )
+
+        return payload
+
+
+async def read_exactly(reader: asyncio.StreamReader, length: int, timeout: float = None) -> bytes:
+    """ readexactly with the errors of recv_exact, within timeout seconds if one is given """
+    try:
+        if timeout is None:
+            return await reader.readexactly(length)
+        return await asyncio.wait_for(reader.readexactly(length), timeout)
+    except asyncio.TimeoutError:
+        raise socket.timeout("read deadline passed")
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            raise ConnectionClosed("connection closed")
+        raise ProtocolError(
+            "connection closed with {} bytes outstanding".format(e.expected - len(e.partial))
+        )
+
+
+async def recv_header_async(
+    reader: asyncio.StreamReader, max_size: int = MAX_FRAME_SIZE
+) -> Tuple[int, int, int]:
+    """ Receive a frame header from an asyncio stream """
+    msg_type, flags, length = unpack_header(await read_exactly(reader, HEADER_SIZE))
+
+    if length > max_size:
+        raise ProtocolError(
+            "frame of {} bytes exceeds the maximum of {} bytes".format(length, max_size)
+        )
+
+    return msg_type, flags, length
+
+
+async def recv_payload_async(
+    reader: asyncio.StreamReader, length: int, timeout: float = None
+) -> bytes:
+    """ Receive the payload of a frame whose header was received """
+    start = time.perf_counter()
+    try:
+        payload = await read_exactly(reader, length, timeout)
+    except ConnectionClosed:
+        raise ProtocolError("connection closed before a {} byte payload".format(length))
+
+    metrics.observe("recv", time.perf_counter() - start)
+    metrics.count_received(HEADER_SIZE + length)
+    return payload
+
+
+async def skip_payload_async(reader: asyncio.StreamReader, length: int, timeout: float = None):
+    """ Receive and discard the payload of a frame without buffering all of it """
+    deadline = time.monotonic() + timeout if timeout is not None else None
+
+    while length > 0:
+        size = min(length, RECV_CHUNK_SIZE)
+        remaining = deadline - time.monotonic() if deadline is not None else None
+        if remaining is not None and remaining <= 0:
+            raise socket.timeout("read deadline passed")
+        try:
+            await read_exactly(reader, size, remaining)
+        except ConnectionClosed:
+            raise ProtocolError("connection closed before a {} byte payload".format(length))
+        length -= size
+
+
+async def recv_frame_async(
+    reader: asyncio.StreamReader, max_size: int = MAX_FRAME_SIZE, timeout: float = None
+) -> Tuple[int, int, bytes]:
+    """ Receive a single frame from an asyncio stream
+
+    With a timeout the payload must arrive within timeout seconds of the header.
+    """
+    msg_type, flags, length = await recv_header_async(reader, max_size)
+    return msg_type, flags, await recv_payload_async(reader, length, timeout)
+
+
+async def send_frame_async(
+    writer: asyncio.StreamWriter,
+    payload: bytes,
+    msg_type: int,
+    flags: int = 0,
+    timeout: float = None,
+):
+    """ Send a single frame to an asyncio stream, within timeout seconds if one is given """
+    start = time.perf_counter()
+    writer.write(pack_header(msg_type, len(payload), flags))
+    writer.write(payload)
+    try:
+        if timeout is None:
+            await writer.drain()
+        else:
+            await asyncio.wait_for(writer.drain(), timeout)
+    except asyncio.TimeoutError:
+        raise socket.timeout("write deadline passed")
+    metrics.observe("send", time.perf_counter() - start)
+    metrics.count_sent(HEADER_SIZE + len(payload))
+
+
+async def linger_async(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, timeout: float):
+    """ Like linger for asyncio streams """
+    deadline = time.monotonic() + timeout
+    try:
+        writer.write_eof()
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            if not await asyncio.wait_for(reader.read(RECV_CHUNK_SIZE), remaining):
+                return
+    except (OSError, asyncio.TimeoutError):
+        pass
@@ -1,180 +1,411 @@
-import os
 import time
-import pickle
+import socket
+import logging
 import socketserver
-from typing import Dict
+from typing import Dict, Iterator, Tuple
 
+from fileserve import logs
 from fileserve import utils
+from fileserve import metrics
+from fileserve import codec
+from fileserve import protocol
+from fileserve import streaming
+from fileserve import operations
+from fileserve.session import SessionManager
+from fileserve.admission import AdmissionControl, OVERLOADED, REFUSED_FRAME_SIZE, LINGER_TIMEOUT
 
 
+log = logging.getLogger(__name__)
+
 SUCCESS = 0
 FAILURE = 1
 
-request_template = {
-    "header": "",
-    "sender": "",
-    "mac": "",
-    "data": {
-        "filename": "",
-        "user1": "",
-        "user2": "",
-        "data": ""
-    },
-}
-
-response_template = {
-    "header": "failure",
-    "mac": "",
-    "data": {
-        "filename": "",
-        "data": "",
-        "error": ""
-    },
-}
+def new_request() -> codec.Request:
+    """ A blank request with empty request data """
+    return codec.Request(data=codec.RequestData())
 
 
-class RequestHandler(socketserver.StreamRequestHandler):
+def new_response(header: str = "failure") -> codec.Response:
+    """ A blank response with empty response data """
+    return codec.Response(header=header, data=codec.ResponseData())
 
-    def handle(self):
-        """ Receive data, process, and return a response """
-        print("\nHandling New Request")
-        data = self.recvall(chunksize=64)
 
-        # Unpickle data
-        request = utils.deserialize(data)
+class RequestProcessor(object):
+    """ Transport independent request handling shared by the server engines """
 
-        # Decrypt data
-        if request["header"] != "add_user":
-            request = self.server.database.decrypt_request(request)
-            print(request)
+    def __init__(
+        self, database, sessions: SessionManager = None, admission: AdmissionControl = None
+    ):
+        self.database = database
+        self.sessions = sessions if sessions is not None else SessionManager()
+        self.admission = admission if admission is not None else AdmissionControl()
 
-        # Process request and generate a response
-        response = self.process_request(request)
+    def handle_frame(self, channel: protocol.Channel, msg_type: int, flags: int, data: bytes):
+        """ Dispatch a frame received between requests """
+        if msg_type == protocol.MSG_HELLO:
+            self.handshake(channel, data)
 
-        # Encrypt data in response
-        if request["header"] != "add_user":
-            response = self.server.database.encrypt_response(
-                request["sender"],
-                response
-            )
-            print(response)
-
-        # Pickle the response
-        response = utils.serialize(response)
-
-        # Send the respone
-        self.send(response)
-
-    def send(self, response: bytes):
-        """ Send response data """
-        self.sendlen(response)
-        self.request.send(response)
-
-    def sendlen(self, response: bytes):
-        """ Send the length of the data first """
-        length = str(len(response)).encode()
-        self.request.send(length)
-        time.sleep(0.05)
-
-    def recvlen(self) -> int:
-        """ Receive length of data to be received """
-        length = self.request.recv(32)
-        length = int(length.decode())
-        return length
-
-    def recvall(self, chunksize: int = 8192) -> bytes:
-        """ Receive entirety of data """
-        length = self.recvlen()
-        data = b""
-        
-        while len(data) < length:
-            received = self.request.recv(chunksize)
-
-            if not received:
-                break
-            else:
-                data += received
-
-        return data
-
-    def process_request(self, request: Dict) -> Dict:
-        """ Main function to parse received data and call other functions """
+        elif msg_type == protocol.MSG_REQUEST:
+            self.handle(channel, data, flags)
 
-        # Check for errors in request
-        signal, response = self.server.database.error_check(request)
+        elif msg_type == protocol.MSG_CHUNK and channel.skip_chunks:
+            # The rest of an upload that was refused
+            channel.skip_chunks = not flags & protocol.FLAG_FINAL
 
-        if signal == FAILURE:
-            print("Error check returned an issue")
-            return response
-
-        if request["header"] == "upload_file":
-            response = self.server.database.upload_file(
-                request["data"]["user1"],
-                request["data"]["filename"],
-                request["data"]["data"],
+        else:
+            raise protocol.ProtocolError(
+                "expected a request but received message type {}".format(msg_type)
             )
-            print(
-                "User {} uploaded file {}".format(
-                request["data"]["user1"],
-                request["data"]["filename"],
-            ))
-
-        elif request["header"] == "download_file":
-            response = self.server.database.download_file(
-                request["data"]["user1"], request["data"]["filename"]
+
+    def refusal(self, channel: protocol.Channel, msg_type: int, flags: int, reason: str):
+        """ The reply to a frame refused by admission control as (msg_type, payload)
+
+        Replies are neither encrypted nor sealed so refusing costs no
+        crypto. Returns None for chunks of a refused upload, which need no
+        reply.
+        """
+        if msg_type == protocol.MSG_HELLO:
+            return protocol.MSG_WELCOME, utils.serialize(codec.Welcome(error=OVERLOADED))
+
+        if msg_type == protocol.MSG_REQUEST:
+            # Keep the session's counter in step with the peer's
+            if flags & protocol.FLAG_SESSION and channel.session is not None:
+                channel.session.skip()
+
+            # An upload's chunks follow its request and are skipped
+            channel.skip_chunks = True
+            response = new_response(OVERLOADED)
+            response["data"]["error"] = reason
+            return protocol.MSG_RESPONSE, utils.serialize(response)
+
+        if msg_type == protocol.MSG_CHUNK and channel.skip_chunks:
+            channel.skip_chunks = not flags & protocol.FLAG_FINAL
+            return None
+
+        raise protocol.ProtocolError(
+            "expected a request but received message type {}".format(msg_type)
+        )
+
+    def refuse(self, channel: protocol.Channel, msg_type: int, flags: int, reason: str):
+        """ Reply to a refused frame """
+        reply = self.refusal(channel, msg_type, flags, reason)
+        if reply is not None:
+            channel.send_frame(reply[1], reply[0])
+
+    def handshake(self, channel: protocol.Channel, data: bytes):
+        """ Establish a session so later requests on the channel skip RSA """
+        channel.session, welcome = self.sessions.accept(
+            data, self.database.priv_key, self.database.load_user_key
+        )
+
+        # Sessions are authenticated so count the connection against its user
+        if channel.session is not None:
+            reason = self.admission.attach(channel, channel.session.user)
+            if reason:
+                channel.session = None
+                self.refuse(channel, protocol.MSG_HELLO, 0, reason)
+                return
+
+        channel.send_frame(welcome, protocol.MSG_WELCOME)
+
+        if channel.session is not None:
+            log.debug("session established", extra={"user": channel.session.user})
+
+    def handle(self, channel: protocol.Channel, data: bytes, flags: int = 0):
+        """ Process a received request and send back a response """
+        start = time.perf_counter()
+        session = None
+        channel.skip_chunks = False
+
+        if flags & protocol.FLAG_SESSION:
+            # Requests in a session are sealed with the session key
+            session = channel.session
+            if session is None:
+                raise protocol.ProtocolError("session request before a handshake")
+
+            with metrics.timed("decrypt"):
+                data = session.open(data)
+            with metrics.timed("decode"):
+                request = utils.deserialize(data, codec.Request)
+            if request["sender"] != session.user:
+                raise protocol.ProtocolError(
+                    "sender {} does not match session user {}".format(
+                        request["sender"], session.user
+                    )
+                )
+
+        else:
+            # Decode data
+            with metrics.timed("decode"):
+                request = utils.deserialize(data, codec.Request)
+
+            # Refuse floods of an operation before paying for RSA
+            reason = self.admission.admit_operation(request["header"])
+            if reason:
+                return self.refuse_request(channel, request, reason, start)
+
+            # Decrypt data
+            if request["header"] != "add_user":
+                with metrics.timed("decrypt"):
+                    request = self.database.decrypt_request(request)
+
+        if not isinstance(request["data"], codec.RequestData):
+            raise protocol.ProtocolError("{} request is not encrypted".format(request["header"]))
+
+        # Operations act as user1, which must be the user the request is authenticated as
+        if request["header"] != "add_user" and request["data"]["user1"] != request["sender"]:
+            raise protocol.ProtocolError(
+                "user1 {} does not match sender {}".format(
+                    request["data"]["user1"], request["sender"]
+                )
             )
-            print(
-                "User {} downloaded a file {}".format(
-                request["data"]["user1"],
-                request["data"]["filename"],
-            ))
-
-        elif request["header"] == "delete_file":
-            response = self.server.database.delete_file(
-                request["data"]["user1"], request["data"]["filename"]
+
+        # The sender is authenticated now, add_user aside
+        reason = ""
+        if session is not None:
+            reason = self.admission.admit_operation(request["header"])
+        if not reason and request["header"] != "add_user":
+            reason = self.admission.admit_user(channel, request["sender"])
+        if not reason and request["data"]["stream"]:
+            reason = channel.begin_stream()
+        if reason:
+            return self.refuse_request(channel, request, reason, start)
+
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("request", extra=logs.summarize(request))
+
+        # Process request and generate a response
+        chunks = None
+        try:
+            response, chunks = self.execute(channel, request)
+        finally:
+            # Uploads are received by now, downloads end theirs before the final chunk
+            if chunks is None:
+                channel.end_stream()
+        offset = response["data"]["offset"]
+        status, error = response["header"], response["data"]["error"]
+        size = response["data"]["size"] or len(response["data"]["data"])
+
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("response", extra=logs.summarize(response))
+
+        if session is not None:
+            with metrics.timed("encrypt"):
+                response = session.seal(utils.serialize(response))
+            channel.send_frame(response, protocol.MSG_RESPONSE, protocol.FLAG_SESSION)
+
+        else:
+            # Encrypt data in response
+            if request["header"] != "add_user":
+                with metrics.timed("encrypt"):
+                    response = self.database.encrypt_response(
+                        request["sender"],
+                        response
+                    )
+
+            # Encode the response
+            with metrics.timed("encode"):
+                response = utils.serialize(response)
+
+            # Send the respone
+            channel.send_frame(response, protocol.MSG_RESPONSE)
+
+        # Stream the file contents after the response
+        if chunks is not None:
+            try:
+                streaming.send_chunks(
+                    channel, request["data"]["key"], chunks, offset, request["data"]["compression"]
+                )
+            finally:
+                channel.end_stream()
+
+        elapsed = time.perf_counter() - start
+        metrics.count_request(request["header"], status, elapsed)
+
+        if log.isEnabledFor(logging.INFO):
+            log.info(
+                "%s %s",
+                request["header"],
+                status,
+                extra={
+                    "user": request["sender"],
+                    "file": request["data"]["filename"],
+                    "error": error,
+                    "bytes": size or request["data"]["size"] or len(request["data"]["data"]),
+                    "ms": round(elapsed * 1000, 3),
+                },
             )
-            print(
-                "User {} deleted file {}".format(
-                request["data"]["user1"],
-                request["data"]["filename"],
-            ))
-
-        elif request["header"] == "share_file":
-            response = self.server.database.share_file(
-                request["data"]["user2"],
-                request["data"]["filename"],
+
+    def refuse_request(self, channel: protocol.Channel, request: Dict, reason: str, start: float):
+        """ Reply to a request refused once it was opened or decoded """
+        # Without the session flag as a sealed request was opened already
+        self.refuse(channel, protocol.MSG_REQUEST, 0, reason)
+
+        metrics.count_request(request["header"], OVERLOADED, time.perf_counter() - start)
+        if log.isEnabledFor(logging.INFO):
+            log.info(
+                "%s %s",
+                request["header"],
+                OVERLOADED,
+                extra={"user": request["sender"], "error": reason},
             )
-            print(
-                "User {} shared a file {} with user {}".format(
-                request["data"]["user1"],
-                request["data"]["filename"],
-                request["data"]["user2"]
-            ))
-
-        elif request["header"] == "add_user":
-            response = self.server.database.add_user(
-                request["data"]["user1"], request["data"]["data"]
+
+    def process_request(self, channel: protocol.Channel, request: Dict) -> Dict:
+        """ Main function to parse received data and call other functions """
+        return self.execute(channel, request)[0]
+
+    def execute(self, channel: protocol.Channel, request: Dict) -> Tuple[Dict, Iterator[bytes]]:
+        """ Check and apply a request atomically with respect to its file
+
+        Returns the response and, for streamed downloads, the file contents
+        which were opened while the file was locked. Streamed uploads with
+        an upload ID are recorded so they can be resumed if interrupted.
+        """
+        header = request["header"]
+        filename = request["data"]["filename"]
+        chunks = None
+
+        with self.database.locked(request):
+            # Check for errors in request
+            with metrics.timed("check"):
+                signal, response = self.database.error_check(request)
+
+            if signal == SUCCESS and header != "upload_file":
+                with metrics.timed("apply"):
+                    response = self.apply(channel, request)
+                if header == "download_file" and response["data"]["stream"]:
+                    chunks = self.database.read_chunks(
+                        filename, response["data"]["offset"], response["data"]["size"]
+                    )
+                return response, chunks
+
+            # Claim the name so the upload can be received without the lock
+            resumable = request["data"]["stream"] and request["data"]["upload_id"] != ""
+            if signal == SUCCESS and resumable:
+                self.database.begin_upload(request)
+            elif signal == SUCCESS:
+                self.database.reserve(filename)
+
+        if signal == FAILURE:
+            if header == "upload_file" and request["data"]["stream"]:
+                streaming.drain_chunks(channel)
+            return response, chunks
+
+        # Resumable uploads keep their claim until they complete or expire
+        if resumable:
+            with metrics.timed("apply"):
+                return self.apply(channel, request), chunks
+
+        try:
+            with metrics.timed("apply"):
+                return self.apply(channel, request), chunks
+        finally:
+            self.database.release(filename)
+
+    def apply(self, channel: protocol.Channel, request: Dict) -> Dict:
+        """ Perform a request which has passed error checking """
+        return operations.registry[request["header"]].handle(self.database, channel, request)
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        socketserver.StreamRequestHandler.setup(self)
+        self.connection.settimeout(self.server.idle_timeout)
+        self.channel = protocol.Channel(self.request, self.server.max_frame_size)
+
+    def handle(self):
+        """ Receive data, process, and return a response for each request """
+        admission = self.server.admission
+        processor = self.server.processor
+
+        reason = admission.connect(self.channel)
+        if reason:
+            self.refuse(reason)
+            return
+
+        try:
+            while True:
+                try:
+                    msg_type, flags, length = self.channel.recv_header()
+                except (protocol.ConnectionClosed, socket.timeout):
+                    break
+
+                # Refuse the frame before buffering it when over budget
+                reason = admission.reserve(self.channel, length)
+                if reason:
+                    self.channel.skip_payload(length)
+                    processor.refuse(self.channel, msg_type, flags, reason)
+                    continue
+
+                try:
+                    data = self.channel.recv_payload(length)
+                    processor.handle_frame(self.channel, msg_type, flags, data)
+                finally:
+                    admission.release(self.channel)
+
+        except socket.timeout:
+            log.info(
+                "connection deadline passed", extra={"client": format_address(self.client_address)}
             )
-            print("Added user {}".format(request["data"]["user1"]))
 
-        return response
+        finally:
+            admission.disconnect(self.channel)
+
+    def refuse(self, reason: str):
+        """ Reply to the first frame of a refused connection then close it """
+        self.connection.settimeout(LINGER_TIMEOUT)
+        try:
+            msg_type, flags, length = self.channel.recv_header()
+            if length > REFUSED_FRAME_SIZE:
+                return
+            self.channel.skip_payload(length)
+            self.server.processor.refuse(self.channel, msg_type, flags, reason)
+            protocol.linger(self.connection, LINGER_TIMEOUT)
+        except (protocol.ProtocolError, OSError):
+            pass
 
 
 class FileServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
 
     allow_reuse_address = True
-    request_queue_size = 20
+    request_queue_size = 128
     daemon_threads = True
+    max_frame_size = protocol.MAX_FRAME_SIZE
+    idle_timeout = 60.0
 
     def __init__(
         self,
         database,
         server_address=("localhost", 60000),
         handler_class=RequestHandler,
+        sessions: SessionManager = None,
+        sock: socket.socket = None,
+        admission: AdmissionControl = None,
     ):
         self.database = database
-        socketserver.TCPServer.__init__(self, server_address, handler_class)
+        self.admission = admission if admission is not None else AdmissionControl()
+        self.processor = RequestProcessor(database, sessions, self.admission)
+
+        # Serve a socket that is already listening, such as one shared by workers
+        socketserver.TCPServer.__init__(
+            self, server_address, handler_class, bind_and_activate=sock is None
+        )
+        if sock is not None:
+            self.socket.close()
+            self.socket = sock
+            self.server_address = sock.getsockname()[:2]
 
     def shutdown(self, filename=None):
         self.database.save(filename)
         return socketserver.TCPServer.shutdown(self)
+
+    def handle_error(self, request, client_address):
+        metrics.count_exception()
+        log.exception("request failed", extra={"client": format_address(client_address)})
+
+
+def format_address(address: Tuple) -> str:
+    return "{}:{}".format(*address[:2])
@@ -0,0 +1,244 @@
+import time
+import struct
+from typing import Callable, Dict, Tuple
+
+from Crypto.Hash import SHA256
+from Crypto.Cipher import PKCS1_OAEP
+from Crypto.Protocol.KDF import HKDF
+from Crypto.Signature import pkcs1_15
+
+from fileserve import utils
+from fileserve import codec
+from fileserve import crypto
+
+
+NONCE_SIZE = 32
+SECRET_SIZE = 32
+TICKET_LIFETIME = 3600
+
+SEQ_NONCE = struct.Struct("!4xQ")
+
+
+class HandshakeError(Exception):
+    """ Raised when a session could not be established """
+
+
+class Session(object):
+    """ Symmetric state shared by the two ends of a connection
+
+    Each direction has its own key and message counter, so the counter is
+    a safe AES-GCM nonce and replayed or reordered messages fail to open.
+    """
+
+    def __init__(
+        self,
+        user: str,
+        send_key: bytes,
+        recv_key: bytes,
+        secret: bytes = b"",
+        ticket: bytes = b"",
+        expires: float = 0.0,
+        resumed: bool = False,
+    ):
+        self.user = user
+        self.send_key = send_key
+        self.recv_key = recv_key
+        self.secret = secret
+        self.ticket = ticket
+        self.expires = expires
+        self.resumed = resumed
+        self.send_seq = 0
+        self.recv_seq = 0
+
+    def seal(self, data: bytes) -> bytes:
+        """ Encrypt the next outgoing message """
+        nonce = SEQ_NONCE.pack(self.send_seq)
+        self.send_seq += 1
+        return crypto.aead_encrypt(self.send_key, nonce, data)
+
+    def open(self, data: bytes) -> bytes:
+        """ Decrypt the next incoming message """
+        nonce = SEQ_NONCE.pack(self.recv_seq)
+        plaintext = crypto.aead_decrypt(self.recv_key, nonce, data)
+        self.recv_seq += 1
+        return plaintext
+
+    def skip(self):
+        """ Pass over an incoming message discarded without opening it """
+        self.recv_seq += 1
+
+
+def derive_keys(secret: bytes, client_nonce: bytes, server_nonce: bytes) -> Tuple[bytes, bytes]:
+    """ Derive the client to server and server to client keys """
+    return HKDF(
+        secret,
+        crypto.AES_KEY_SIZE,
+        client_nonce + server_nonce,
+        SHA256,
+        num_keys=2,
+        context=b"fileserve session",
+    )
+
+
+def hello_digest(user: str, nonce: bytes, secret: bytes) -> SHA256.SHA256Hash:
+    """ Hash of the fields of a full hello that the client signs """
+    return SHA256.new(b"fileserve hello" + user.encode() + nonce + secret)
+
+
+def client_hello(
+    user: str,
+    priv_key: crypto.Key,
+    server_pub_key: crypto.Key,
+    resume: Session = None,
+) -> Tuple[bytes, Dict]:
+    """ Build the client hello, resuming a previous session if possible
+
+    A full hello wraps a fresh secret for the server and signs it with the
+    user's key. A resumed hello only carries the server's ticket so no RSA
+    operation is needed on either end.
+    """
+    hello = codec.Hello()
+    hello["user"] = user
+    hello["nonce"] = crypto.get_random_bytes(NONCE_SIZE)
+
+    if resume is not None and resume.ticket and resume.expires > time.time():
+        secret = resume.secret
+        hello["ticket"] = resume.ticket
+    else:
+        secret = crypto.get_random_bytes(SECRET_SIZE)
+        cipher = PKCS1_OAEP.new(crypto.import_key(server_pub_key), hashAlgo=SHA256)
+        hello["secret"] = cipher.encrypt(secret)
+        hello["signature"] = pkcs1_15.new(crypto.import_key(priv_key)).sign(
+            hello_digest(user, hello["nonce"], hello["secret"])
+        )
+
+    state = {
+        "user": user,
+        "nonce": hello["nonce"],
+        "secret": secret,
+        "resumed": hello["ticket"] != b"",
+    }
+    return utils.serialize(hello), state
+
+
+def client_finish(state: Dict, welcome: bytes) -> Session:
+    """ Complete the handshake from the server's welcome """
+    welcome = utils.deserialize(welcome, codec.Welcome)
+
+    if welcome["error"] != "":
+        raise HandshakeError(welcome["error"])
+
+    send_key, recv_key = derive_keys(state["secret"], state["nonce"], welcome["nonce"])
+    return Session(
+        user=state["user"],
+        send_key=send_key,
+        recv_key=recv_key,
+        secret=state["secret"],
+        ticket=welcome["ticket"],
+        expires=welcome["expires"],
+        resumed=state["resumed"],
+    )
+
+
+class SessionManager(object):
+    """ Server side of the handshake and issuer of resumption tickets
+
+    Tickets are the session secret, user and expiry sealed under a key that
+    only lives in the server's memory, so the server keeps no per-session
+    state. Worker processes are given the same key so any of them can
+    resume a session.
+    """
+
+    def __init__(self, ticket_lifetime: float = TICKET_LIFETIME, ticket_key: bytes = None):
+        self.ticket_lifetime = ticket_lifetime
+        if ticket_key is None:
+            ticket_key = crypto.get_random_bytes(crypto.AES_KEY_SIZE)
+        self.ticket_key = ticket_key
+
+    def issue_ticket(self, user: str, secret: bytes, expires: float) -> bytes:
+        """ Seal the session secret into a ticket only this server can open """
+        nonce = crypto.get_random_bytes(crypto.GCM_NONCE_SIZE)
+        data = utils.serialize(codec.Ticket(user=user, secret=secret, expires=expires))
+        return nonce + crypto.aead_encrypt(self.ticket_key, nonce, data)
+
+    def open_ticket(self, ticket: bytes) -> codec.Ticket:
+        """ Open a ticket issued by issue_ticket """
+        nonce = ticket[:crypto.GCM_NONCE_SIZE]
+        data = crypto.aead_decrypt(self.ticket_key, nonce, ticket[crypto.GCM_NONCE_SIZE:])
+        return utils.deserialize(data, codec.Ticket)
+
+    def accept(
+        self,
+        hello: bytes,
+        priv_key: crypto.Key,
+        load_user_key: Callable[[str], crypto.Key],
+    ) -> Tuple[Session, bytes]:
+        """ Handle a client hello and return the session and welcome reply
+
+        On failure the session is None and the welcome carries the error.
+        """
+        hello = utils.deserialize(hello, codec.Hello)
+        welcome = codec.Welcome()
+        welcome["nonce"] = crypto.get_random_bytes(NONCE_SIZE)
+
+        try:
+            if hello["ticket"] != b"":
+                secret, expires = self.resume(hello)
+                welcome["ticket"] = hello["ticket"]
+                resumed = True
+            else:
+                secret = self.authenticate(hello, priv_key, load_user_key)
+                expires = time.time() + self.ticket_lifetime
+                welcome["ticket"] = self.issue_ticket(hello["user"], secret, expires)
+                resumed = False
+        except (ValueError, OSError) as e:
+            welcome["error"] = str(e)
+            return None, utils.serialize(welcome)
+
+        welcome["expires"] = expires
+        recv_key, send_key = derive_keys(secret, hello["nonce"], welcome["nonce"])
+        session = Session(
+            user=hello["user"],
+            send_key=send_key,
+            recv_key=recv_key,
+            secret=secret,
+            ticket=welcome["ticket"],
+            expires=expires,
+            resumed=resumed,
+        )
+        return session, utils.serialize(welcome)
+
+    def authenticate(
+        self,
+        hello: Dict,
+        priv_key: crypto.Key,
+        load_user_key: Callable[[str], crypto.Key],
+    ) -> bytes:
+        """ Verify a full hello and unwrap its secret """
+        pub_key = load_user_key(hello["user"])
+
+        try:
+            pkcs1_15.new(crypto.import_key(pub_key)).verify(
+                hello_digest(hello["user"], hello["nonce"], hello["secret"]),
+                hello["signature"],
+            )
+        except ValueError:
+            raise ValueError("hello signature is not valid")
+
+        cipher = PKCS1_OAEP.new(crypto.import_key(priv_key), hashAlgo=SHA256)
+        return cipher.decrypt(hello["secret"])
+
+    def resume(self, hello: Dict) -> Tuple[bytes, float]:
+        """ Check a resumption ticket and return its secret and expiry """
+        try:
+            ticket = self.open_ticket(hello["ticket"])
+        except ValueError:
+            raise ValueError("ticket is not valid")
+
+        if ticket["user"] != hello["user"]:
+            raise ValueError("ticket was not issued to {}".format(hello["user"]))
+
+        if ticket["expires"] < time.time():
+            raise ValueError("ticket has expired")
+
+        return ticket["secret"], ticket["expires"]
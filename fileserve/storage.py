@@ -0,0 +1,291 @@
+import os
+import json
+import hashlib
+import functools
+from collections import Counter
+from typing import Iterable, Iterator
+
+from fileserve import utils
+from fileserve import metrics
+from fileserve import compression
+from fileserve.locking import StripedLock
+
+
+# Size of the chunks files are split into by ChunkStore
+STORE_CHUNK_SIZE = 64 * 1024
+
+# Reads of at least this many bytes are served from a memory map
+MMAP_SIZE = 8 << 20
+
+
+def split(chunks: Iterable[bytes], size: int) -> Iterator[bytes]:
+    """ Regroup a stream of arbitrarily sized chunks into size byte chunks """
+    buf = bytearray()
+
+    for chunk in chunks:
+        buf += chunk
+        if len(buf) < size:
+            continue
+
+        end = len(buf) - len(buf) % size
+        with memoryview(buf) as view:
+            for i in range(0, end, size):
+                yield bytes(view[i:i + size])
+        del buf[:end]
+
+    if buf:
+        yield bytes(buf)
+
+
+class FlatStorage(object):
+    """ Stores every file whole under its own name """
+
+    def __init__(self, root: str, fsync: bool = False):
+        self.root = root
+        self.fsync = fsync
+        os.makedirs(root, exist_ok=True)
+
+    def save(self, filename: str, chunks: Iterable[bytes]) -> int:
+        """ Store a file from its contents, replacing it atomically """
+        return utils.save_chunks(self.root, filename, chunks, fsync=self.fsync)
+
+    def adopt(self, filename: str, path: str) -> int:
+        """ Store a complete file from elsewhere on the filesystem by moving it """
+        if self.fsync:
+            with open(path, "rb") as f:
+                os.fsync(f.fileno())
+        os.replace(path, os.path.join(self.root, filename))
+        return self.size(filename)
+
+    def read(self, filename: str) -> bytes:
+        """ Read a whole file """
+        return utils.read_file(self.root, filename)
+
+    def read_chunks(
+        self, filename: str, chunk_size: int, offset: int = 0, length: int = None
+    ) -> Iterator[bytes]:
+        """ Open a file and return an iterator over length bytes from offset """
+        remaining = self.size(filename) - offset if length is None else length
+        if remaining >= MMAP_SIZE:
+            return utils.map_chunks(self.root, filename, chunk_size, offset, length)
+        return utils.read_chunks(self.root, filename, chunk_size, offset, length)
+
+    def read_range(self, filename: str, offset: int, length: int) -> bytes:
+        """ Read up to length bytes starting at offset """
+        with metrics.timed("disk_read"), open(os.path.join(self.root, filename), "rb") as f:
+            f.seek(offset)
+            return f.read(length)
+
+    def size(self, filename: str) -> int:
+        return os.path.getsize(os.path.join(self.root, filename))
+
+    def delete(self, filename: str):
+        os.remove(os.path.join(self.root, filename))
+
+    def usage(self) -> int:
+        """ Bytes of file data on disk """
+        return sum(entry.stat().st_size for entry in os.scandir(self.root) if entry.is_file())
+
+
+class ChunkStore(object):
+    """ Content addressed storage deduplicating fixed size chunks
+
+    Files are split into chunk_size chunks stored once under their SHA-256
+    and described by a manifest listing the chunk digests. Each chunk is
+    reference counted by the manifests using it, and by open readers, so
+    deleting a file only removes chunks no other file shares.
+
+    Manifests are written after their chunks and removed before their
+    chunks are released, so reference counts are rebuilt from the
+    manifests on startup and any chunk left unreferenced by a crash is
+    collected then.
+
+    With a compression codec each new chunk is stored compressed behind a
+    one byte header naming the codec used, chunks which do not compress
+    are stored as they are.
+    """
+
+    def __init__(
+        self,
+        root: str,
+        fsync: bool = False,
+        chunk_size: int = STORE_CHUNK_SIZE,
+        compression: str = "",
+    ):
+        self.root = root
+        self.fsync = fsync
+        self.chunk_size = chunk_size
+        self.compression = compression
+        self.chunk_dir = os.path.join(root, "chunks")
+        self.manifest_dir = os.path.join(root, "manifests")
+        self.locks = StripedLock()
+        self.refs = Counter()
+
+        os.makedirs(self.chunk_dir, exist_ok=True)
+        os.makedirs(self.manifest_dir, exist_ok=True)
+        self.recover()
+
+    def recover(self):
+        """ Rebuild reference counts and delete unreferenced chunks """
+        self.refs.clear()
+        for name in os.listdir(self.manifest_dir):
+            if name.startswith(".") and name.endswith(".tmp"):
+                os.remove(os.path.join(self.manifest_dir, name))
+                continue
+            self.refs.update(self.load_manifest(name)["chunks"])
+
+        for prefix in os.listdir(self.chunk_dir):
+            for name in os.listdir(os.path.join(self.chunk_dir, prefix)):
+                if name not in self.refs:
+                    os.remove(os.path.join(self.chunk_dir, prefix, name))
+
+    def chunk_path(self, digest: str) -> str:
+        return os.path.join(self.chunk_dir, digest[:2], digest)
+
+    def load_manifest(self, filename: str) -> dict:
+        with open(os.path.join(self.manifest_dir, filename), "r") as f:
+            return json.load(f)
+
+    def load_chunk(self, digest: str) -> bytes:
+        with metrics.timed("disk_read"), open(self.chunk_path(digest), "rb") as f:
+            data = f.read()
+
+        if not self.compression:
+            return data
+        return compression.decompress(data[1:], compression.CODECS[data[0]], self.chunk_size)
+
+    def acquire(self, digest: str, chunk: bytes = None):
+        """ Take a reference to a chunk, writing it first if it is new """
+        with self.locks(digest):
+            if self.refs[digest] == 0 and chunk is not None:
+                parts = [chunk]
+                if self.compression:
+                    codec, payload = compression.compress(chunk, self.compression)
+                    parts = [bytes([compression.CODECS.index(codec)]), payload]
+
+                os.makedirs(os.path.dirname(self.chunk_path(digest)), exist_ok=True)
+                utils.save_chunks(
+                    os.path.dirname(self.chunk_path(digest)), digest, parts, fsync=self.fsync
+                )
+            self.refs[digest] += 1
+
+    def release(self, digest: str):
+        """ Drop a reference to a chunk, deleting it with the last one """
+        with self.locks(digest):
+            self.refs[digest] -= 1
+            if self.refs[digest] <= 0:
+                del self.refs[digest]
+                try:
+                    os.remove(self.chunk_path(digest))
+                except FileNotFoundError:
+                    pass
+
+    def save(self, filename: str, chunks: Iterable[bytes]) -> int:
+        """ Store a file from its contents, replacing it atomically """
+        digests = []
+        size = 0
+
+        try:
+            for chunk in split(chunks, self.chunk_size):
+                digest = hashlib.sha256(chunk).hexdigest()
+                self.acquire(digest, chunk)
+                digests.append(digest)
+                size += len(chunk)
+
+            old = None
+            if os.path.exists(os.path.join(self.manifest_dir, filename)):
+                old = self.load_manifest(filename)
+
+            manifest = json.dumps({"size": size, "chunks": digests})
+            utils.save_file(self.manifest_dir, filename, manifest.encode(), fsync=self.fsync)
+
+        except BaseException:
+            for digest in digests:
+                self.release(digest)
+            raise
+
+        if old is not None:
+            for digest in old["chunks"]:
+                self.release(digest)
+
+        return size
+
+    def adopt(self, filename: str, path: str) -> int:
+        """ Store a complete file from elsewhere on the filesystem, removing it """
+        directory, name = os.path.split(path)
+        size = self.save(filename, utils.read_chunks(directory, name, self.chunk_size))
+        os.remove(path)
+        return size
+
+    def read(self, filename: str) -> bytes:
+        """ Read a whole file """
+        return b"".join(self.read_chunks(filename, self.chunk_size))
+
+    def read_chunks(
+        self, filename: str, chunk_size: int, offset: int = 0, length: int = None
+    ) -> Iterator[bytes]:
+        """ Pin a file's chunks and return an iterator over length bytes from offset
+
+        The chunks stay readable until the iterator is exhausted or closed
+        even if the file is deleted in the meantime.
+        """
+        manifest = self.load_manifest(filename)
+        end = manifest["size"] if length is None else min(offset + length, manifest["size"])
+        first = offset // self.chunk_size
+        digests = manifest["chunks"][first:(end + self.chunk_size - 1) // self.chunk_size]
+        for digest in digests:
+            self.acquire(digest)
+
+        def chunks():
+            try:
+                yield b""
+                position = first * self.chunk_size
+                for digest in digests:
+                    data = self.load_chunk(digest)
+                    yield data[max(offset - position, 0):end - position]
+                    position += len(data)
+            finally:
+                for digest in digests:
+                    self.release(digest)
+
+        # Start the generator so the pin is released even if it is never read
+        pinned = chunks()
+        next(pinned)
+        return split(pinned, chunk_size)
+
+    def read_range(self, filename: str, offset: int, length: int) -> bytes:
+        """ Read up to length bytes starting at offset """
+        digests = self.load_manifest(filename)["chunks"]
+        first = offset // self.chunk_size
+        last = (offset + length - 1) // self.chunk_size
+
+        data = bytearray()
+        for digest in digests[first:last + 1]:
+            data += self.load_chunk(digest)
+
+        start = offset - first * self.chunk_size
+        return bytes(data[start:start + length])
+
+    def size(self, filename: str) -> int:
+        return self.load_manifest(filename)["size"]
+
+    def delete(self, filename: str):
+        digests = self.load_manifest(filename)["chunks"]
+        os.remove(os.path.join(self.manifest_dir, filename))
+        for digest in digests:
+            self.release(digest)
+
+    def usage(self) -> int:
+        """ Bytes of chunk data and manifests on disk """
+        total = 0
+        for dirpath, _, names in os.walk(self.root):
+            total += sum(os.path.getsize(os.path.join(dirpath, name)) for name in names)
+        return total
+
+
+# Storage backends selectable by name
+backends = {
+    "flat": FlatStorage,
+    "chunked": ChunkStore,
+    "compressed": functools.partial(ChunkStore, compression="zlib"),
+}
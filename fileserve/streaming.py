@@ -0,0 +1,126 @@
+import struct
+from typing import Iterable, Iterator
+
+from fileserve import crypto
+from fileserve import protocol
+from fileserve import compression
+
+
+# Plaintext bytes per chunk frame and the largest chunk accepted from a peer
+CHUNK_SIZE = 1 << 20
+MAX_CHUNK_SIZE = 16 << 20
+
+NONCE = struct.Struct("!4xQ")
+AAD = struct.Struct("!QQBB")
+
+# Frame flags marking how each chunk was compressed
+COMPRESSION_FLAGS = {"": 0, "zlib": protocol.FLAG_ZLIB, "lzma": protocol.FLAG_LZMA}
+COMPRESSION_CODECS = {flag: codec for codec, flag in COMPRESSION_FLAGS.items()}
+COMPRESSION_MASK = protocol.FLAG_ZLIB | protocol.FLAG_LZMA
+
+
+def new_key() -> bytes:
+    """ Generate a fresh key for a single transfer """
+    return crypto.get_random_bytes(crypto.AES_KEY_SIZE)
+
+
+def seal_chunk(
+    key: bytes, index: int, data: bytes, final: bool, offset: int = 0, flags: int = 0
+) -> bytes:
+    """ Encrypt a chunk bound to its position in the stream and in the file """
+    return crypto.aead_encrypt(
+        key, NONCE.pack(index), data, AAD.pack(index, offset, final, flags)
+    )
+
+
+def open_chunk(
+    key: bytes, index: int, data: bytes, final: bool, offset: int = 0, flags: int = 0
+) -> bytes:
+    """ Decrypt a chunk and check it is the one expected at this position """
+    return crypto.aead_decrypt(
+        key, NONCE.pack(index), data, AAD.pack(index, offset, final, flags)
+    )
+
+
+def send_chunks(
+    channel: protocol.Channel,
+    key: bytes,
+    chunks: Iterable[bytes],
+    offset: int = 0,
+    codec: str = "",
+) -> int:
+    """ Send chunks as encrypted frames followed by an empty final frame
+
+    The transfer key is only ever used for one stream so the chunk index
+    is a safe nonce. Binding the index, the chunk's offset in the file and
+    the final flag into the AAD stops a peer from reordering, replaying or
+    truncating the stream, or from splicing it in at the wrong offset when
+    a transfer is resumed. The GCM tag is each chunk's integrity check.
+
+    With a codec every chunk that looks compressible is compressed before
+    it is encrypted and flagged, the flag is bound into the AAD too.
+    """
+    index = 0
+    size = 0
+
+    for chunk in chunks:
+        if not chunk:
+            continue
+        used, payload = compression.compress(chunk, codec)
+        flags = COMPRESSION_FLAGS[used]
+        channel.send_frame(
+            seal_chunk(key, index, payload, False, offset + size, flags), protocol.MSG_CHUNK, flags
+        )
+        index += 1
+        size += len(chunk)
+
+    # The peer may start its next transfer as soon as it sees the final frame
+    channel.end_stream()
+    channel.send_frame(
+        seal_chunk(key, index, b"", True, offset + size), protocol.MSG_CHUNK, protocol.FLAG_FINAL
+    )
+    return size
+
+
+def recv_chunks(
+    channel: protocol.Channel, key: bytes, offset: int = 0, max_size: int = MAX_CHUNK_SIZE
+) -> Iterator[bytes]:
+    """ Yield decrypted chunks of a stream starting at offset until the final frame """
+    index = 0
+
+    while True:
+        msg_type, flags, payload = channel.recv_frame(max_size + crypto.GCM_TAG_SIZE)
+
+        if msg_type != protocol.MSG_CHUNK:
+            raise protocol.ProtocolError(
+                "expected a chunk but received message type {}".format(msg_type)
+            )
+
+        final = bool(flags & protocol.FLAG_FINAL)
+        codec = COMPRESSION_CODECS.get(flags & COMPRESSION_MASK)
+        if codec is None:
+            raise protocol.ProtocolError("chunk has conflicting compression flags")
+
+        chunk = open_chunk(key, index, payload, final, offset, flags & COMPRESSION_MASK)
+        chunk = compression.decompress(chunk, codec, max_size)
+
+        if final:
+            return
+
+        yield chunk
+        index += 1
+        offset += len(chunk)
+
+
+def drain_chunks(channel: protocol.Channel, max_size: int = MAX_CHUNK_SIZE):
+    """ Discard the chunk frames of a stream that was rejected """
+    while True:
+        msg_type, flags, _ = channel.recv_frame(max_size + crypto.GCM_TAG_SIZE)
+
+        if msg_type != protocol.MSG_CHUNK:
+            raise protocol.ProtocolError(
+                "expected a chunk but received message type {}".format(msg_type)
+            )
+
+        if flags & protocol.FLAG_FINAL:
+            return
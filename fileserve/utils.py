@@ -1,23 +1,132 @@
 import os
-import pickle
-from typing import Dict
+import mmap
+import hashlib
+import tempfile
+from typing import Iterable, Iterator
+
+from fileserve import codec
+from fileserve import metrics
+from fileserve.streaming import CHUNK_SIZE
 
 
 def read_file(file_dir: str, filename: str) -> bytes:
     """ Read file contents to bytes """
-    with open(os.path.join(file_dir, filename), "rb") as f:
+    with metrics.timed("disk_read"), open(os.path.join(file_dir, filename), "rb") as f:
         data = f.read()
     return data
 
-def save_file(file_dir: str, filename: str, data: bytes):
+def read_chunks(
+    file_dir: str, filename: str, chunk_size: int, offset: int = 0, length: int = None
+) -> Iterator[bytes]:
+    """ Read file contents incrementally in chunks of chunk_size bytes
+
+    Reads length bytes from offset, or to the end of the file. The file is
+    opened straight away, so the caller keeps its contents even if the file
+    is replaced or deleted before the chunks are consumed.
+    """
+    f = open(os.path.join(file_dir, filename), "rb")
+    f.seek(offset)
+    remaining = length
+
+    def chunks():
+        nonlocal remaining
+        with f:
+            while remaining is None or remaining > 0:
+                with metrics.timed("disk_read"):
+                    chunk = f.read(
+                        chunk_size if remaining is None else min(chunk_size, remaining)
+                    )
+                if not chunk:
+                    break
+                if remaining is not None:
+                    remaining -= len(chunk)
+                yield chunk
+
+    return chunks()
+
+def map_chunks(
+    file_dir: str, filename: str, chunk_size: int, offset: int = 0, length: int = None
+) -> Iterator[bytes]:
+    """ Like read_chunks but yielding views of a memory map instead of copies
+
+    Chunks are read straight from the page cache. The map is unmapped once
+    the iterator is finished and the last chunk is released.
+    """
+    with open(os.path.join(file_dir, filename), "rb") as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    end = len(mapped) if length is None else min(offset + length, len(mapped))
+
+    def chunks():
+        view = memoryview(mapped)
+        try:
+            for start in range(offset, end, chunk_size):
+                yield view[start:min(start + chunk_size, end)]
+        finally:
+            view.release()
+            try:
+                mapped.close()
+            except BufferError:
+                # A consumer still holds a chunk, the map goes with it
+                pass
+
+    return chunks()
+
+def save_file(file_dir: str, filename: str, data: bytes, fsync: bool = False):
     """ Save to file to 'database' """
-    with open(os.path.join(file_dir, filename), "wb") as f:
-        f.write(data)
+    save_chunks(file_dir, filename, [data], fsync)
+
+def save_chunks(file_dir: str, filename: str, chunks: Iterable[bytes], fsync: bool = False) -> int:
+    """ Write chunks to a temp file and atomically rename it into place """
+    fd, tmp_path = tempfile.mkstemp(dir=file_dir, prefix=".", suffix=".tmp")
+    size = 0
+
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for chunk in chunks:
+                with metrics.timed("disk_write"):
+                    f.write(chunk)
+                size += len(chunk)
+            if fsync:
+                f.flush()
+                with metrics.timed("fsync"):
+                    os.fsync(f.fileno())
+        os.replace(tmp_path, os.path.join(file_dir, filename))
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+    return size
+
+def write_chunks(file_dir: str, filename: str, chunks: Iterable[bytes], offset: int = 0) -> int:
+    """ Write chunks into a file from offset, creating it if needed
+
+    The file is never truncated, so disjoint ranges of one file can be
+    written concurrently. Returns the number of bytes written.
+    """
+    fd = os.open(os.path.join(file_dir, filename), os.O_WRONLY | os.O_CREAT, 0o644)
+    size = 0
+
+    with os.fdopen(fd, "wb") as f:
+        f.seek(offset)
+        for chunk in chunks:
+            with metrics.timed("disk_write"):
+                f.write(chunk)
+            size += len(chunk)
+
+    return size
+
+def file_digest(file_dir: str, filename: str) -> bytes:
+    """ SHA-256 of a file's contents """
+    digest = hashlib.sha256()
+    with open(os.path.join(file_dir, filename), "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.digest()
 
-def serialize(data: Dict) -> bytes:
-    """ Pickle dictionary object to bytes for sending """
-    return pickle.dumps(data)
+def serialize(data: codec.Message) -> bytes:
+    """ Encode a message to bytes for sending """
+    return codec.encode(data)
 
-def deserialize(data: bytes) -> Dict:
-    """ Unpickle the received dictionary object """
-    return pickle.loads(data)
+def deserialize(data: bytes, cls: type = None) -> codec.Message:
+    """ Decode a received message, optionally checking its type """
+    return codec.decode(data, cls)
@@ -0,0 +1,48 @@
+import os
+import sys
+import argparse
+
+from fileserve.locking import StripedLock
+from fileserve.metadata import JournaledMetadata, SQLiteMetadata
+
+
+def migrate(db_dir: str, force: bool = False):
+    """ Import the JSON snapshot and its journal into the SQLite metadata """
+    locks = StripedLock()
+    source = JournaledMetadata(db_dir, locks, sync_every=0)
+    target = SQLiteMetadata(db_dir, locks)
+
+    try:
+        if target.users and not force:
+            raise ValueError("{} already has metadata, pass --force to merge".format(target.path))
+
+        target.load_snapshot(source.files, source.users)
+        target.save()
+        return len(source.files), len(source.users), target.path
+    finally:
+        source.close()
+        target.close()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Import db.json and journal.log into the SQLite metadata backend"
+    )
+    parser.add_argument("--db-dir", type=str, default="db", help="Database directory")
+    parser.add_argument(
+        "--force", action="store_true", help="Import even if the SQLite database has users"
+    )
+    args = parser.parse_args()
+
+    if not os.path.exists(os.path.join(args.db_dir, "db.json")):
+        if not os.path.exists(os.path.join(args.db_dir, "journal.log")):
+            sys.exit("No JSON metadata in {}".format(args.db_dir))
+
+    try:
+        files, users, path = migrate(args.db_dir, args.force)
+    except ValueError as e:
+        sys.exit(str(e))
+
+    print("Imported {} files and {} users into {}".format(files, users, path))
+    print("Run the server with --metadata sqlite, db.json is no longer used")
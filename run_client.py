@@ -1,15 +1,67 @@
 import os
+import sys
+import atexit
 import copy
+import time
 import socket
 import argparse
-from typing import Dict
+from typing import Dict, List, Tuple
 
 import fileserve
 
 
+def read_commands(path: str) -> List[Tuple[str, str, str]]:
+    """ Parse a command file of 'command [filename] [user2]' lines """
+    f = sys.stdin if path == "-" else open(path, "r")
+    tasks = []
+    with f:
+        for line in f:
+            fields = line.split("#", 1)[0].split()
+            if fields:
+                fields += [""] * (3 - len(fields))
+                tasks.append(tuple(fields[:3]))
+    return tasks
+
+
+def run_batch(args):
+
+    client = fileserve.BatchClient(
+        user=args.user,
+        ip=args.ip,
+        port=args.port,
+        connections=args.connections,
+        processes=args.processes,
+        retries=args.retries,
+        file_dir=args.upload_dir or args.dir,
+        compression=args.compression,
+    )
+
+    def progress(result, done, total):
+        print("[{}/{}] {!r} ({:.2f}s)".format(done, total, result, result.elapsed))
+
+    start = time.perf_counter()
+    if args.batch:
+        results = client.run_many(read_commands(args.batch), progress=progress)
+    elif args.upload_dir:
+        results = client.upload_dir(progress=progress)
+    elif args.ranges:
+        # One file at a time, each split across the connections
+        results = []
+        for i, filename in enumerate(args.download_many.split(","), 1):
+            results.append(client.download_ranges(filename, args.ranges))
+            progress(results[-1], i, len(args.download_many.split(",")))
+    else:
+        results = client.download_many(args.download_many.split(","), progress=progress)
+
+    print(fileserve.batch.summary(results, time.perf_counter() - start))
+    return all(result.ok for result in results)
+
+
 def main(args):
 
-    client = fileserve.Client(user=args.user, ip=args.ip, port=args.port)
+    client = fileserve.Client(
+        user=args.user, ip=args.ip, port=args.port, compression=args.compression
+    )
 
     # Get user input
     while True:
@@ -17,8 +69,8 @@ def main(args):
         command = (
             input(
                 "\nPlease enter the task you would like to perform.\n"
-                + "Options are (upload_file, download_file, delete_file, "
-                + "share_file, add_user):\n"
+                + "Options are (upload_file, download_file, update_file, delete_file, "
+                + "share_file, revoke_access, list_files, add_user):\n"
             )
             .strip()
             .lower()
@@ -32,20 +84,33 @@ def main(args):
         elif command not in [
             "upload_file",
             "download_file",
+            "update_file",
             "delete_file",
             "share_file",
+            "revoke_access",
+            "list_files",
             "add_user",
         ]:
             continue
 
+        if command == "list_files":
+            for filename, owner in client.list_files():
+                print("{}  (owner {})".format(filename, owner))
+            continue
+
         # Get additional user input based on command
         filename = ""
-        if command in ["upload_file", "download_file", "delete_file", "share_file"]:
+        if command in [
+            "upload_file", "download_file", "update_file", "delete_file", "share_file",
+            "revoke_access",
+        ]:
             filename = input("Enter filename: ")
 
         user2 = ""
         if command == "share_file":
             user2 = input("Enter user to share file with: ")
+        elif command == "revoke_access":
+            user2 = input("Enter user to revoke access from: ")
 
         # Run with options
         client.run(command, filename, user2)
@@ -59,5 +124,46 @@ if __name__ == "__main__":
     )
     parser.add_argument("--ip", type=str, default="localhost", help="Address to use")
     parser.add_argument("--port", type=int, default=60000, help="Port to use")
+    parser.add_argument(
+        "--compression",
+        type=str,
+        default="",
+        choices=["", "zlib", "lzma"],
+        help="Compress file data before it is encrypted",
+    )
+    parser.add_argument(
+        "--batch", type=str, default=None, help="Run the commands in a file ('-' for stdin)"
+    )
+    parser.add_argument(
+        "--upload-dir", type=str, default=None, help="Upload every file in a directory"
+    )
+    parser.add_argument(
+        "--download-many", type=str, default=None, help="Comma separated files to download"
+    )
+    parser.add_argument(
+        "--dir", type=str, default=None, help="Local file directory, defaults to the user's"
+    )
+    parser.add_argument(
+        "--connections", type=int, default=4, help="Concurrent connections for batches"
+    )
+    parser.add_argument(
+        "--processes", type=int, default=0, help="Run batches on this many worker processes"
+    )
+    parser.add_argument(
+        "--retries", type=int, default=2, help="Retries of a batch command on connection errors"
+    )
+    parser.add_argument(
+        "--ranges", type=int, default=0, help="Download each file as this many parallel ranges"
+    )
+    parser.add_argument(
+        "--log-level", type=str, default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR"]
+    )
     args = parser.parse_args()
+
+    # Flush queued log records on exit
+    atexit.register(fileserve.logs.setup(args.log_level, "text", sys.stdout).stop)
+
+    if args.batch or args.upload_dir or args.download_many:
+        sys.exit(0 if run_batch(args) else 1)
+
     main(args)
@@ -1,8 +1,40 @@
 import os
 import argparse
+import functools
 import threading
 
 import fileserve
+from fileserve.prefork import PreforkServer
+
+
+def parse_rate(text: str):
+    """ Parse HEADER=RATE or HEADER=RATE/BURST into (header, (rate, burst)) """
+    header, _, rate = text.partition("=")
+    rate, _, burst = rate.partition("/")
+    return header, (float(rate), float(burst or rate))
+
+
+def setup_worker(index, args):
+    """ Logging and metrics of one worker process, each gets its own metrics port and file """
+    listener = fileserve.logs.setup(args.log_level, args.log_format)
+
+    metrics_server = None
+    if args.metrics_port is not None:
+        metrics_server = fileserve.metrics.serve((args.ip, args.metrics_port + index))
+
+    stop_dump = None
+    if args.metrics_file:
+        stop_dump = fileserve.metrics.dump_every(
+            "{}.{}".format(args.metrics_file, index), args.metrics_interval
+        )
+
+    def cleanup():
+        if metrics_server is not None:
+            metrics_server.shutdown()
+        if stop_dump is not None:
+            stop_dump()
+        listener.stop()
+    return cleanup
 
 
 if __name__ == "__main__":
@@ -10,13 +42,157 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--ip", type=str, default="localhost", help="Address to use")
     parser.add_argument("--port", type=int, default=60000, help="Port to use")
+    parser.add_argument(
+        "--engine",
+        type=str,
+        default="thread",
+        choices=["thread", "asyncio"],
+        help="Thread per connection or asyncio event loop server",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=None, help="Crypto/disk threads for the asyncio engine"
+    )
+    parser.add_argument(
+        "--streams",
+        type=int,
+        default=None,
+        help="Streamed transfers the asyncio engine runs at once, --workers if unset",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=0,
+        help="Serve from this many worker processes, needs sqlite metadata and flat storage",
+    )
+    parser.add_argument(
+        "--sync-every", type=int, default=1, help="fsync the metadata journal every N records"
+    )
+    parser.add_argument(
+        "--sync-interval", type=float, default=None, help="fsync the journal every N seconds instead"
+    )
+    parser.add_argument(
+        "--storage",
+        type=str,
+        default="flat",
+        choices=["flat", "chunked", "compressed"],
+        help="Store whole files, deduplicated content addressed chunks or compressed chunks",
+    )
+    parser.add_argument(
+        "--metadata",
+        type=str,
+        default="json",
+        choices=["json", "sqlite"],
+        help="Keep metadata in memory with a journal, or in SQLite (see migrate_db.py)",
+    )
+    parser.add_argument(
+        "--cache-mb", type=int, default=64, help="MB of memory for caching hot files, 0 disables"
+    )
+    parser.add_argument(
+        "--max-connections", type=int, default=0, help="Connections allowed, 0 is no limit"
+    )
+    parser.add_argument(
+        "--max-user-connections", type=int, default=0, help="Connections allowed per user"
+    )
+    parser.add_argument(
+        "--max-inflight-mb", type=int, default=0, help="MB of requests being received or handled"
+    )
+    parser.add_argument(
+        "--max-user-inflight-mb", type=int, default=0, help="MB of requests in flight per user"
+    )
+    parser.add_argument(
+        "--user-rate", type=float, default=0, help="Requests per second allowed per user"
+    )
+    parser.add_argument(
+        "--user-burst", type=float, default=0, help="Requests a user may burst, --user-rate if 0"
+    )
+    parser.add_argument(
+        "--operation-rate",
+        type=parse_rate,
+        action="append",
+        default=[],
+        help="Requests per second allowed for an operation as HEADER=RATE[/BURST], repeatable",
+    )
+    parser.add_argument(
+        "--read-timeout", type=float, default=None, help="Seconds a request may take to arrive"
+    )
+    parser.add_argument(
+        "--write-timeout", type=float, default=None, help="Seconds a response may take to send"
+    )
+    parser.add_argument(
+        "--log-level", type=str, default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR"]
+    )
+    parser.add_argument("--log-format", type=str, default="json", choices=["json", "text"])
+    parser.add_argument(
+        "--metrics-port", type=int, default=None, help="Serve Prometheus metrics on this port"
+    )
+    parser.add_argument(
+        "--metrics-file", type=str, default=None, help="Dump Prometheus metrics to this file"
+    )
+    parser.add_argument(
+        "--metrics-interval", type=float, default=15.0, help="Seconds between metrics dumps"
+    )
     args = parser.parse_args()
 
-    server = fileserve.FileServer(
-        database=fileserve.Database(),
-        server_address=(args.ip, args.port),
-        handler_class=fileserve.RequestHandler
-    )
+    listener = fileserve.logs.setup(args.log_level, args.log_format)
+
+    # Worker processes serve their own metrics, see setup_worker
+    metrics_server = None
+    if args.metrics_port is not None and args.processes == 0:
+        metrics_server = fileserve.metrics.serve((args.ip, args.metrics_port))
+
+    stop_dump = None
+    if args.metrics_file and args.processes == 0:
+        stop_dump = fileserve.metrics.dump_every(args.metrics_file, args.metrics_interval)
+
+    database_options = {
+        "sync_every": 0 if args.sync_interval else args.sync_every,
+        "sync_interval": args.sync_interval,
+        "storage": args.storage,
+        "cache_bytes": args.cache_mb << 20,
+        "metadata": args.metadata,
+    }
+
+    admission_options = {
+        "max_connections": args.max_connections,
+        "max_user_connections": args.max_user_connections,
+        "max_inflight_bytes": args.max_inflight_mb << 20,
+        "max_user_inflight_bytes": args.max_user_inflight_mb << 20,
+        "user_rate": args.user_rate,
+        "user_burst": args.user_burst,
+        "operation_rates": dict(args.operation_rate),
+        "read_timeout": args.read_timeout,
+        "write_timeout": args.write_timeout,
+    }
+
+    database = None
+    if args.processes > 0:
+        server = PreforkServer(
+            database_options=database_options,
+            server_address=(args.ip, args.port),
+            processes=args.processes,
+            engine=args.engine,
+            max_workers=args.workers,
+            max_streams=args.streams,
+            initializer=functools.partial(setup_worker, args=args),
+            admission_options=admission_options,
+        )
+    elif args.engine == "asyncio":
+        database = fileserve.Database(**database_options)
+        server = fileserve.AsyncFileServer(
+            database=database,
+            server_address=(args.ip, args.port),
+            max_workers=args.workers,
+            max_streams=args.streams,
+            admission=fileserve.AdmissionControl(**admission_options),
+        )
+    else:
+        database = fileserve.Database(**database_options)
+        server = fileserve.FileServer(
+            database=database,
+            server_address=(args.ip, args.port),
+            handler_class=fileserve.RequestHandler,
+            admission=fileserve.AdmissionControl(**admission_options),
+        )
     ip, port = server.server_address
 
     t = threading.Thread(target=server.serve_forever)
@@ -31,4 +207,11 @@ if __name__ == "__main__":
         signal = input("Enter 'kill' to shutdown server: ").lower()
 
     server.shutdown()
-    server.socket.close()
+    server.server_close()
+    if database is not None:
+        print("File cache: {}".format(database.cache.stats()))
+    if metrics_server is not None:
+        metrics_server.shutdown()
+    if stop_dump is not None:
+        stop_dump()
+    listener.stop()
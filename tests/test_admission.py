@@ -0,0 +1,221 @@
+import os
+import time
+import socket
+import threading
+
+import pytest
+
+import fileserve
+from fileserve import protocol
+from fileserve.admission import OVERLOADED, TokenBucket
+
+
+USER1 = "foo1"
+USER2 = "foo2"
+FILENAME = "tmp.bin"
+
+
+def start_server(engine, admission):
+    if engine == "asyncio":
+        server = fileserve.AsyncFileServer(
+            database=fileserve.Database(sync_every=0),
+            server_address=("localhost", 0),
+            admission=admission,
+        )
+    else:
+        server = fileserve.FileServer(
+            database=fileserve.Database(sync_every=0),
+            server_address=("localhost", 0),
+            admission=admission,
+        )
+
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    return server
+
+
+@pytest.fixture(params=["thread", "asyncio"])
+def serve(request, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    servers = []
+
+    def serve(**options):
+        server = start_server(request.param, fileserve.AdmissionControl(**options))
+        servers.append(server)
+        return server.server_address[1]
+
+    yield serve
+
+    for server in servers:
+        server.shutdown(str(tmp_path / "db.json"))
+        server.server_close()
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=2, burst=3, now=0.0)
+    assert [bucket.take(0.0) for _ in range(4)] == [True, True, True, False]
+    assert bucket.take(0.5) and not bucket.take(0.5)
+    assert bucket.take(10.0) and bucket.tokens == 2
+
+
+def test_rate_limits_shed_floods(serve):
+    port = serve(user_rate=5, user_burst=5, operation_rates={"add_user": (0.01, 2)})
+    flooder = fileserve.Client(USER1, port=port)
+    other = fileserve.Client(USER2, port=port)
+
+    # add_user is limited across users as it is unauthenticated
+    assert flooder.run("add_user", "", "")["header"] == "success"
+    assert other.run("add_user", "", "")["header"] == "success"
+    third = fileserve.Client("foo3", port=port)
+    assert third.run("add_user", "", "")["header"] == OVERLOADED
+    third.close()
+
+    headers = [flooder.run("list_files", "", "")["header"] for _ in range(20)]
+    assert headers.count("success") <= 6 and headers[-1] == OVERLOADED
+
+    # The flooder is refused without holding up anyone else
+    for _ in range(4):
+        response = other.run("list_files", "", "")
+        assert response["header"] == "success"
+
+    # A refused streamed upload is skipped and the connection stays usable
+    fileserve.utils.save_file(flooder.FILE_DIR, FILENAME, os.urandom(3 << 20))
+    assert flooder.run("upload_file", FILENAME, "")["header"] == OVERLOADED
+    time.sleep(0.5)
+    assert flooder.run("upload_file", FILENAME, "")["header"] == "success"
+    flooder.close()
+    other.close()
+
+
+def test_connection_caps(serve):
+    port = serve(max_connections=4, max_user_connections=2)
+    client = fileserve.Client(USER1, port=port)
+    client.run("add_user", "", "")
+
+    # A user past its connections is refused, sessions or not
+    second = fileserve.Client(USER1, port=port)
+    assert second.run("list_files", "", "")["header"] == "success"
+    third = fileserve.Client(USER1, port=port)
+    assert third.run("list_files", "", "")["header"] == OVERLOADED
+    plain = fileserve.Client(USER1, port=port, session=False)
+    assert plain.run("list_files", "", "")["header"] == OVERLOADED
+
+    second.close()
+    time.sleep(0.2)
+    assert third.run("list_files", "", "")["header"] == "success"
+    for c in [client, third, plain]:
+        c.close()
+    time.sleep(0.2)
+
+    # Past the global cap new connections are answered quickly then closed
+    idle = [socket.create_connection(("localhost", port)) for _ in range(4)]
+    time.sleep(0.2)
+    refused = [fileserve.Client(USER2, port=port, session=session) for session in [True, False]]
+    start = time.time()
+    for c in refused:
+        assert c.run("add_user", "", "")["header"] == OVERLOADED
+    assert time.time() - start < 1.0
+
+    for s in idle:
+        s.close()
+    time.sleep(0.2)
+    for c in refused:
+        assert c.run("list_files" if c.use_session else "add_user", "", "")["header"] != OVERLOADED
+        c.close()
+
+
+def test_inflight_bytes(serve):
+    port = serve(max_user_inflight_bytes=64 * 1024)
+    client = fileserve.Client(USER1, port=port, stream=False)
+    client.run("add_user", "", "")
+
+    # Frames over the budget are refused from their header without being buffered
+    fileserve.utils.save_file(client.FILE_DIR, FILENAME, os.urandom(256 * 1024))
+    response = client.run("upload_file", FILENAME, "")
+    assert response["header"] == OVERLOADED
+    assert response["data"]["error"] == "too many bytes in flight for {}".format(USER1)
+
+    fileserve.utils.save_file(client.FILE_DIR, FILENAME, os.urandom(16 * 1024))
+    assert client.run("upload_file", FILENAME, "")["header"] == "success"
+    client.close()
+
+
+def test_read_deadline(serve):
+    port = serve(read_timeout=0.5)
+    client = fileserve.Client(USER1, port=port)
+    client.run("add_user", "", "")
+
+    # A client trickling a request is cut off while others are served
+    slow = socket.create_connection(("localhost", port))
+    slow.sendall(protocol.pack_header(protocol.MSG_REQUEST, 1000) + b"x")
+    for _ in range(3):
+        assert client.run("list_files", "", "")["header"] == "success"
+
+    slow.settimeout(5)
+    start = time.time()
+    assert slow.recv(1) == b""
+    assert time.time() - start < 2
+    slow.close()
+    client.close()
+
+
+def test_stream_slots(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    server = fileserve.AsyncFileServer(
+        database=fileserve.Database(sync_every=0),
+        server_address=("localhost", 0),
+        max_workers=1,
+        max_streams=1,
+    )
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    port = server.server_address[1]
+
+    slow = fileserve.Client(USER1, port=port)
+    other = fileserve.Client(USER2, port=port)
+    slow.run("add_user", "", "")
+    other.run("add_user", "", "")
+    fileserve.utils.save_file(other.FILE_DIR, FILENAME, os.urandom(1 << 20))
+    assert other.run("upload_file", FILENAME, "")["header"] == "success"
+
+    # An upload whose client stalls after its request holds the only stream slot
+    stalled = threading.Event()
+    send_chunks = fileserve.streaming.send_chunks
+
+    def stall(*args):
+        stalled.wait(10)
+        send_chunks(*args)
+
+    monkeypatch.setattr(fileserve.streaming, "send_chunks", stall)
+    fileserve.utils.save_file(slow.FILE_DIR, "slow.bin", os.urandom(1 << 20))
+    results = []
+    upload = threading.Thread(
+        target=lambda: results.append(slow.run("upload_file", "slow.bin", "")["header"])
+    )
+    upload.start()
+
+    deadline = time.time() + 5
+    while server.streams.acquire(blocking=False):
+        server.streams.release()
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+    # The work slot is free for others, while further streams are refused
+    assert other.run("list_files", "", "")["header"] == "success"
+    os.remove(os.path.join(other.FILE_DIR, FILENAME))
+    assert other.run("download_file", FILENAME, "")["header"] == OVERLOADED
+
+    # The slot is free again by the time the upload's response arrives
+    stalled.set()
+    upload.join(10)
+    assert results == ["success"]
+    assert other.run("download_file", FILENAME, "")["header"] == "success"
+    os.remove(os.path.join(other.FILE_DIR, FILENAME))
+    assert other.run("download_file", FILENAME, "")["header"] == "success"
+
+    for c in [slow, other]:
+        c.close()
+    server.shutdown(str(tmp_path / "db.json"))
+    server.server_close()
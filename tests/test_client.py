@@ -0,0 +1,322 @@
+import os
+import time
+import socket
+import threading
+import urllib.request
+
+import pytest
+
+import fileserve
+
+
+USER1 = "foo1"
+USER2 = "foo2"
+FILENAME = "tmp.bin"
+DATA = os.urandom(3 * 1024 * 1024 + 7)
+
+
+@pytest.fixture(params=["thread", "asyncio"])
+def server(request, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    if request.param == "asyncio":
+        server = fileserve.AsyncFileServer(
+            database=fileserve.Database(),
+            server_address=("localhost", 0),
+        )
+    else:
+        server = fileserve.FileServer(
+            database=fileserve.Database(),
+            server_address=("localhost", 0),
+        )
+
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+
+    yield server
+
+    server.shutdown(str(tmp_path / "db.json"))
+    server.server_close()
+
+
+def test_client_roundtrip(server):
+    port = server.server_address[1]
+    client1 = fileserve.Client(USER1, port=port)
+    client2 = fileserve.Client(USER2, port=port, stream=False)
+
+    client1.run("add_user", "", "")
+    client2.run("add_user", "", "")
+    assert USER1 in server.database.users
+    assert USER2 in server.database.users
+
+    fileserve.utils.save_file(client1.FILE_DIR, FILENAME, DATA)
+    client1.run("upload_file", FILENAME, "")
+    assert server.database.files[FILENAME]["owner"] == USER1
+
+    client1.run("share_file", FILENAME, USER2)
+    assert client2.list_files() == [(FILENAME, USER1)]
+    client2.run("download_file", FILENAME, "")
+    assert fileserve.utils.read_file(client2.FILE_DIR, FILENAME) == DATA
+
+    client1.run("revoke_access", FILENAME, USER2)
+    assert client2.list_files() == []
+    assert client2.run("download_file", FILENAME, "")["header"] == "failure"
+
+    os.remove(os.path.join(client1.FILE_DIR, FILENAME))
+    client1.run("download_file", FILENAME, "")
+    assert fileserve.utils.read_file(client1.FILE_DIR, FILENAME) == DATA
+
+    client1.run("delete_file", FILENAME, "")
+    assert FILENAME not in server.database.files
+
+def test_update_sends_only_changes(server):
+    port = server.server_address[1]
+    client = fileserve.Client(USER1, port=port)
+    client.run("add_user", "", "")
+
+    fileserve.utils.save_file(client.FILE_DIR, FILENAME, DATA)
+    client.run("upload_file", FILENAME, "")
+
+    edited = DATA[:1000] + b"edit" + DATA[1004:2000000] + b"inserted" + DATA[2000000:]
+    fileserve.utils.save_file(client.FILE_DIR, FILENAME, edited)
+
+    request = client.generate_update(
+        FILENAME, client.exchange(client.generate_request("file_signature", FILENAME, ""))
+    )
+    assert len(request["data"]["data"]) < len(DATA) // 100
+
+    client.run("update_file", FILENAME, "")
+    assert server.database.files[FILENAME]["version"] == 1
+
+    os.remove(os.path.join(client.FILE_DIR, FILENAME))
+    client.run("download_file", FILENAME, "")
+    assert fileserve.utils.read_file(client.FILE_DIR, FILENAME) == edited
+
+    # A delta against an old version is refused
+    request["data"]["version"] = 0
+    assert client.exchange(request)["header"] == "failure"
+    client.close()
+
+def test_keepalive_reconnects_after_idle_timeout(server):
+    server.idle_timeout = 0.2
+    client = fileserve.Client(USER1, port=server.server_address[1])
+
+    client.run("add_user", "", "")
+    channel = client.channel
+    client.run("add_user", "", "")
+    assert client.channel is channel
+
+    time.sleep(0.5)
+    client.run("add_user", "", "")
+    assert client.channel is not channel
+    client.close()
+
+def test_session_resumption(server):
+    client = fileserve.Client(USER1, port=server.server_address[1])
+
+    client.run("add_user", "", "")
+    assert client.channel.session is not None
+    assert not client.channel.session.resumed
+
+    client.close()
+    client.run("add_user", "", "")
+    assert client.channel.session.resumed
+    client.close()
+
+    # A ticket from another server instance falls back to a full handshake
+    server.processor.sessions = fileserve.session.SessionManager()
+    client.run("add_user", "", "")
+    assert not client.channel.session.resumed
+    client.close()
+
+@pytest.mark.parametrize("session", [True, False])
+def test_requests_act_as_their_sender(server, monkeypatch, session):
+    port = server.server_address[1]
+    victim = fileserve.Client(USER2, port=port)
+    victim.run("add_user", "", "")
+    fileserve.utils.save_file(victim.FILE_DIR, FILENAME, DATA)
+    assert victim.run("upload_file", FILENAME, "")["header"] == "success"
+    victim.close()
+
+    # USER1 is authenticated but names USER2 as the user to act as
+    client = fileserve.Client(USER1, port=port, session=session)
+    client.run("add_user", "", "")
+    generate_request = client.generate_request
+
+    def impersonate(*args):
+        request = generate_request(*args)
+        request["data"]["user1"] = USER2
+        return request
+
+    monkeypatch.setattr(client, "generate_request", impersonate)
+    with pytest.raises((ConnectionError, fileserve.protocol.ProtocolError)):
+        client.run("delete_file", FILENAME, "")
+    client.close()
+
+    assert FILENAME in server.database.files
+
+@pytest.mark.parametrize("processes", [0, 2])
+def test_batch_upload_and_download(server, tmp_path, processes):
+    port = server.server_address[1]
+    fileserve.Client(USER1, port=port).run("add_user", "", "")
+
+    upload_dir = tmp_path / "outbox"
+    upload_dir.mkdir()
+    files = {"file{}.bin".format(i): os.urandom(100000 + i) for i in range(8)}
+    for name, data in files.items():
+        (upload_dir / name).write_bytes(data)
+
+    batch = fileserve.BatchClient(
+        USER1, port=port, connections=3, processes=processes, file_dir=str(upload_dir)
+    )
+    results = batch.upload_dir()
+    assert [result.filename for result in results] == sorted(files)
+    assert all(result.ok for result in results)
+    assert sorted(server.database.files) == sorted(files)
+
+    batch = fileserve.BatchClient(
+        USER1, port=port, connections=3, processes=processes, file_dir=str(tmp_path / "inbox")
+    )
+    results = batch.download_many(list(files) + ["missing.bin"])
+    assert [result.ok for result in results] == [True] * len(files) + [False]
+    assert "doesn't exist" in results[-1].error
+    for name, data in files.items():
+        assert (tmp_path / "inbox" / name).read_bytes() == data
+
+def test_batch_retries_connection_errors(server):
+    s = socket.socket()
+    s.bind(("localhost", 0))
+    closed_port = s.getsockname()[1]
+    s.close()
+
+    batch = fileserve.BatchClient(USER1, port=closed_port, retries=2, backoff=0.01)
+    results = batch.download_many([FILENAME])
+    assert not results[0].ok
+    assert results[0].attempts == 3
+
+def test_interrupted_transfers_resume(server, monkeypatch):
+    port = server.server_address[1]
+    client = fileserve.Client(USER1, port=port)
+    client.run("add_user", "", "")
+    fileserve.utils.save_file(client.FILE_DIR, FILENAME, DATA)
+
+    send_chunks, recv_chunks = fileserve.streaming.send_chunks, fileserve.streaming.recv_chunks
+
+    def cut(chunks):
+        for i, chunk in enumerate(chunks):
+            if i == 2:
+                raise ConnectionResetError("connection cut")
+            yield chunk
+
+    # Drop the connection after two chunks of the upload
+    with monkeypatch.context() as m, pytest.raises(ConnectionResetError):
+        m.setattr(
+            fileserve.streaming, "send_chunks", lambda channel, key, chunks, *args: send_chunks(
+                channel, key, cut(chunks), *args
+            )
+        )
+        client.run("upload_file", FILENAME, "")
+
+    upload_id = client.uploads[FILENAME]["upload_id"]
+    deadline = time.time() + 5
+    while upload_id not in server.database.uploads and time.time() < deadline:
+        time.sleep(0.01)
+    while server.database.uploads[upload_id]["active"] and time.time() < deadline:
+        time.sleep(0.01)
+    assert server.database.uploads[upload_id]["offset"] == 2 * fileserve.streaming.CHUNK_SIZE
+
+    assert client.run("upload_file", FILENAME, "")["header"] == "success"
+    assert server.database.uploads == {}
+    assert server.database.download_file(USER1, FILENAME)["data"]["data"] == DATA
+
+    # Drop the connection after two chunks of the download
+    os.remove(os.path.join(client.FILE_DIR, FILENAME))
+    with monkeypatch.context() as m, pytest.raises(ConnectionResetError):
+        m.setattr(
+            fileserve.streaming, "recv_chunks", lambda channel, key, *args: cut(
+                recv_chunks(channel, key, *args)
+            )
+        )
+        client.run("download_file", FILENAME, "")
+
+    part = os.path.join(client.FILE_DIR, fileserve.client.part_name(FILENAME))
+    assert os.path.getsize(part) == 2 * fileserve.streaming.CHUNK_SIZE
+
+    assert client.run("download_file", FILENAME, "")["header"] == "success"
+    assert fileserve.utils.read_file(client.FILE_DIR, FILENAME) == DATA
+    assert not os.path.exists(part)
+
+def test_ranged_downloads(server, tmp_path):
+    port = server.server_address[1]
+    client = fileserve.Client(USER1, port=port)
+    client.run("add_user", "", "")
+    fileserve.utils.save_file(client.FILE_DIR, FILENAME, DATA)
+    client.run("upload_file", FILENAME, "")
+
+    response = client.download_range(FILENAME, 1000, 50)
+    assert response["data"]["size"] == 50
+    assert response["data"]["total"] == len(DATA)
+    part = fileserve.client.part_name(FILENAME)
+    with open(os.path.join(client.FILE_DIR, part), "rb") as f:
+        f.seek(1000)
+        assert f.read() == DATA[1000:1050]
+
+    response = client.download_range(FILENAME, 0, 50, digest=bytes(32))
+    assert "has changed" in response["data"]["error"]
+
+    batch = fileserve.BatchClient(USER1, port=port, file_dir=str(tmp_path / "inbox"))
+    result = batch.download_ranges(FILENAME, streams=3)
+    assert result.ok and result.size == len(DATA)
+    assert (tmp_path / "inbox" / FILENAME).read_bytes() == DATA
+
+@pytest.mark.parametrize("stream", [True, False])
+def test_compressed_transfers(server, stream):
+    port = server.server_address[1]
+    client = fileserve.Client(USER1, port=port, stream=stream, compression="zlib")
+    client.run("add_user", "", "")
+
+    text = b"".join(b"line %d of a log file\n" % i for i in range(200000))
+    fileserve.utils.save_file(client.FILE_DIR, FILENAME, text)
+    client.run("upload_file", FILENAME, "")
+    assert server.database.download_file(USER1, FILENAME)["data"]["data"] == text
+
+    os.remove(os.path.join(client.FILE_DIR, FILENAME))
+    client.run("download_file", FILENAME, "")
+    assert fileserve.utils.read_file(client.FILE_DIR, FILENAME) == text
+
+def test_metrics(server):
+    fileserve.metrics.registry.clear()
+    endpoint = fileserve.metrics.serve(("localhost", 0))
+
+    try:
+        port = server.server_address[1]
+        client = fileserve.Client(USER1, port=port)
+        client.run("add_user", "", "")
+
+        fileserve.utils.save_file(client.FILE_DIR, FILENAME, DATA)
+        client.run("upload_file", FILENAME, "")
+        client.run("upload_file", FILENAME, "")
+        os.remove(os.path.join(client.FILE_DIR, FILENAME))
+        client.run("download_file", FILENAME, "")
+
+        metrics = fileserve.metrics
+        assert metrics.requests_total.get("upload_file", "success") == 1
+        assert metrics.requests_total.get("upload_file", "failure") == 1
+        assert metrics.requests_total.get("download_file", "success") == 1
+        assert metrics.request_seconds.count("download_file") == 1
+        assert metrics.received_bytes.get() > 2 * len(DATA)
+        for stage in ["recv", "decode", "decrypt", "aead_decrypt", "check", "apply",
+                      "encrypt", "send", "disk_read", "disk_write", "journal_sync"]:
+            assert metrics.stage_seconds.count(stage) > 0, stage
+
+        url = "http://localhost:{}/metrics".format(endpoint.server_address[1])
+        with urllib.request.urlopen(url) as response:
+            text = response.read().decode()
+        assert 'fileserve_requests_total{header="upload_file",status="failure"} 1' in text
+        assert 'fileserve_stage_seconds_bucket{stage="decrypt",le="+Inf"}' in text
+
+    finally:
+        endpoint.shutdown()
+        endpoint.server_close()
+        fileserve.metrics.disable()
@@ -0,0 +1,54 @@
+import os
+import pytest
+
+from fileserve import crypto
+from fileserve.keystore import KeyStore
+
+
+PUB_KEY, PRIV_KEY = crypto.generate_keys()
+DATA = b"some plaintext message" * 1000
+
+
+def test_hybrid_roundtrip():
+    ciphertext, mac = crypto.hybrid_encrypt(DATA, PUB_KEY, PRIV_KEY)
+    assert len(ciphertext) > len(DATA)
+    assert crypto.hybrid_decrypt(ciphertext, mac, PUB_KEY, PRIV_KEY) == DATA
+
+def test_hybrid_tampered_ciphertext():
+    ciphertext, mac = crypto.hybrid_encrypt(DATA, PUB_KEY, PRIV_KEY)
+    ciphertext = bytearray(ciphertext)
+    ciphertext[-1] ^= 1
+    with pytest.raises(ValueError):
+        crypto.hybrid_decrypt(bytes(ciphertext), mac, PUB_KEY, PRIV_KEY)
+
+def test_hybrid_bad_signature():
+    other_pub_key, other_priv_key = crypto.generate_keys()
+    ciphertext, mac = crypto.hybrid_encrypt(DATA, PUB_KEY, other_priv_key)
+    with pytest.raises(ValueError):
+        crypto.hybrid_decrypt(ciphertext, mac, PUB_KEY, PRIV_KEY)
+
+def test_keystore_reloads_on_mtime(tmp_path):
+    path = str(tmp_path / "foo_public.pem")
+    with open(path, "wb") as f:
+        f.write(PUB_KEY)
+
+    store = KeyStore(check_interval=0)
+    key = store.get(path)
+    assert store.get(path) is key
+    assert store.hits == 1
+
+    other_pub_key, _ = crypto.generate_keys()
+    with open(path, "wb") as f:
+        f.write(other_pub_key)
+    os.utime(path, ns=(0, 0))
+    assert store.get(path) != key
+    assert store.misses == 2
+
+def test_keystore_evicts_lru(tmp_path):
+    store = KeyStore(max_keys=2)
+    for i in range(3):
+        path = str(tmp_path / "{}_public.pem".format(i))
+        with open(path, "wb") as f:
+            f.write(PUB_KEY)
+        store.get(path)
+    assert len(store) == 2
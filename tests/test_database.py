@@ -0,0 +1,497 @@
+import os
+import copy
+import json
+import hashlib
+import random
+import threading
+
+import pytest
+
+import fileserve
+from fileserve.journal import Journal
+from fileserve.server import RequestProcessor, new_request
+
+
+USER1 = "foo1"
+USER2 = "foo2"
+FILENAME = "tmp.txt"
+DATA = "some plaintext message".encode()
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def test_journal_replayed_after_crash(workdir):
+    db = fileserve.Database()
+    db.add_user(USER1)
+    db.add_user(USER2)
+    db.upload_file(USER1, FILENAME, DATA)
+    db.share_file(USER2, FILENAME)
+
+    # No save, a new instance recovers from the journal alone
+    db = fileserve.Database()
+    assert USER1 in db.users and USER2 in db.users
+    assert db.files[FILENAME]["owner"] == USER1
+    assert db.files[FILENAME]["access"] == {USER1, USER2}
+
+def test_journal_compaction(workdir):
+    db = fileserve.Database(compact_every=3)
+    db.add_user(USER1)
+    db.add_user(USER2)
+    db.upload_file(USER1, FILENAME, DATA)
+    assert db.journal.records == 0
+    assert os.path.exists(os.path.join(db.DB_DIR, db.db_file))
+
+    db.delete_file(USER1, FILENAME)
+    assert db.journal.records == 1
+
+    db = fileserve.Database()
+    assert FILENAME not in db.files
+    assert USER2 in db.users
+
+def test_journal_torn_tail(workdir):
+    path = str(workdir / "journal.log")
+    journal = Journal(path)
+    journal.sync(journal.append("add_user", user=USER1))
+    journal.close()
+
+    with open(path, "ab") as f:
+        f.write(b'{"op": "add_user", "us')
+
+    assert Journal.replay(path) == [{"op": "add_user", "user": USER1}]
+    assert open(path, "rb").read().endswith(b"}\n")
+
+
+def make_request(header, user1, filename="", user2="", data=b""):
+    request = new_request()
+    request["header"] = header
+    request["sender"] = user1
+    request["data"]["user1"] = user1
+    request["data"]["user2"] = user2
+    request["data"]["filename"] = filename
+    request["data"]["data"] = data
+    return request
+
+def run_threads(target, count):
+    barrier = threading.Barrier(count)
+    errors = []
+
+    def run(i):
+        barrier.wait()
+        try:
+            target(i)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert errors == []
+
+def test_concurrent_uploads_of_one_name(workdir):
+    db = fileserve.Database(sync_every=0)
+    processor = RequestProcessor(db)
+    users = ["user{}".format(i) for i in range(16)]
+    for user in users:
+        db.add_user(user)
+
+    results = [None] * len(users)
+
+    def upload(i):
+        request = make_request("upload_file", users[i], FILENAME, data=users[i].encode())
+        results[i] = processor.process_request(None, request)["header"]
+
+    run_threads(upload, len(users))
+
+    # Exactly one upload wins and the stored contents are its own
+    assert results.count("success") == 1
+    winner = users[results.index("success")]
+    assert db.files[FILENAME]["owner"] == winner
+    assert db.files[FILENAME]["access"] == {winner}
+    assert open(os.path.join(db.FILE_DIR, FILENAME), "rb").read() == winner.encode()
+
+@pytest.mark.parametrize("storage", ["flat", "chunked", "compressed"])
+def test_concurrent_mixed_operations(workdir, storage):
+    db = fileserve.Database(sync_every=0, storage=storage)
+    processor = RequestProcessor(db)
+    users = ["user{}".format(i) for i in range(4)]
+    filenames = ["file{}.txt".format(i) for i in range(4)]
+    for user in users:
+        db.add_user(user)
+
+    def worker(i):
+        rng = random.Random(i)
+        for _ in range(200):
+            user1, user2 = rng.sample(users, 2)
+            filename = rng.choice(filenames)
+            header = rng.choice(
+                ["upload_file", "download_file", "share_file", "revoke_access", "delete_file"]
+            )
+            request = make_request(header, user1, filename, user2, DATA)
+            response = processor.process_request(None, request)
+            if header == "download_file" and response["header"] == "success":
+                assert response["data"]["data"] == DATA
+
+    run_threads(worker, 8)
+
+    # Metadata matches the stored files and the access index matches the metadata
+    if storage != "flat":
+        refs = dict(db.storage.refs)
+        db.storage.recover()
+        assert dict(db.storage.refs) == refs
+        assert sorted(db.files) == sorted(os.listdir(db.storage.manifest_dir))
+    else:
+        assert sorted(db.files) == sorted(os.listdir(db.FILE_DIR))
+    for filename, info in db.files.items():
+        assert info["owner"] in info["access"]
+        for user in info["access"]:
+            assert filename in db.acl.files_of(user)
+    for user in users:
+        assert all(user in db.files[filename]["access"] for filename in db.acl.files_of(user))
+
+    # Replaying the interleaved journal reproduces the same state
+    files = copy.deepcopy(db.files)
+    db.journal.close()
+    replayed = fileserve.Database(storage=storage)
+    assert replayed.files == files
+    assert replayed.acl.owned == db.acl.owned and replayed.acl.shared == db.acl.shared
+    assert replayed.acl.readable == db.acl.readable
+
+def test_chunk_store_deduplicates(workdir):
+    db = fileserve.Database(sync_every=0, storage="chunked")
+    size = db.storage.chunk_size
+    base = os.urandom(size * 4)
+    edited = base[:size] + os.urandom(size) + base[size * 2:]
+
+    db.add_user(USER1)
+    db.upload_file(USER1, "v1.bin", base)
+    db.upload_file(USER1, "v2.bin", edited)
+    db.upload_file(USER1, "copy.bin", base)
+
+    # Only the edited chunk is stored a second time
+    assert len(db.storage.refs) == 5
+    assert db.download_file(USER1, "v2.bin")["data"]["data"] == edited
+
+    # A reader keeps its chunks after the file is deleted
+    reader = db.read_chunks("v2.bin")
+    db.delete_file(USER1, "v2.bin")
+    assert b"".join(reader) == edited
+    assert len(db.storage.refs) == 4
+
+    db.delete_file(USER1, "v1.bin")
+    db.delete_file(USER1, "copy.bin")
+    assert len(db.storage.refs) == 0
+    assert sum(len(files) for _, _, files in os.walk(db.storage.chunk_dir)) == 0
+
+def test_compressed_store(workdir):
+    db = fileserve.Database(sync_every=0, storage="compressed")
+    text = b"".join(b"line %d of a log file\n" % i for i in range(100000))
+    noise = os.urandom(100000)
+
+    db.add_user(USER1)
+    db.upload_file(USER1, "text.log", text)
+    db.upload_file(USER1, "noise.bin", noise)
+
+    assert db.storage.usage() < len(text) // 2 + len(noise) + 1000
+    assert db.download_file(USER1, "text.log")["data"]["data"] == text
+    assert db.download_file(USER1, "noise.bin")["data"]["data"] == noise
+    assert db.storage.read_range("text.log", 70000, 100) == text[70000:70100]
+
+@pytest.mark.parametrize("storage", ["flat", "chunked", "compressed"])
+def test_update_file_from_delta(workdir, storage):
+    db = fileserve.Database(sync_every=0, storage=storage)
+    base = os.urandom(300000)
+    edited = base[:5000] + b"changed" + base[5000:250000] + base[260000:]
+
+    db.add_user(USER1)
+    db.upload_file(USER1, FILENAME, base)
+
+    signature = db.file_signature(USER1, FILENAME)["data"]["data"]
+    changes = fileserve.delta.diff(edited, signature)
+    digest = hashlib.sha256(edited).digest()
+
+    # A delta that does not rebuild the client's file leaves it untouched
+    assert db.update_file(USER1, FILENAME, changes, b"wrong")["header"] == "failure"
+    assert db.download_file(USER1, FILENAME)["data"]["data"] == base
+
+    assert db.update_file(USER1, FILENAME, changes, digest)["data"]["version"] == 1
+    assert db.download_file(USER1, FILENAME)["data"]["data"] == edited
+
+    db.journal.close()
+    assert fileserve.Database(storage=storage).files[FILENAME]["version"] == 1
+
+def test_file_cache(workdir, monkeypatch):
+    db = fileserve.Database(sync_every=0, cache_bytes=4096)
+    db.add_user(USER1)
+    db.upload_file(USER1, "a.txt", b"a" * 1000)
+    db.upload_file(USER1, "b.txt", b"b" * 1000)
+    db.upload_file(USER1, "big.bin", b"x" * 1000)
+
+    # Files over an eighth of the budget bypass the cache
+    db.download_file(USER1, "big.bin")
+    assert "big.bin" not in db.cache
+    db.upload_file(USER1, "small.txt", b"s" * 100)
+    db.download_file(USER1, "small.txt")
+    assert db.download_file(USER1, "small.txt")["data"]["data"] == b"s" * 100
+    assert db.cache.hits == 1
+
+    # Changing or deleting a file invalidates it
+    signature = db.file_signature(USER1, "small.txt")["data"]["data"]
+    edited = b"t" * 100
+    db.update_file(
+        USER1, "small.txt", fileserve.delta.diff(edited, signature), hashlib.sha256(edited).digest()
+    )
+    assert "small.txt" not in db.cache
+    assert b"".join(db.read_chunks("small.txt")) == edited
+    db.delete_file(USER1, "small.txt")
+    assert "small.txt" not in db.cache
+
+    # The least recently used file is evicted past the budget
+    cache = fileserve.cache.FileCache(max_bytes=250, max_file_size=100)
+    for name in "abc":
+        cache.put(name, name.encode() * 100)
+    assert "a" not in cache and cache.evictions == 1 and cache.size == 200
+
+    # Large streamed reads come from a memory map
+    monkeypatch.setattr(fileserve.storage, "MMAP_SIZE", 500)
+    chunks = list(db.storage.read_chunks("big.bin", 300, offset=100))
+    assert [type(chunk) for chunk in chunks] == [memoryview] * 3
+    assert b"".join(chunks) == b"x" * 900
+
+def test_access_index(workdir, monkeypatch):
+    db = fileserve.Database()
+    processor = RequestProcessor(db)
+    db.add_user(USER1)
+    db.add_user(USER2)
+    for name in ["c.txt", "a.txt", "b.txt"]:
+        db.upload_file(USER1, name, DATA)
+    db.upload_file(USER2, "own.txt", DATA)
+    db.share_file(USER2, "a.txt")
+    db.share_file(USER2, "c.txt")
+
+    def listing(user, offset=0):
+        request = make_request("list_files", user)
+        request["data"]["offset"] = offset
+        response = processor.process_request(None, request)
+        return json.loads(response["data"]["data"]), response["data"]["size"]
+
+    # Owned and shared files are listed by name a page at a time
+    monkeypatch.setattr(fileserve.database, "LIST_PAGE_SIZE", 2)
+    assert listing(USER2) == ([["a.txt", USER1], ["c.txt", USER1]], 3)
+    assert listing(USER2, 2) == ([["own.txt", USER2]], 3)
+    assert listing(USER1)[1] == 3
+
+    # Only the owner can revoke, and not from themselves
+    revoke = make_request("revoke_access", USER2, "a.txt", USER2)
+    assert processor.process_request(None, revoke)["header"] == "failure"
+    revoke = make_request("revoke_access", USER1, "a.txt", USER1)
+    assert processor.process_request(None, revoke)["header"] == "failure"
+    revoke = make_request("revoke_access", USER1, "a.txt", USER2)
+    assert processor.process_request(None, revoke)["header"] == "success"
+    assert processor.process_request(None, revoke)["header"] == "failure"
+
+    download = make_request("download_file", USER2, "a.txt")
+    assert processor.process_request(None, download)["data"]["error"] == (
+        "user1 {} not authorized to download file a.txt".format(USER2)
+    )
+    assert db.acl.files_of(USER2) == ["c.txt", "own.txt"]
+    assert db.acl.files_of(USER2, 1, 1) == ["own.txt"] and db.acl.count(USER2) == 2
+
+    # Deleting a file drops it for everyone and a restart rebuilds the index
+    db.delete_file(USER1, "c.txt")
+    assert db.acl.files_of(USER2) == ["own.txt"]
+    db.save()
+    db.journal.close()
+    db = fileserve.Database()
+    assert db.acl.files_of(USER1) == ["a.txt", "b.txt"]
+    assert db.acl.files_of(USER2) == ["own.txt"]
+
+def test_sqlite_metadata(workdir, monkeypatch):
+    db = fileserve.Database(metadata="sqlite")
+    processor = RequestProcessor(db)
+    db.add_user(USER1)
+    db.add_user(USER2)
+    for name in ["c.txt", "a.txt", "b.txt"]:
+        db.upload_file(USER1, name, DATA)
+    db.share_file(USER2, "a.txt")
+
+    # Checks and listings read through the tables
+    monkeypatch.setattr(fileserve.database, "LIST_PAGE_SIZE", 2)
+    request = make_request("list_files", USER1)
+    response = processor.process_request(None, request)
+    assert json.loads(response["data"]["data"]) == [["a.txt", USER1], ["b.txt", USER1]]
+    assert response["data"]["size"] == 3
+
+    download = make_request("download_file", USER2, "b.txt")
+    assert processor.process_request(None, download)["header"] == "failure"
+    download = make_request("download_file", USER2, "a.txt")
+    assert processor.process_request(None, download)["data"]["data"] == DATA
+
+    revoke = make_request("revoke_access", USER1, "a.txt", USER1)
+    assert processor.process_request(None, revoke)["header"] == "failure"
+    revoke = make_request("revoke_access", USER1, "a.txt", USER2)
+    assert processor.process_request(None, revoke)["header"] == "success"
+    assert processor.process_request(None, download)["header"] == "failure"
+
+    # Reuploading a name resets its grants to the new owner
+    db.delete_file(USER1, "c.txt")
+    db.upload_file(USER2, "c.txt", DATA)
+    assert db.files["c.txt"]["access"] == {USER2}
+
+    # Everything is in the database on restart, no snapshot or journal
+    db.close()
+    db = fileserve.Database(metadata="sqlite")
+    assert set(db.users) == {USER1, USER2}
+    assert db.files["a.txt"]["access"] == {USER1}
+    assert db.metadata.list_files(USER2, 0, 10) == ([["c.txt", USER2]], 1)
+    assert not os.path.exists(os.path.join(db.DB_DIR, "db.json"))
+
+    # An export has the format of the JSON backend
+    db.save("export.json")
+    exported = json.load(open("export.json"))
+    assert exported["files"]["a.txt"] == {
+        "owner": USER1, "access": [USER1], "digest": hashlib.sha256(DATA).hexdigest(), "version": 0
+    }
+    db.close()
+
+def test_sqlite_migration(workdir):
+    import migrate_db
+
+    db = fileserve.Database()
+    db.add_user(USER1)
+    db.add_user(USER2)
+    db.upload_file(USER1, FILENAME, DATA)
+    db.save()
+    db.share_file(USER2, FILENAME)
+    db.close()
+
+    # The snapshot and the journal records after it are imported
+    assert migrate_db.migrate(db.DB_DIR)[:2] == (1, 2)
+    with pytest.raises(ValueError):
+        migrate_db.migrate(db.DB_DIR)
+
+    db = fileserve.Database(metadata="sqlite")
+    assert db.files[FILENAME]["owner"] == USER1
+    assert db.files[FILENAME]["access"] == {USER1, USER2}
+    assert db.download_file(USER2, FILENAME)["data"]["data"] == DATA
+    db.close()
+
+def test_sqlite_concurrent_operations(workdir):
+    db = fileserve.Database(metadata="sqlite", sync_every=0)
+    processor = RequestProcessor(db)
+    users = ["user{}".format(i) for i in range(4)]
+    filenames = ["file{}.txt".format(i) for i in range(4)]
+    for user in users:
+        db.add_user(user)
+
+    def worker(i):
+        rng = random.Random(i)
+        for _ in range(100):
+            user1, user2 = rng.sample(users, 2)
+            header = rng.choice(["upload_file", "download_file", "share_file", "delete_file"])
+            request = make_request(header, user1, rng.choice(filenames), user2, DATA)
+            processor.process_request(None, request)
+
+    run_threads(worker, 8)
+
+    assert sorted(db.files) == sorted(os.listdir(db.FILE_DIR))
+    for filename, info in db.files.items():
+        assert info["owner"] in info["access"]
+    db.close()
+
+def test_operation_registry(workdir):
+    db = fileserve.Database(sync_every=0)
+    processor = RequestProcessor(db)
+    db.add_user(USER1)
+    db.upload_file(USER1, FILENAME, DATA)
+
+    # One registration adds a checked, locked and dispatched operation
+    def check_file_size(data, users, files, upload):
+        return fileserve.error_handling.missing_user(data, users) or (
+            fileserve.error_handling.missing_file(data, files)
+        )
+
+    @fileserve.operations.operation("file_size", check_file_size)
+    def file_size(database, channel, request):
+        response = fileserve.server.new_response("success")
+        response["data"]["size"] = database.storage.size(request["data"]["filename"])
+        return response
+
+    try:
+        response = processor.process_request(None, make_request("file_size", USER1, FILENAME))
+        assert response["header"] == "success" and response["data"]["size"] == len(DATA)
+
+        response = processor.process_request(None, make_request("file_size", USER1, "nope"))
+        assert response["data"]["error"] == "filename nope doesn't exist"
+
+        with pytest.raises(ValueError):
+            fileserve.operations.operation("file_size", check_file_size)(file_size)
+    finally:
+        del fileserve.operations.registry["file_size"]
+
+    response = processor.process_request(None, make_request("file_size", USER1, FILENAME))
+    assert response["data"]["error"] == "unknown header"
+
+    # Responses are built fresh rather than shared
+    assert fileserve.server.new_response() == fileserve.codec.Response(
+        header="failure", data=fileserve.codec.ResponseData()
+    )
+    assert fileserve.server.new_response()["data"] is not fileserve.server.new_response()["data"]
+
+def test_shared_upload_ids_stay_in_upload_dir(workdir):
+    db = fileserve.Database(metadata="sqlite", shared=True, sync_every=0)
+    processor = RequestProcessor(db)
+    db.add_user(USER1)
+
+    # Uploads are read from disk by ID, which must not name other files
+    with open(str(workdir / "outside.json"), "w") as f:
+        json.dump({"user": USER1, "filename": FILENAME, "size": 1}, f)
+    open(str(workdir / "outside.part"), "wb").close()
+
+    upload_id = os.path.join("..", "..", "outside")
+    assert db.find_upload(upload_id) is None
+
+    request = make_request("upload_status", USER1)
+    request["data"]["upload_id"] = upload_id
+    response = processor.process_request(None, request)
+    assert response["data"]["error"] == "upload_id {} is not valid".format(upload_id)
+    db.close()
+
+def test_mismatched_upload_stream(workdir):
+    db = fileserve.Database(sync_every=0)
+    db.add_user(USER1)
+
+    # Mismatched streams fail without storing anything and are read to the end
+    chunks = iter([b"abc", b"def", b"ghi"])
+    response = db.upload_stream(USER1, FILENAME, chunks, 4)
+    assert response["header"] == "failure"
+    assert response["data"]["error"] == (
+        "upload of file {} failed: received more than the announced 4 bytes".format(FILENAME)
+    )
+    assert next(chunks, None) is None
+
+    assert db.upload_stream(USER1, FILENAME, iter([b"abc"]), 4)["header"] == "failure"
+    response = db.upload_stream(USER1, FILENAME, iter([b"abcd"]), 4, digest=b"x" * 32)
+    assert response["header"] == "failure"
+    assert FILENAME not in db.files and not os.path.exists(os.path.join(db.FILE_DIR, FILENAME))
+
+    assert db.upload_stream(USER1, FILENAME, iter([b"abcd"]), 4)["header"] == "success"
+
+    # Resumable uploads are discarded the same way
+    request = make_request("upload_file", USER1, "resumable.txt")
+    request["data"]["upload_id"] = "a" * 32
+    request["data"]["size"] = 4
+    db.begin_upload(request)
+    chunks = iter([b"abc", b"def", b"ghi"])
+    response = db.upload_resumable("a" * 32, chunks)
+    assert response["header"] == "failure"
+    assert response["data"]["error"] == (
+        "upload of file resumable.txt failed: received more than the announced 4 bytes"
+    )
+    assert next(chunks, None) is None
+    assert db.uploads == {} and os.listdir(db.UPLOAD_DIR) == []
@@ -0,0 +1,155 @@
+import os
+import json
+import time
+import signal
+import threading
+
+import pytest
+
+import fileserve
+from fileserve.prefork import PreforkServer
+
+
+USER1 = "foo1"
+USER2 = "foo2"
+FILENAME = "tmp.bin"
+DATA = os.urandom(3 * 1024 * 1024 + 7)
+
+
+@pytest.fixture(params=["thread", "asyncio"])
+def server(request, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    server = PreforkServer(
+        {"sync_every": 0}, ("localhost", 0), processes=2, engine=request.param
+    )
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+
+    yield server
+
+    server.shutdown(str(tmp_path / "db.json"))
+    server.server_close()
+
+
+def run_threads(target, count):
+    barrier = threading.Barrier(count)
+    errors = []
+
+    def run(i):
+        barrier.wait()
+        try:
+            target(i)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert errors == []
+
+
+def test_workers_share_metadata(server, tmp_path):
+    port = server.server_address[1]
+    users = ["user{}".format(i) for i in range(8)]
+    for user in users:
+        fileserve.Client(user, port=port, keepalive=False).run("add_user", "", "")
+
+    # Uploads of one name spread over both workers, exactly one wins
+    results = [None] * len(users)
+
+    def upload(i):
+        client = fileserve.Client(users[i], port=port, keepalive=False, stream=False)
+        fileserve.utils.save_file(client.FILE_DIR, FILENAME, users[i].encode())
+        results[i] = client.run("upload_file", FILENAME, "")["header"]
+
+    run_threads(upload, len(users))
+    assert results.count("success") == 1
+    winner = users[results.index("success")]
+
+    # Sessions resume on either worker and every worker sees each change
+    client = fileserve.Client(winner, port=port)
+    client.run("add_user", "", "")
+    for i in range(6):
+        client.close()
+        response = client.run("download_file", FILENAME, "")
+        assert response["header"] == "success"
+        assert client.channel.session.resumed
+        assert fileserve.utils.read_file(client.FILE_DIR, FILENAME) == winner.encode()
+
+    # A file cached by a worker is not served stale after another replaces it
+    client.run("delete_file", FILENAME, "")
+    fileserve.utils.save_file(client.FILE_DIR, FILENAME, b"replaced")
+    client.run("upload_file", FILENAME, "")
+    for i in range(6):
+        reader = fileserve.Client(winner, port=port, keepalive=False)
+        os.remove(os.path.join(reader.FILE_DIR, FILENAME))
+        assert reader.run("download_file", FILENAME, "")["header"] == "success"
+        assert fileserve.utils.read_file(reader.FILE_DIR, FILENAME) == b"replaced"
+    client.close()
+
+def test_uploads_resume_on_any_worker(server, monkeypatch):
+    port = server.server_address[1]
+    client = fileserve.Client(USER1, port=port)
+    client.run("add_user", "", "")
+    fileserve.utils.save_file(client.FILE_DIR, FILENAME, DATA)
+
+    send_chunks = fileserve.streaming.send_chunks
+
+    def cut(chunks):
+        for i, chunk in enumerate(chunks):
+            if i == 2:
+                raise ConnectionResetError("connection cut")
+            yield chunk
+
+    with monkeypatch.context() as m, pytest.raises(ConnectionResetError):
+        m.setattr(
+            fileserve.streaming, "send_chunks", lambda channel, key, chunks, *args: send_chunks(
+                channel, key, cut(chunks), *args
+            )
+        )
+        client.run("upload_file", FILENAME, "")
+
+    # The upload is reloaded from disk by whichever worker gets the retry,
+    # which may race the worker that was cut off until it notices
+    deadline = time.time() + 10
+    while True:
+        response = client.run("upload_file", FILENAME, "")
+        if response["header"] == "success" or time.time() > deadline:
+            break
+        error = response["data"]["error"]
+        assert "already in progress" in error or "is at offset" in error
+        time.sleep(0.05)
+    assert response["header"] == "success"
+
+    os.remove(os.path.join(client.FILE_DIR, FILENAME))
+    client.run("download_file", FILENAME, "")
+    assert fileserve.utils.read_file(client.FILE_DIR, FILENAME) == DATA
+    assert os.listdir(os.path.join("db", "uploads")) == []
+    client.close()
+
+def test_dead_workers_are_restarted(server, tmp_path):
+    port = server.server_address[1]
+    fileserve.Client(USER1, port=port, keepalive=False).run("add_user", "", "")
+
+    pid = server.workers[0].pid
+    os.kill(pid, signal.SIGKILL)
+    deadline = time.time() + 30
+    while (server.workers[0].pid == pid or not server.workers[0].is_alive()) and (
+        time.time() < deadline
+    ):
+        time.sleep(0.05)
+    assert server.workers[0].pid != pid
+
+    for i in range(4):
+        client = fileserve.Client(USER2, port=port, keepalive=False)
+        expected = "success" if i == 0 else "failure"
+        assert client.run("add_user", "", "")["header"] == expected
+
+    # Shutting down exports the metadata every worker wrote
+    server.shutdown(str(tmp_path / "export.json"))
+    exported = json.load(open(str(tmp_path / "export.json")))
+    assert sorted(exported["users"]) == [USER1, USER2]
@@ -0,0 +1,166 @@
+import io
+import os
+import json
+import pickle
+import socket
+import logging
+import threading
+
+import pytest
+
+from fileserve import logs
+from fileserve import codec
+from fileserve import protocol
+from fileserve import streaming
+
+
+def test_frame_roundtrip():
+    a, b = socket.socketpair()
+    payload = b"x" * (protocol.COALESCE_SIZE * 3 + 1)
+
+    t = threading.Thread(target=protocol.send_frame, args=(a, payload, protocol.MSG_REQUEST, 5))
+    t.start()
+    msg_type, flags, received = protocol.recv_frame(b)
+    t.join()
+
+    assert msg_type == protocol.MSG_REQUEST
+    assert flags == 5
+    assert received == payload
+
+def test_back_to_back_frames():
+    a, b = socket.socketpair()
+    protocol.send_frame(a, b"first", protocol.MSG_REQUEST)
+    protocol.send_frame(a, b"", protocol.MSG_REQUEST)
+    protocol.send_frame(a, b"second", protocol.MSG_RESPONSE)
+
+    channel = protocol.Channel(b)
+    assert channel.expect_frame(protocol.MSG_REQUEST) == b"first"
+    assert channel.expect_frame(protocol.MSG_REQUEST) == b""
+    assert channel.expect_frame(protocol.MSG_RESPONSE) == b"second"
+
+def test_bad_magic():
+    a, b = socket.socketpair()
+    a.sendall(b"GET / HTTP/1.1\r\n\r\n")
+    with pytest.raises(protocol.ProtocolError):
+        protocol.recv_frame(b)
+
+def test_truncated_frame():
+    a, b = socket.socketpair()
+    a.sendall(protocol.pack_header(protocol.MSG_REQUEST, 10) + b"abc")
+    a.close()
+    with pytest.raises(protocol.ProtocolError):
+        protocol.recv_frame(b)
+
+def test_frame_too_large():
+    a, b = socket.socketpair()
+    a.sendall(protocol.pack_header(protocol.MSG_REQUEST, 1 << 40))
+    with pytest.raises(protocol.ProtocolError):
+        protocol.recv_frame(b, max_size=1 << 20)
+
+def test_chunk_stream_roundtrip():
+    a, b = socket.socketpair()
+    key = streaming.new_key()
+    chunks = [b"a" * 1000, b"b" * 10, b"c" * 5000]
+
+    t = threading.Thread(target=streaming.send_chunks, args=(protocol.Channel(a), key, chunks))
+    t.start()
+    received = list(streaming.recv_chunks(protocol.Channel(b), key))
+    t.join()
+
+    assert received == chunks
+
+@pytest.mark.parametrize("codec", ["zlib", "lzma"])
+def test_chunk_stream_compressed(codec):
+    a, b = socket.socketpair()
+    key = streaming.new_key()
+    chunks = [b"log line\n" * 10000, os.urandom(5000)]
+    frames = []
+
+    # Record the flags of each frame as it is sent
+    channel = protocol.Channel(a)
+    send_frame = channel.send_frame
+    channel.send_frame = lambda payload, msg_type, flags=0: (
+        frames.append((len(payload), flags)), send_frame(payload, msg_type, flags)
+    )
+
+    t = threading.Thread(target=streaming.send_chunks, args=(channel, key, chunks, 0, codec))
+    t.start()
+    received = list(streaming.recv_chunks(protocol.Channel(b), key))
+    t.join()
+
+    assert received == chunks
+    assert frames[0][0] < len(chunks[0]) and frames[0][1] == streaming.COMPRESSION_FLAGS[codec]
+    assert frames[1][1] == 0
+
+def test_chunk_stream_truncated():
+    a, b = socket.socketpair()
+    key = streaming.new_key()
+
+    # Chunk frame marked final at the wrong position fails authentication
+    payload = streaming.seal_chunk(key, 0, b"data", False)
+    protocol.send_frame(a, payload, protocol.MSG_CHUNK, protocol.FLAG_FINAL)
+    with pytest.raises(ValueError):
+        list(streaming.recv_chunks(protocol.Channel(b), key))
+
+def test_codec_roundtrip():
+    request = codec.Request(
+        header="upload_file",
+        sender="foo1",
+        data=codec.RequestData(filename="tmp.txt", user1="foo1", data=b"\x00" * 10, size=10),
+    )
+    decoded = codec.decode(codec.encode(request), codec.Request)
+
+    assert decoded == request
+    assert decoded["data"]["data"] == b"\x00" * 10
+    assert not hasattr(decoded, "__dict__")
+
+    # Once encrypted the data field carries raw ciphertext
+    request["data"] = b"ciphertext"
+    assert codec.decode(codec.encode(request))["data"] == b"ciphertext"
+
+@pytest.mark.parametrize("data", [
+    b"",
+    b"\xff",
+    codec.encode(codec.Hello(user="foo1"))[:-1],
+    codec.encode(codec.Hello(user="foo1")) + b"\x00",
+    pickle.dumps({"header": "add_user"}),
+])
+def test_codec_rejects_malformed(data):
+    with pytest.raises(codec.CodecError):
+        codec.decode(data)
+
+def test_codec_rejects_wrong_type():
+    with pytest.raises(codec.CodecError):
+        codec.decode(codec.encode(codec.Welcome()), codec.Hello)
+
+def test_codec_rejects_undeclared_nesting():
+    # Only the declared data class may be nested, one level deep
+    with pytest.raises(codec.CodecError):
+        codec.encode(codec.Request(data=codec.ResponseData()))
+
+    nested = codec.encode(codec.Request())
+    for _ in range(5000):
+        nested = bytes([codec.Request.type_id]) + b"\x00" * 12 + b"\x01" + nested
+    with pytest.raises(codec.CodecError):
+        codec.decode(nested)
+
+def test_logs_leave_out_payloads():
+    stream = io.StringIO()
+    listener = logs.setup("DEBUG", "json", stream)
+    try:
+        request = codec.Request(
+            header="upload_file",
+            sender="foo1",
+            data=codec.RequestData(filename="tmp.txt", user1="foo1", data=b"secret" * 1000),
+        )
+        logging.getLogger("fileserve.test").debug("request", extra=logs.summarize(request))
+    finally:
+        listener.stop()
+        logging.getLogger("fileserve").handlers.clear()
+        logging.getLogger("fileserve").propagate = True
+        logging.getLogger("fileserve").setLevel(logging.NOTSET)
+
+    record = json.loads(stream.getvalue())
+    assert record["msg"] == "request"
+    assert record["file"] == "tmp.txt" and record["data_bytes"] == 6000
+    assert "secret" not in stream.getvalue()